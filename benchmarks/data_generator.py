@@ -0,0 +1,121 @@
+"""
+Generates synthetic BMI survey data in the layout the strata wrangler reads from s3.
+
+Run from the root of the repository:
+
+    python -m benchmarks.data_generator --rows 1000000 --output bmi_data.json
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+
+# Ranges of Q608 totals that fall in each of the "066" strata, E to A.
+LAND_VALUE_BANDS = [(0, 29999), (30000, 79999), (80000, 129999), (130000, 200000),
+                    (200001, 1000000)]
+
+REGION_NAMES = {1: "North East", 2: "North West", 3: "Yorkshire and The Humber",
+                4: "East Midlands", 5: "West Midlands", 6: "East of England",
+                7: "London", 8: "South East", 9: "South West", 10: "Wales",
+                11: "Scotland", 12: "Scotland", 13: "Northern Ireland",
+                14: "Northern Ireland"}
+
+
+def get_periods(current_period, periods):
+    """
+    Lists the quarterly periods up to and including the current period.
+    :param current_period: The current period, as YYYYMM.
+    :param periods: Number of periods.
+    :return: List of the periods as ints, current period first.
+    """
+    year, month = divmod(int(current_period), 100)
+    quarter_months = year * 12 + month - 1 - 3 * np.arange(periods)
+    return [int(months // 12 * 100 + months % 12 + 1) for months in quarter_months]
+
+
+def generate_bmi_data(rows, periods=2, survey_mix=0.5, anomaly_rate=0.05,
+                      current_period="201809", seed=0):
+    """
+    Generates references with a row for each period. A reference's survey and region
+    are the same in every period. Anomalous references are "066" references whose
+    Q608 total in the earlier periods is in a different strata band to the current
+    period, every other reference keeps the same total.
+    :param rows: Number of rows, rounded down to a whole number of references.
+    :param periods: Number of periods for each reference.
+    :param survey_mix: Share of references in the "066" (land) survey, the rest are
+                       "076" (marine).
+    :param anomaly_rate: Share of the "066" references whose strata changes.
+    :param current_period: The current period, as YYYYMM.
+    :param seed: Seed for the random number generator.
+    :return: DataFrame of the data, current period first.
+    """
+    random = np.random.RandomState(seed)
+    reference_count = max(rows // periods, 1)
+
+    land = random.random_sample(reference_count) < survey_mix
+    anomalous = land & (random.random_sample(reference_count) < anomaly_rate)
+    regions = random.randint(1, 15, reference_count)
+
+    lower, upper = np.array(LAND_VALUE_BANDS).T
+    bands = random.randint(0, len(LAND_VALUE_BANDS), reference_count)
+    current_values = random.randint(lower[bands], upper[bands] + 1)
+    # Marine references are all one strata whatever their total.
+    current_values[~land] = random.randint(0, 500000, (~land).sum())
+
+    # Anomalous references move to one of the other bands.
+    previous_bands = (bands + random.randint(1, len(LAND_VALUE_BANDS),
+                                             reference_count)) % len(LAND_VALUE_BANDS)
+    previous_values = np.where(
+        anomalous,
+        random.randint(lower[previous_bands], upper[previous_bands] + 1),
+        current_values)
+
+    period_data = []
+    for position, period in enumerate(get_periods(current_period, periods)):
+        values = current_values if position == 0 else previous_values
+        period_data.append(pd.DataFrame({
+            "Q601_asphalting_sand": random.randint(0, 10000, reference_count),
+            "Q602_building_soft_sand": random.randint(0, 10000, reference_count),
+            "Q603_concreting_sand": random.randint(0, 10000, reference_count),
+            "Q604_bituminous_gravel": random.randint(0, 10000, reference_count),
+            "Q605_concreting_gravel": random.randint(0, 10000, reference_count),
+            "Q606_other_gravel": random.randint(0, 10000, reference_count),
+            "Q607_constructional_fill": random.randint(0, 10000, reference_count),
+            "Q608_total": values,
+            "enterprise_ref": np.arange(reference_count) % 1000,
+            "survey": np.where(land, "066", "076"),
+            "name": "Generated",
+            "period": period,
+            "responder_id": 49900000000 + np.arange(reference_count),
+            "response_type": 1,
+            "county": random.randint(1, 100, reference_count),
+            "marine": np.where(land, "n", "y"),
+            "region": regions,
+            "region_name": pd.Series(regions).map(REGION_NAMES).to_numpy()
+        }))
+
+    return pd.concat(period_data, ignore_index=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--periods", type=int, default=2)
+    parser.add_argument("--survey-mix", type=float, default=0.5,
+                        help="Share of references in the 066 survey.")
+    parser.add_argument("--anomaly-rate", type=float, default=0.05,
+                        help="Share of 066 references whose strata changes.")
+    parser.add_argument("--current-period", default="201809")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", required=True,
+                        help="File to write the data to as json records.")
+    arguments = parser.parse_args(argv)
+
+    data = generate_bmi_data(arguments.rows, arguments.periods, arguments.survey_mix,
+                             arguments.anomaly_rate, arguments.current_period,
+                             arguments.seed)
+    data.to_json(arguments.output, orient="records")
+
+
+if __name__ == "__main__":
+    main()
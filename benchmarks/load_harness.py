@@ -0,0 +1,376 @@
+"""
+Load tests the wrangler and method together on one machine, with no AWS account.
+
+S3, SQS (the BPM queue) and SNS are replaced by moto, and the method Lambda by a local
+stand in that runs strata_period_method.lambda_handler in this process, enforcing the
+payload limits of a synchronous Lambda invoke. Many wrangler runs are driven at once
+and the throughput, latency percentiles and memory are printed as json:
+
+    python -m benchmarks.load_harness --rows 100000 --runs 50 --concurrency 8
+    python -m benchmarks.load_harness --runs 50 --concurrency 4 --processes 4 \
+        --environment pass_data_by_reference=true
+
+Threads share one interpreter, so the method's pandas work only overlaps where it
+releases the GIL. --processes runs that many copies of the harness, each with its own
+moto and its own share of the runs, to load every core.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from unittest import mock
+
+import boto3
+import numpy as np
+import pandas as pd
+from botocore.exceptions import ClientError
+from moto import mock_s3, mock_sns, mock_sqs
+
+import strata_common
+import strata_metrics
+import strata_period_method
+import strata_period_wrangler
+from benchmarks.data_generator import generate_bmi_data
+from benchmarks.strata_benchmark import environment_variables, wrangler_runtime_variables
+
+# Largest request and response of a synchronous (RequestResponse) Lambda invoke.
+PAYLOAD_LIMIT_BYTES = 6291456
+
+fake_aws_environment = {"AWS_ACCESS_KEY_ID": "load",
+                        "AWS_SECRET_ACCESS_KEY": "load",
+                        "AWS_DEFAULT_REGION": "eu-west-2",
+                        # Keeps moto from storing bodies over 1MB with their
+                        # aws-chunked framing, see strata_benchmark.
+                        "AWS_REQUEST_CHECKSUM_CALCULATION": "when_required"}
+
+
+class LocalContext:
+    def __init__(self, aws_request_id):
+        self.aws_request_id = aws_request_id
+
+
+class LocalLambda:
+    """
+    Stands in for the boto3 Lambda client, running the method in this process. As with
+    Lambda, a request over the payload limit is rejected before the method runs, and
+    a method that raises or returns more than the limit gives an "Unhandled" function
+    error instead of its response. Safe to share between threads.
+    """
+    def __init__(self, payload_limit=PAYLOAD_LIMIT_BYTES):
+        """
+        :param payload_limit: Largest request and response in bytes.
+        """
+        self.payload_limit = payload_limit
+        self.lock = threading.Lock()
+        self.invocations = 0
+        self.request_bytes = []
+        self.response_bytes = []
+        self.rejected = 0
+
+    def invoke(self, FunctionName, Payload, **kwargs):  # noqa: N803
+        payload = Payload.encode("UTF-8") if isinstance(Payload, str) else Payload
+        with self.lock:
+            self.invocations += 1
+            self.request_bytes.append(len(payload))
+
+        if len(payload) > self.payload_limit:
+            with self.lock:
+                self.rejected += 1
+            raise ClientError(
+                {"Error": {"Code": "RequestEntityTooLargeException",
+                           "Message": f"{len(payload)} byte payload is too large for "
+                                      f"the RequestResponse invocation type (limit "
+                                      f"{self.payload_limit} bytes)"}},
+                "Invoke")
+
+        result = {"StatusCode": 200, "ExecutedVersion": "$LATEST"}
+        try:
+            response = json.dumps(strata_period_method.lambda_handler(
+                json.loads(payload), LocalContext(FunctionName))).encode("UTF-8")
+        except Exception as e:
+            result["FunctionError"] = "Unhandled"
+            response = json.dumps({"errorMessage": str(e),
+                                   "errorType": type(e).__name__}).encode("UTF-8")
+
+        if len(response) > self.payload_limit:
+            result["FunctionError"] = "Unhandled"
+            response = json.dumps({
+                "errorMessage": f"Response payload size ({len(response)} bytes) "
+                                f"exceeded maximum allowed payload size "
+                                f"({self.payload_limit} bytes).",
+                "errorType": "Function.ResponseSizeTooLarge"}).encode("UTF-8")
+
+        with self.lock:
+            self.response_bytes.append(len(response))
+            if "FunctionError" in result:
+                self.rejected += 1
+        result["Payload"] = io.BytesIO(response)
+        return result
+
+
+class MemorySampler:
+    """
+    Samples the resident set size of this process in a background thread, to find its
+    peak while the runs are going.
+    """
+    def __init__(self, interval=0.05):
+        """
+        :param interval: Seconds between samples.
+        """
+        self.interval = interval
+        self.peak = strata_metrics.get_rss_bytes()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            rss = strata_metrics.get_rss_bytes()
+            if rss is not None and (self.peak is None or rss > self.peak):
+                self.peak = rss
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stopped.set()
+        self.thread.join()
+        return False
+
+
+def set_up_aws(data, bucket_name, in_file_name):
+    """
+    Creates the bucket holding the input data, the BPM queue and the SNS topic in moto.
+    :param data: DataFrame of the input data.
+    :param bucket_name: Name of the bucket.
+    :param in_file_name: Name of the input file, without its extension.
+    :return: Tuple of the queue url and topic arn.
+    """
+    s3 = boto3.client("s3", region_name="eu-west-2")
+    s3.create_bucket(Bucket=bucket_name,
+                     CreateBucketConfiguration={"LocationConstraint": "eu-west-2"})
+    s3.put_object(Bucket=bucket_name, Key=in_file_name + ".json",
+                  Body=data.to_json(orient="records").encode("UTF-8"))
+
+    sqs = boto3.client("sqs", region_name="eu-west-2")
+    queue_url = sqs.create_queue(QueueName="strata-load-bpm")["QueueUrl"]
+
+    sns = boto3.client("sns", region_name="eu-west-2")
+    topic_arn = sns.create_topic(Name="strata-load")["TopicArn"]
+    sns.subscribe(TopicArn=topic_arn, Protocol="sqs",
+                  Endpoint=sqs.get_queue_attributes(
+                      QueueUrl=queue_url,
+                      AttributeNames=["QueueArn"])["Attributes"]["QueueArn"])
+
+    return queue_url, topic_arn
+
+
+def run_load(data, current_period, runs, concurrency, extra_environment=None,
+             worker=0, payload_limit=PAYLOAD_LIMIT_BYTES):
+    """
+    Runs the wrangler runs times, concurrency at a time, against moto and a LocalLambda.
+    Each run has its own run_id and output files.
+    :param data: DataFrame of the input data.
+    :param current_period: The current period of the runs.
+    :param runs: Number of wrangler runs.
+    :param concurrency: Number of runs at a time.
+    :param extra_environment: Dict of wrangler environment variables to add, such as
+                              pass_data_by_reference or data_encoding.
+    :param worker: Number of this worker, used in the run_ids.
+    :param payload_limit: Largest invoke request and response in bytes.
+    :return: Dict of each run's latency and error, the total wall time, the Lambda
+             stand in's counts and the peak memory.
+    """
+    bucket_name = environment_variables["bucket_name"]
+    in_file_name = wrangler_runtime_variables["in_file_name"]
+    environment = dict(fake_aws_environment, **environment_variables)
+    environment.update(extra_environment or {})
+    local_lambda = LocalLambda(payload_limit)
+
+    def run_wrangler(run_number):
+        run_id = f"load-{worker}-{run_number}"
+        runtime_variables = dict(wrangler_runtime_variables,
+                                 anomalies_file_name=f"load/{run_id}/anomalies",
+                                 bpm_queue_url=queue_url,
+                                 out_file_name=f"load/{run_id}/output.json",
+                                 period=current_period,
+                                 run_id=run_id,
+                                 sns_topic_arn=topic_arn)
+        start = time.perf_counter()
+        error = None
+        try:
+            strata_period_wrangler.lambda_handler(
+                {"RuntimeVariables": runtime_variables}, LocalContext(run_id))
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"[:200]
+        return time.perf_counter() - start, error
+
+    with mock.patch.dict(os.environ, environment), mock_s3(), mock_sqs(), mock_sns():
+        queue_url, topic_arn = set_up_aws(data, bucket_name, in_file_name)
+
+        strata_common.boto3_clients.clear()
+        strata_common.environment_cache.clear()
+        strata_common.boto3_clients["lambda"] = local_lambda
+        try:
+            with MemorySampler() as memory, \
+                    ThreadPoolExecutor(max_workers=concurrency) as executor:
+                start = time.perf_counter()
+                results = list(executor.map(run_wrangler, range(runs)))
+                wall_seconds = time.perf_counter() - start
+        finally:
+            strata_common.boto3_clients.clear()
+            strata_common.environment_cache.clear()
+
+    return {
+        "latencies": [latency for latency, _ in results],
+        "errors": [error for _, error in results if error is not None],
+        "wall_seconds": wall_seconds,
+        "invocations": local_lambda.invocations,
+        "rejected_invocations": local_lambda.rejected,
+        "request_bytes": local_lambda.request_bytes,
+        "response_bytes": local_lambda.response_bytes,
+        "peak_rss_bytes": memory.peak,
+        # ru_maxrss is in KB on Linux.
+        "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    }
+
+
+def run_worker(arguments, worker, runs):
+    """
+    Generates the data and runs the load in a worker process.
+    :param arguments: Parsed command line arguments.
+    :param worker: Number of the worker.
+    :param runs: Number of runs the worker makes.
+    :return: Result of run_load.
+    """
+    data = generate_bmi_data(arguments.rows, arguments.periods, arguments.survey_mix,
+                             arguments.anomaly_rate, arguments.current_period,
+                             arguments.seed)
+    return run_load(data, arguments.current_period, runs, arguments.concurrency,
+                    arguments.environment, worker, arguments.payload_limit)
+
+
+def summarise(worker_results, wall_seconds):
+    """
+    Combines the results of the workers.
+    :param worker_results: List of run_load results.
+    :param wall_seconds: Time taken by all of the workers.
+    :return: Dict of the throughput, latency percentiles, payload sizes and memory.
+    """
+    latencies = np.concatenate([result["latencies"] for result in worker_results])
+    errors = [error for result in worker_results for error in result["errors"]]
+    request_bytes = [size for result in worker_results
+                     for size in result["request_bytes"]]
+    response_bytes = [size for result in worker_results
+                      for size in result["response_bytes"]]
+    peaks = [result["peak_rss_bytes"] or result["max_rss_bytes"]
+             for result in worker_results]
+
+    def percentiles(values):
+        if not len(values):
+            return {}
+        return {name: round(float(np.percentile(values, q)), 6) for name, q in
+                [("p50", 50), ("p90", 90), ("p99", 99), ("max", 100)]}
+
+    return {
+        "runs": len(latencies),
+        "failed_runs": len(errors),
+        "runs_per_second": round(len(latencies) / wall_seconds, 3),
+        "wall_seconds": round(wall_seconds, 3),
+        "latency_seconds": percentiles(latencies),
+        "invocations": sum(result["invocations"] for result in worker_results),
+        "rejected_invocations": sum(result["rejected_invocations"]
+                                    for result in worker_results),
+        "request_bytes": percentiles(request_bytes),
+        "response_bytes": percentiles(response_bytes),
+        "peak_rss_mb": round(max(peaks) / 2 ** 20, 3),
+        "total_peak_rss_mb": round(sum(peaks) / 2 ** 20, 3),
+        # The distinct errors, most common first.
+        "errors": pd.Series(errors, dtype=object).value_counts().head(5).to_dict()
+    }
+
+
+def parse_environment(setting):
+    """
+    Splits a name=value environment variable setting.
+    :param setting: String of the setting.
+    :return: Tuple of the name and value.
+    """
+    name, separator, value = setting.partition("=")
+    if not separator:
+        raise argparse.ArgumentTypeError(f"{setting} is not name=value")
+    return name, value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--periods", type=int, default=2)
+    parser.add_argument("--survey-mix", type=float, default=0.5,
+                        help="Share of references in the 066 survey.")
+    parser.add_argument("--anomaly-rate", type=float, default=0.05,
+                        help="Share of 066 references whose strata changes.")
+    parser.add_argument("--current-period", default="201809")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--runs", type=int, default=20,
+                        help="Number of wrangler runs in total.")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="Number of runs at a time in each process.")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="Number of processes to share the runs between.")
+    parser.add_argument("--environment", type=parse_environment, action="append",
+                        default=[], metavar="NAME=VALUE",
+                        help="Wrangler environment variable to set. Repeatable.")
+    parser.add_argument("--payload-limit", type=int, default=PAYLOAD_LIMIT_BYTES,
+                        help="Largest invoke request and response in bytes. "
+                             f"Default: {PAYLOAD_LIMIT_BYTES}")
+    parser.add_argument("--output", help="File to also write the results to.")
+    arguments = parser.parse_args(argv)
+    arguments.environment = dict(arguments.environment)
+
+    # Spread the runs as evenly as possible over the processes.
+    worker_runs = [len(runs) for runs in
+                   np.array_split(np.arange(arguments.runs), arguments.processes)]
+
+    if arguments.processes == 1:
+        worker_results = [run_worker(arguments, 0, arguments.runs)]
+    else:
+        with ProcessPoolExecutor(max_workers=arguments.processes) as executor:
+            worker_results = list(executor.map(
+                run_worker, [arguments] * arguments.processes,
+                range(arguments.processes), worker_runs))
+
+    results = {
+        "parameters": {
+            "rows": arguments.rows,
+            "periods": arguments.periods,
+            "runs": arguments.runs,
+            "concurrency": arguments.concurrency,
+            "processes": arguments.processes,
+            "environment": arguments.environment,
+            "payload_limit": arguments.payload_limit
+        },
+        "versions": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__
+        },
+        # The workers run at the same time, so the slowest one is the wall time.
+        "results": summarise(worker_results,
+                             max(result["wall_seconds"] for result in worker_results))
+    }
+
+    output = json.dumps(results, indent=4)
+    print(output)
+    if arguments.output:
+        with open(arguments.output, "w") as output_file:
+            output_file.write(output)
+
+
+if __name__ == "__main__":
+    main()
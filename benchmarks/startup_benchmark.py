@@ -0,0 +1,162 @@
+"""
+Measures the start up cost of the strata lambdas.
+
+Reports the import time of each lambda module (from ``python -X importtime``), each in
+a new interpreter, and the time each lambda spends setting up an invocation
+(validating the environment and runtime variables and creating the boto3 client) for
+a cold container and for warm invocations.
+
+Run from the root of the repository:
+
+    python -m benchmarks.startup_benchmark --repeat 100
+"""
+import argparse
+import importlib
+import json
+import os
+import subprocess
+import sys
+import time
+
+LAMBDA_MODULES = ["strata_period_method", "strata_period_wrangler"]
+
+method_environment_variables = {
+    "strata_column": "strata",
+    "value_column": "Q608_total"
+}
+
+method_runtime_variables = {
+    "bpm_queue_url": "fake_queue_url",
+    "current_period": "201809",
+    "data": "[]",
+    "environment": "sandbox",
+    "period_column": "period",
+    "reference": "responder_id",
+    "region_column": "region",
+    "run_id": "bob",
+    "segmentation": "strata",
+    "survey": "BMI_SG",
+    "survey_column": "survey"
+}
+
+
+wrangler_environment_variables = {
+    "bucket_name": "startup-bucket",
+    "method_name": "strata_period_method",
+    "period_column": "period",
+    "reference": "responder_id",
+    "segmentation": "strata"
+}
+
+wrangler_runtime_variables = {
+    "bpm_queue_url": "fake_queue_url",
+    "distinct_values": ["region"],
+    "environment": "sandbox",
+    "in_file_name": "strata_input",
+    "out_file_name": "strata_output.json",
+    "period": "201809",
+    "run_id": "bob",
+    "sns_topic_arn": "fake_sns_arn",
+    "survey": "BMI_SG",
+    "survey_column": "survey",
+    "total_steps": 6
+}
+
+
+def measure_import_time(module_name, top=10):
+    """
+    Imports a module in a new interpreter with -X importtime.
+    :param module_name: Name of the module to import.
+    :param top: Number of the slowest imports made by the module to report.
+    :return: Dict of the module's import time and its slowest imports, in ms.
+    """
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import " + module_name],
+        stderr=subprocess.PIPE, universal_newlines=True, check=True,
+        env=dict(os.environ, AWS_DEFAULT_REGION="eu-west-2"))
+
+    # Nested imports are indented below the module that imported them and are
+    # listed before it, so the lambda's own imports are the ones one level in.
+    total = 0
+    imported = {}
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth == 0 and name.strip() == module_name:
+            total = int(cumulative) / 1000
+        elif depth == 1:
+            imported[name.strip()] = int(cumulative) / 1000
+        elif depth == 0:
+            imported.clear()
+
+    slowest = sorted(imported.items(), key=lambda item: item[1], reverse=True)
+    return {
+        "total_ms": round(total, 3),
+        "slowest_ms": {name: round(ms, 3) for name, ms in slowest[:top]}
+    }
+
+
+def measure_setup_time(module_name, environment_variables, runtime_variables, repeat):
+    """
+    Times the per invocation set up of a lambda, once with empty caches and then for
+    warm invocations.
+    :param module_name: Name of the lambda module.
+    :param environment_variables: Dict of the lambda's environment variables.
+    :param runtime_variables: Dict of the lambda's runtime variables.
+    :param repeat: Number of warm invocations to time.
+    :return: Dict of the cold and mean warm set up times, in ms.
+    """
+    os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-2")
+    os.environ.update(environment_variables)
+    import strata_common
+
+    module = importlib.import_module(module_name)
+
+    def set_up():
+        start = time.perf_counter()
+        strata_common.get_boto3_client("lambda")
+        strata_common.load_environment(module.EnvironmentSchema)
+        strata_common.load_runtime(module.RuntimeSchema, runtime_variables)
+        return (time.perf_counter() - start) * 1000
+
+    strata_common.boto3_clients.clear()
+    strata_common.environment_cache.clear()
+    strata_common.schema_cache.clear()
+    cold = set_up()
+    warm = [set_up() for _ in range(repeat)]
+
+    return {
+        "cold_ms": round(cold, 3),
+        "warm_mean_ms": round(sum(warm) / len(warm), 3)
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=100,
+                        help="Number of warm invocations to time.")
+    parser.add_argument("--top", type=int, default=10,
+                        help="Number of the slowest imports to report per module.")
+    arguments = parser.parse_args(argv)
+
+    results = {
+        "import_time": {module_name: measure_import_time(module_name, arguments.top)
+                        for module_name in LAMBDA_MODULES},
+        # The wrangler is measured first, so its set up doesn't gain from the method's
+        # imports.
+        "setup_time": {
+            "strata_period_wrangler": measure_setup_time(
+                "strata_period_wrangler", wrangler_environment_variables,
+                wrangler_runtime_variables, arguments.repeat),
+            "strata_period_method": measure_setup_time(
+                "strata_period_method", method_environment_variables,
+                method_runtime_variables, arguments.repeat)
+        }
+    }
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+"""
+Times each stage of the strata method and the wrangler's round trip on synthetic data.
+
+S3 is replaced by moto and the method Lambda is run in this process, so no AWS account
+is needed. Results are printed as json and can be compared against a stored baseline:
+
+    python -m benchmarks.strata_benchmark --rows 1000000 --output baseline.json
+    python -m benchmarks.strata_benchmark --rows 1000000 --baseline baseline.json
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import sys
+import time
+import tracemalloc
+from unittest import mock
+
+import boto3
+import numpy as np
+import pandas as pd
+from moto import mock_s3
+
+import strata_common
+import strata_period_method
+import strata_period_wrangler
+from benchmarks.data_generator import generate_bmi_data
+
+environment_variables = {
+    "bucket_name": "benchmark-bucket",
+    "method_name": "strata_period_method",
+    "period_column": "period",
+    "reference": "responder_id",
+    "segmentation": "strata",
+    "strata_column": "strata",
+    "value_column": "Q608_total"
+}
+
+wrangler_runtime_variables = {
+    "bpm_queue_url": "fake_queue_url",
+    "distinct_values": ["region"],
+    "environment": "benchmark",
+    "in_file_name": "strata_benchmark_input",
+    "out_file_name": "strata_benchmark_output.json",
+    "run_id": "benchmark",
+    "sns_topic_arn": "fake_sns_arn",
+    "survey": "BMI_SG",
+    "survey_column": "survey",
+    "total_steps": 6
+}
+
+
+class BenchmarkContext:
+    aws_request_id = "benchmark"
+
+
+class InProcessLambda:
+    """
+    Stands in for the boto3 Lambda client, running the method in this process.
+    """
+    def invoke(self, FunctionName, Payload):  # noqa: N803
+        response = strata_period_method.lambda_handler(json.loads(Payload),
+                                                       BenchmarkContext())
+        return {"Payload": io.BytesIO(json.dumps(response).encode("UTF-8"))}
+
+
+def time_stage(function, repeat):
+    """
+    Runs a stage repeat times, then once more with tracemalloc to find its peak
+    memory, which is kept out of the timings as tracing slows it down.
+    :param function: Function running the stage.
+    :param repeat: Number of timed runs.
+    :return: Dict of the fastest and mean run in seconds and the peak memory in MB.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "seconds_min": round(min(timings), 6),
+        "seconds_mean": round(sum(timings) / len(timings), 6),
+        "peak_memory_mb": round(peak / 2 ** 20, 3)
+    }
+
+
+def benchmark_method(data, current_period, repeat):
+    """
+    Times the stages of the method: parsing the json payload, classifying the strata,
+    mismatch detection and serialising the output and anomalies.
+    :param data: DataFrame of the input data.
+    :param current_period: The current period of the run.
+    :param repeat: Number of timed runs of each stage.
+    :return: Dict of stage name to its timings.
+    """
+    strata_column = environment_variables["strata_column"]
+    period_column = environment_variables["period_column"]
+    segmentation = environment_variables["segmentation"]
+    payload = data.to_json(orient="records")
+    strata_rules = strata_period_method.load_strata_rules()
+
+    def parse():
+        return strata_common.decode_dataframe(payload, "json-records")
+
+    def classify():
+        return strata_period_method.classify_strata(
+            input_data, environment_variables["value_column"], "region",
+            strata_column, "survey", strata_rules)
+
+    def detect_mismatches():
+        return strata_period_method.strata_mismatch_detector(
+            post_strata, current_period, period_column,
+            environment_variables["reference"], segmentation, "good_" + segmentation,
+            "current_" + period_column, "previous_" + period_column,
+            "current_" + segmentation, "previous_" + segmentation)
+
+    def serialise():
+        return (strata_common.encode_dataframe(strata_check, "json-records"),
+                anomalies.to_json(orient="records"))
+
+    stages = {"parse": time_stage(parse, repeat)}
+    input_data = parse()
+    stages["classify"] = time_stage(classify, repeat)
+    post_strata = classify()
+    stages["mismatch_detection"] = time_stage(detect_mismatches, repeat)
+    strata_check, anomalies = detect_mismatches()
+    stages["serialise"] = time_stage(serialise, repeat)
+
+    return stages, len(anomalies)
+
+
+def benchmark_wrangler(data, current_period, repeat, extra_environment=None):
+    """
+    Times the wrangler reading the data from s3, invoking the method and saving the
+    output, with moto in place of s3 and the method run in this process.
+    :param data: DataFrame of the input data.
+    :param current_period: The current period of the run.
+    :param repeat: Number of timed runs.
+    :param extra_environment: Dict of wrangler environment variables to add, such as
+                              data_encoding or pass_data_by_reference.
+    :return: Dict of the timings.
+    """
+    bucket_name = environment_variables["bucket_name"]
+    environment = dict(environment_variables, **(extra_environment or {}))
+    runtime_variables = dict(wrangler_runtime_variables, period=current_period)
+    context = BenchmarkContext()
+
+    def run_wrangler():
+        strata_period_wrangler.lambda_handler({"RuntimeVariables": runtime_variables},
+                                              context)
+
+    # Newer botocore sends bodies over 1MB with aws-chunked encoding, which moto
+    # stores with the chunk framing still in it unless checksums are only sent when
+    # an operation requires them.
+    fake_aws_environment = {"AWS_ACCESS_KEY_ID": "benchmark",
+                            "AWS_SECRET_ACCESS_KEY": "benchmark",
+                            "AWS_DEFAULT_REGION": "eu-west-2",
+                            "AWS_REQUEST_CHECKSUM_CALCULATION": "when_required"}
+    with mock.patch.dict(os.environ, dict(fake_aws_environment, **environment)), \
+            mock_s3(), \
+            mock.patch("strata_period_wrangler.aws_functions.send_bpm_status"), \
+            mock.patch("strata_period_wrangler.aws_functions."
+                       "send_sns_message_with_anomalies"):
+        client = boto3.client("s3", region_name="eu-west-2")
+        client.create_bucket(
+            Bucket=bucket_name,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"})
+        client.put_object(Bucket=bucket_name,
+                          Key=runtime_variables["in_file_name"] + ".json",
+                          Body=data.to_json(orient="records").encode("UTF-8"))
+
+        strata_common.boto3_clients.clear()
+        strata_common.environment_cache.clear()
+        strata_common.boto3_clients["lambda"] = InProcessLambda()
+        try:
+            return time_stage(run_wrangler, repeat)
+        finally:
+            strata_common.boto3_clients.clear()
+            strata_common.environment_cache.clear()
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """
+    Finds the stages that have slowed down by more than the tolerance since the
+    baseline, comparing the fastest runs.
+    :param results: Benchmark results.
+    :param baseline: Benchmark results to compare against.
+    :param tolerance: Allowed slow down, as a fraction of the baseline.
+    :return: List of dicts describing each regression.
+    """
+    regressions = []
+    for stage, timings in results["stages"].items():
+        if stage not in baseline.get("stages", {}):
+            continue
+        baseline_seconds = baseline["stages"][stage]["seconds_min"]
+        ratio = timings["seconds_min"] / baseline_seconds if baseline_seconds else 1
+        if ratio > 1 + tolerance:
+            regressions.append({
+                "stage": stage,
+                "baseline_seconds": baseline_seconds,
+                "seconds": timings["seconds_min"],
+                "ratio": round(ratio, 3)
+            })
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--periods", type=int, default=2)
+    parser.add_argument("--survey-mix", type=float, default=0.5,
+                        help="Share of references in the 066 survey.")
+    parser.add_argument("--anomaly-rate", type=float, default=0.05,
+                        help="Share of 066 references whose strata changes.")
+    parser.add_argument("--current-period", default="201809")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of timed runs of each stage.")
+    parser.add_argument("--skip-wrangler", action="store_true",
+                        help="Only time the stages of the method.")
+    parser.add_argument("--output", help="File to also write the results to.")
+    parser.add_argument("--baseline",
+                        help="Results file to compare against. Exits with 1 if any "
+                             "stage is slower by more than the tolerance.")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed slow down against the baseline. Default: 0.2")
+    arguments = parser.parse_args(argv)
+
+    data = generate_bmi_data(arguments.rows, arguments.periods, arguments.survey_mix,
+                             arguments.anomaly_rate, arguments.current_period,
+                             arguments.seed)
+
+    stages, anomaly_count = benchmark_method(data, arguments.current_period,
+                                             arguments.repeat)
+    if not arguments.skip_wrangler:
+        stages["wrangler"] = benchmark_wrangler(data, arguments.current_period,
+                                                arguments.repeat)
+        stages["wrangler_by_reference"] = benchmark_wrangler(
+            data, arguments.current_period, arguments.repeat,
+            {"pass_data_by_reference": "true"})
+        stages["wrangler_stream_output"] = benchmark_wrangler(
+            data, arguments.current_period, arguments.repeat, {"stream_output": "true"})
+
+    results = {
+        "parameters": {
+            "rows": len(data),
+            "periods": arguments.periods,
+            "survey_mix": arguments.survey_mix,
+            "anomaly_rate": arguments.anomaly_rate,
+            "seed": arguments.seed,
+            "repeat": arguments.repeat
+        },
+        "versions": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__
+        },
+        "anomaly_count": anomaly_count,
+        "stages": stages,
+        # ru_maxrss is in KB on Linux.
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 3)
+    }
+
+    if arguments.baseline:
+        with open(arguments.baseline) as baseline_file:
+            results["regressions"] = compare_to_baseline(
+                results, json.load(baseline_file), arguments.tolerance)
+
+    output = json.dumps(results, indent=4)
+    print(output)
+    if arguments.output:
+        with open(arguments.output, "w") as output_file:
+            output_file.write(output)
+
+    if results.get("regressions"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
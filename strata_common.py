@@ -0,0 +1,242 @@
+import base64
+import os
+import zlib
+
+import boto3
+import pandas as pd
+
+# Ways a DataFrame can be carried in the data field of the wrangler and method payloads.
+DATA_ENCODINGS = ["json-records", "json-split", "arrow-base64"]
+
+# Compressions the method can apply to the data and anomalies it returns.
+RESPONSE_COMPRESSIONS = ["gzip", "zstd"]
+
+# Kept for the life of the container so warm invocations skip the setup.
+boto3_clients = {}
+environment_cache = {}
+schema_cache = {}
+
+
+def get_boto3_client(service_name, client_factory=None, cache_key=None, config=None):
+    """
+    Gets a boto3 client, creating it the first time it is needed by the container.
+    :param service_name: Name of the AWS service.
+    :param client_factory: Function used to create the client. Default: boto3.client
+    :param cache_key: Name the client is kept under, for a client with its own config.
+                      Default: service_name
+    :param config: botocore Config to create the client with.
+    :return: boto3 client for the service.
+    """
+    cache_key = cache_key or service_name
+    if cache_key not in boto3_clients:
+        client_factory = client_factory or boto3.client
+        client_options = {"region_name": "eu-west-2"}
+        if config is not None:
+            client_options["config"] = config
+        boto3_clients[cache_key] = client_factory(service_name, **client_options)
+
+    return boto3_clients[cache_key]
+
+
+def get_schema(schema_class):
+    """
+    Gets an instance of a schema, creating it the first time it is needed.
+    :param schema_class: Marshmallow schema class.
+    :return: Instance of the schema.
+    """
+    if schema_class not in schema_cache:
+        schema_cache[schema_class] = schema_class()
+
+    return schema_cache[schema_class]
+
+
+def load_environment(schema_class, environ=None):
+    """
+    Validates the environment variables with a schema. The result is kept and reused
+    for as long as the variables the schema declares have the same values.
+    :param schema_class: Marshmallow schema class for the environment variables.
+    :param environ: Mapping of environment variables. Default: os.environ
+    :return: Dict of the validated environment variables.
+    """
+    environ = os.environ if environ is None else environ
+    schema = get_schema(schema_class)
+    values = tuple(environ.get(name) for name in schema.fields)
+    cache_key = (schema_class,) + values
+    if cache_key not in environment_cache:
+        # Only the declared variables are given to the schema, not all of os.environ.
+        environment_cache[cache_key] = schema.load({
+            name: value for name, value in zip(schema.fields, values)
+            if value is not None})
+
+    return environment_cache[cache_key]
+
+
+def load_runtime(schema_class, variables, passthrough_fields=("data",)):
+    """
+    Validates runtime variables with a schema, giving it only the variables it
+    declares. The fields in passthrough_fields, which can hold several MB, are only
+    checked to be strings: the schema is given an empty string in their place and the
+    value is put back afterwards. Any other value for them is given to the schema as
+    it is, so every error is the one the schema's handle_error raises.
+    :param schema_class: Marshmallow schema class for the runtime variables.
+    :param variables: Dict of runtime variables.
+    :param passthrough_fields: Names of the string fields that are only type checked.
+    :return: Dict of the validated runtime variables.
+    """
+    schema = get_schema(schema_class)
+    declared = {name: variables[name] for name in schema.fields if name in variables}
+
+    passed = {}
+    for name in passthrough_fields:
+        if isinstance(declared.get(name), str):
+            passed[name] = declared[name]
+            declared[name] = ""
+
+    loaded = schema.load(declared)
+    loaded.update(passed)
+    return loaded
+
+
+def encode_dataframe(data, data_encoding="json-records"):
+    """
+    Encodes a DataFrame for the data field of a payload.
+    json-records is the original format, json-split only writes the column names once
+    and arrow-base64 is an Arrow IPC stream which keeps the dtypes of the columns.
+    :param data: DataFrame to encode.
+    :param data_encoding: One of DATA_ENCODINGS.
+    :return: String holding the encoded data.
+    """
+    if data_encoding == "json-records":
+        return data.to_json(orient="records")
+    if data_encoding == "json-split":
+        return data.to_json(orient="split", index=False)
+    if data_encoding == "arrow-base64":
+        import pyarrow as pa
+
+        table = pa.Table.from_pandas(data, preserve_index=False)
+        sink = pa.BufferOutputStream()
+        writer = pa.ipc.new_stream(sink, table.schema)
+        writer.write_table(table)
+        writer.close()
+        return base64.b64encode(sink.getvalue().to_pybytes()).decode("ascii")
+    raise ValueError(f"Unknown data encoding: {data_encoding}")
+
+
+def decode_dataframe(data, data_encoding="json-records"):
+    """
+    Decodes the data field of a payload back into a DataFrame.
+    :param data: String holding the encoded data.
+    :param data_encoding: One of DATA_ENCODINGS, the encoding used for the data.
+    :return: DataFrame of the data.
+    """
+    if data_encoding == "json-records":
+        return pd.read_json(data, dtype=False)
+    if data_encoding == "json-split":
+        return pd.read_json(data, orient="split", dtype=False)
+    if data_encoding == "arrow-base64":
+        import pyarrow as pa
+
+        return pa.ipc.open_stream(base64.b64decode(data)).read_all().to_pandas()
+    raise ValueError(f"Unknown data encoding: {data_encoding}")
+
+
+def save_records_to_s3(bucket_name, file_name, data, part_size=8388608,
+                       compress=False, rows_per_chunk=50000):
+    """
+    Saves data as json records, the same bytes as DataFrame.to_json would give, using
+    an s3 multipart upload. A DataFrame is encoded a chunk of rows at a time, and
+    batches a batch at a time, and each part is uploaded as soon as it fills, so the
+    whole json is never held in memory.
+    Data that fits in one part is saved with a single put. The upload is aborted if
+    anything fails, so no partial object is left behind.
+    :param bucket_name: Name of the s3 bucket to save to.
+    :param file_name: Name to save the data as.
+    :param data: DataFrame, string of json records, or iterable of DataFrames of
+                 batches of records, each with the same columns.
+    :param part_size: Size of each uploaded part in bytes, at least 5MB.
+    :param compress: Whether to gzip the data, setting the object's ContentEncoding.
+    :param rows_per_chunk: Number of rows of a DataFrame to encode at a time.
+    :return: Number of bytes saved.
+    """
+    s3 = get_boto3_client("s3")
+    object_parameters = {"Bucket": bucket_name, "Key": file_name,
+                         "ContentType": "application/json"}
+    if compress:
+        object_parameters["ContentEncoding"] = "gzip"
+        # A wbits of 31 writes a gzip header and trailer.
+        compressor = zlib.compressobj(wbits=31)
+
+    upload_id = None
+    parts = []
+    buffer = bytearray()
+    saved_bytes = 0
+
+    def upload_part():
+        nonlocal upload_id
+        if upload_id is None:
+            upload_id = s3.create_multipart_upload(**object_parameters)["UploadId"]
+        response = s3.upload_part(Bucket=bucket_name, Key=file_name,
+                                  UploadId=upload_id, PartNumber=len(parts) + 1,
+                                  Body=bytes(buffer))
+        parts.append({"ETag": response["ETag"], "PartNumber": len(parts) + 1})
+        buffer.clear()
+
+    try:
+        for piece in iter_json_record_bytes(data, rows_per_chunk):
+            if compress:
+                piece = compressor.compress(piece)
+            buffer += piece
+            saved_bytes += len(piece)
+            if len(buffer) >= part_size:
+                upload_part()
+        if compress:
+            piece = compressor.flush()
+            buffer += piece
+            saved_bytes += len(piece)
+
+        if upload_id is None:
+            s3.put_object(Body=bytes(buffer), **object_parameters)
+        else:
+            if buffer:
+                upload_part()
+            s3.complete_multipart_upload(Bucket=bucket_name, Key=file_name,
+                                         UploadId=upload_id,
+                                         MultipartUpload={"Parts": parts})
+    except Exception:
+        if upload_id is not None:
+            s3.abort_multipart_upload(Bucket=bucket_name, Key=file_name,
+                                      UploadId=upload_id)
+        raise
+
+    return saved_bytes
+
+
+def iter_json_record_bytes(data, rows_per_chunk, chunk_size=1048576):
+    """
+    Encodes data as json records in pieces. The records of each chunk of a DataFrame,
+    or of each batch, are encoded on their own and joined into one json array.
+    :param data: DataFrame, string of json records, or iterable of DataFrames.
+    :param rows_per_chunk: Number of rows of a DataFrame to encode at a time.
+    :param chunk_size: Number of characters of a string to encode at a time.
+    :return: Generator of UTF-8 encoded bytes.
+    """
+    if isinstance(data, str):
+        for start in range(0, len(data), chunk_size):
+            yield data[start:start + chunk_size].encode("UTF-8")
+        return
+
+    batches = data
+    if isinstance(data, pd.DataFrame):
+        batches = (data.iloc[start:start + rows_per_chunk]
+                   for start in range(0, len(data), rows_per_chunk))
+
+    yield b"["
+    first = True
+    for batch in batches:
+        if len(batch) == 0:
+            continue
+        if not first:
+            yield b","
+        yield batch.to_json(orient="records")[1:-1].encode("UTF-8")
+        first = False
+    yield b"]"
@@ -0,0 +1,132 @@
+import json
+import os
+import sys
+import time
+
+METRICS_NAMESPACE = "ES/Strata"
+
+# Metric name and CloudWatch unit of each measurement a stage can record.
+STAGE_METRICS = {
+    "duration_ms": ("Duration", "Milliseconds"),
+    "rows": ("Rows", "Count"),
+    "payload_bytes": ("PayloadBytes", "Bytes"),
+    "rss_delta_bytes": ("RssDelta", "Bytes")
+}
+
+try:
+    page_size = os.sysconf("SC_PAGE_SIZE")
+except (AttributeError, OSError, ValueError):
+    page_size = 4096
+
+
+class StageMetrics:
+    """
+    Times the stages of one invocation. When enabled each stage is written to stdout
+    as it finishes, as a CloudWatch Embedded Metric Format record, so the stages that
+    ran are logged even if the Lambda then times out. When disabled stage() returns a
+    shared context manager that does nothing.
+    """
+    def __init__(self, module, run_id, enabled=False, namespace=METRICS_NAMESPACE):
+        """
+        :param module: Name of the module, used as a dimension of the metrics.
+        :param run_id: Id of the run, logged with the metrics.
+        :param enabled: Whether to emit the metrics.
+        :param namespace: CloudWatch namespace of the metrics.
+        """
+        self.enabled = enabled
+        self.module = module
+        self.namespace = namespace
+        self.run_id = run_id
+
+    def stage(self, name, rows=None, payload_bytes=None):
+        """
+        Measures the code run in a with block. Row and payload sizes known only at the
+        end of the stage can be set on the dict the with statement gives.
+        :param name: Name of the stage, used as a dimension of the metrics.
+        :param rows: Number of rows handled by the stage.
+        :param payload_bytes: Size of the payload handled by the stage.
+        :return: Context manager giving a dict of the stage's measurements.
+        """
+        if not self.enabled:
+            return disabled_stage
+        return Stage(self, name, rows, payload_bytes)
+
+    def emit(self, name, measurements):
+        """
+        Writes a stage's measurements to stdout as an Embedded Metric Format record.
+        :param name: Name of the stage.
+        :param measurements: Dict of the measurements named in STAGE_METRICS.
+        :return:
+        """
+        record = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": self.namespace,
+                    "Dimensions": [["Module", "Stage"]],
+                    "Metrics": [
+                        {"Name": metric_name, "Unit": unit}
+                        for key, (metric_name, unit) in STAGE_METRICS.items()
+                        if measurements.get(key) is not None
+                    ]
+                }]
+            },
+            "Module": self.module,
+            "Stage": name,
+            "run_id": self.run_id
+        }
+        for key, (metric_name, _) in STAGE_METRICS.items():
+            if measurements.get(key) is not None:
+                record[metric_name] = measurements[key]
+
+        sys.stdout.write(json.dumps(record) + "\n")
+
+
+class Stage:
+    """
+    Context manager measuring a stage for StageMetrics.
+    """
+    def __init__(self, metrics, name, rows, payload_bytes):
+        self.metrics = metrics
+        self.name = name
+        self.measurements = {"rows": rows, "payload_bytes": payload_bytes}
+
+    def __enter__(self):
+        self.start_rss = get_rss_bytes()
+        self.start = time.perf_counter()
+        return self.measurements
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.measurements["duration_ms"] = round(
+            (time.perf_counter() - self.start) * 1000, 3)
+        end_rss = get_rss_bytes()
+        if self.start_rss is not None and end_rss is not None:
+            self.measurements["rss_delta_bytes"] = end_rss - self.start_rss
+        self.metrics.emit(self.name, self.measurements)
+        return False
+
+
+class DisabledStage:
+    """
+    Context manager for StageMetrics when it is disabled.
+    """
+    def __enter__(self):
+        return {}
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+disabled_stage = DisabledStage()
+
+
+def get_rss_bytes():
+    """
+    Gets the resident set size of this process.
+    :return: Size in bytes, or None where /proc is not available.
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * page_size
+    except (OSError, IndexError, ValueError):
+        return None
@@ -1,9 +1,50 @@
+import base64
+import codecs
+import gzip
+import io
+import json
 import logging
 import os
+import uuid
+from itertools import repeat
 
+import numpy as np
 import pandas as pd
-from es_aws_functions import general_functions
-from marshmallow import EXCLUDE, Schema, fields
+from es_aws_functions import aws_functions, general_functions
+from marshmallow import (EXCLUDE, Schema, ValidationError, fields, validate,
+                         validates_schema)
+
+import strata_common
+import strata_metrics
+
+# Kind of value held by a column of each numpy dtype kind, see update_column_kinds.
+COLUMN_KINDS = {"b": "bool", "f": "float", "i": "int", "u": "uint"}
+
+# Strata rules per survey code. A value falls into the band after the last threshold it
+# is greater than, so strata[0] is for values of 29999 or less. A band listed under
+# region_splits is divided again by region, a region below the first breakpoint gets
+# the first of those strata. A reference with no region drops to the band below.
+DEFAULT_STRATA_RULES = {
+    "066": {
+        "thresholds": [29999, 79999, 129999, 200000],
+        "strata": ["E", "D", "C", "B", "A"],
+        "region_splits": {
+            "B": {"breakpoints": [10], "strata": ["B1", "B2"]}
+        }
+    },
+    "076": {
+        "thresholds": [],
+        "strata": ["M"]
+    }
+}
+compiled_rules_cache = {}
+
+# Column holding each row's position in the input while the other columns are set aside.
+ROW_POSITION_COLUMN = "row_position"
+
+# Kept for the life of the container so warm invocations only read it again when it
+# changes.
+strata_lookup_cache = {}
 
 
 class EnvironmentSchema(Schema):
@@ -14,7 +55,17 @@ class EnvironmentSchema(Schema):
         logging.error(f"Error validating environment params: {e}")
         raise ValueError(f"Error validating environment params: {e}")
 
+    compact_dtypes = fields.Bool(missing=False)
+    emit_metrics = fields.Bool(missing=False)
+    executor = fields.Str(missing="serial",
+                          validate=validate.OneOf(["serial", "process"]))
+    process_pool_threshold = fields.Int(missing=500000)
+    process_pool_workers = fields.Int(missing=None)
     strata_column = fields.Str(required=True)
+    strata_rules = fields.Str(missing=None)
+    strata_rules_file = fields.Str(
+        missing=None, validate=validate.Regexp(r".*\.json$",
+                                               error="Must be a .json file."))
     value_column = fields.Str(required=True)
 
 
@@ -26,21 +77,101 @@ class RuntimeSchema(Schema):
         logging.error(f"Error validating runtime params: {e}")
         raise ValueError(f"Error validating runtime params: {e}")
 
+    anomalies_file_name = fields.Str(missing="Strata_Anomalies")
+    batch_size = fields.Int(missing=None)
     bpm_queue_url = fields.Str(required=True)
+    bucket_name = fields.Str(missing=None)
+    classify_only = fields.Bool(missing=False)
     current_period = fields.Str(required=True)
-    data = fields.Str(required=True)
+    data = fields.Str(missing=None, allow_none=True)
+    data_encoding = fields.Str(missing="json-records",
+                               validate=validate.OneOf(strata_common.DATA_ENCODINGS))
     environment = fields.Str(required=True)
+    in_file_name = fields.Str(missing=None)
+    out_file_name = fields.Str(missing=None)
+    # s3 needs every part of a multipart upload but the last to be at least 5MB.
+    output_part_size = fields.Int(missing=8388608,
+                                  validate=validate.Range(min=5242880))
     period_column = fields.Str(required=True)
+    projected = fields.Bool(missing=False)
     reference = fields.Str(required=True)
     region_column = fields.Str(required=True)
+    response_compression = fields.Str(
+        missing=None, validate=validate.OneOf(strata_common.RESPONSE_COMPRESSIONS))
+    response_spill_bytes = fields.Int(missing=None, validate=validate.Range(min=0))
+    response_spill_prefix = fields.Str(missing="strata_spill/")
     segmentation = fields.Str(required=True)
+    strata_lookup_key = fields.Str(missing=None)
     survey = fields.Str(required=True)
     survey_column = fields.Str(required=True)
 
+    @validates_schema
+    def validate_data_source(self, data, **kwargs):
+        # Data is either sent in the payload or read from s3 by the method.
+        if data.get("data") is None and not (data.get("bucket_name") and
+                                             data.get("in_file_name") and
+                                             data.get("out_file_name")):
+            raise ValidationError("Either data or bucket_name, in_file_name and "
+                                  "out_file_name must be provided.")
+
+    @validates_schema
+    def validate_classify_only(self, data, **kwargs):
+        # Only the wrangler's incremental runs classify, and they send the data inline.
+        if data.get("classify_only") and data.get("data") is None:
+            raise ValidationError("classify_only needs the data in the payload.")
+
+    @validates_schema
+    def validate_projected(self, data, **kwargs):
+        # Only the projected columns are returned, so the rest of the data would be
+        # missing from an output saved to s3 by the method.
+        if data.get("projected") and data.get("data") is None:
+            raise ValidationError("projected needs the data in the payload.")
+
+    @validates_schema
+    def validate_response_spill(self, data, **kwargs):
+        if data.get("response_spill_bytes") is not None and not data.get("bucket_name"):
+            raise ValidationError("bucket_name must be provided to spill the response "
+                                  "to s3.")
+
+    @validates_schema
+    def validate_strata_lookup(self, data, **kwargs):
+        if data.get("strata_lookup_key") is not None and (
+                data.get("data") is None or not data.get("bucket_name") or
+                data.get("classify_only")):
+            raise ValidationError("strata_lookup_key needs the data in the payload and "
+                                  "a bucket_name, and can't be used with "
+                                  "classify_only.")
+
+
+class BatchSchema(Schema):
+    class Meta:
+        unknown = EXCLUDE
+
+    def handle_error(self, e, data, **kwargs):
+        logging.error(f"Error validating batch params: {e}")
+        raise ValueError(f"Error validating batch params: {e}")
+
+    runs = fields.List(fields.Dict(), required=True, validate=validate.Length(min=1))
+
 
 def lambda_handler(event, context):
     """
     Applies Calculate strata function to row of DataFrame.
+    When the data is not in the payload it is read from and written back to s3, and
+    only the output file name and the number of anomalies are returned. Giving a
+    batch_size as well streams the data from s3 in batches of that many records,
+    uploading the output a batch at a time in parts of output_part_size bytes.
+    With classify_only, which needs the data in the payload, only the strata are
+    calculated and no anomalies are returned.
+    With projected, which needs the data in the payload, only the reference, period,
+    strata and row_position columns of the data are returned, for the wrangler to add
+    back to the rest of its data.
+    With strata_lookup_key the current period is checked against the strata in that
+    lookup in s3 instead of against other periods in the data, see
+    strata_lookup_detector.
+    With response_compression the returned data and anomalies are compressed and
+    base64 encoded. When the data and anomalies returned would be more than
+    response_spill_bytes, the data is saved to s3 and only its key is returned.
     :param event: Event Object.
     :param context: Context object.
     :return: strata_out - Dict with "success" and "data" or "success and "error".
@@ -56,23 +187,44 @@ def lambda_handler(event, context):
         # Because it is used in exception handling
         run_id = event["RuntimeVariables"]["run_id"]
 
-        environment_variables = EnvironmentSchema().load(os.environ)
+        environment_variables = strata_common.load_environment(EnvironmentSchema)
 
-        runtime_variables = RuntimeSchema().load(event["RuntimeVariables"])
+        runtime_variables = strata_common.load_runtime(RuntimeSchema,
+                                                       event["RuntimeVariables"])
 
         # Environment Variables
+        compact_dtypes = environment_variables["compact_dtypes"]
+        emit_metrics = environment_variables["emit_metrics"]
+        executor = environment_variables["executor"]
+        process_pool_threshold = environment_variables["process_pool_threshold"]
+        process_pool_workers = environment_variables["process_pool_workers"]
         strata_column = environment_variables["strata_column"]
+        strata_rules = load_strata_rules(environment_variables["strata_rules"],
+                                         environment_variables["strata_rules_file"])
         value_column = environment_variables["value_column"]
 
         # Runtime Variables
+        anomalies_file_name = runtime_variables["anomalies_file_name"]
+        batch_size = runtime_variables["batch_size"]
         bpm_queue_url = runtime_variables["bpm_queue_url"]
+        bucket_name = runtime_variables["bucket_name"]
+        classify_only = runtime_variables["classify_only"]
         current_period = runtime_variables["current_period"]
         data = runtime_variables["data"]
+        data_encoding = runtime_variables["data_encoding"]
         environment = runtime_variables['environment']
+        in_file_name = runtime_variables["in_file_name"]
+        out_file_name = runtime_variables["out_file_name"]
+        output_part_size = runtime_variables["output_part_size"]
         period_column = runtime_variables["period_column"]
+        projected = runtime_variables["projected"]
         reference = runtime_variables["reference"]
         region_column = runtime_variables["region_column"]
+        response_compression = runtime_variables["response_compression"]
+        response_spill_bytes = runtime_variables["response_spill_bytes"]
+        response_spill_prefix = runtime_variables["response_spill_prefix"]
         segmentation = runtime_variables["segmentation"]
+        strata_lookup_key = runtime_variables["strata_lookup_key"]
         survey = runtime_variables['survey']
         survey_column = runtime_variables["survey_column"]
 
@@ -91,34 +243,134 @@ def lambda_handler(event, context):
 
     try:
         logger.info("Started - retrieved configuration variables.")
-        input_data = pd.read_json(data, dtype=False)
-        post_strata = input_data.apply(
-            calculate_strata,
-            strata_column=strata_column,
-            value_column=value_column,
-            survey_column=survey_column,
-            region_column=region_column,
-            axis=1,
-        )
-        logger.info("Successfully ran calculation")
-
-        # Perform mismatch detection
-        strata_check, anomalies = strata_mismatch_detector(
-            post_strata,
-            current_period,
-            period_column,
-            reference,
-            segmentation,
-            "good_" + segmentation,
-            "current_" + period_column,
-            "previous_" + period_column,
-            "current_" + segmentation,
-            "previous_" + segmentation)
-
-        json_out = strata_check.to_json(orient="records")
-        anomalies_out = anomalies.to_json(orient="records")
-
-        final_output = {"data": json_out, "anomalies": anomalies_out}
+        metrics = strata_metrics.StageMetrics(current_module, run_id, emit_metrics)
+        if data is None and batch_size is not None:
+            with metrics.stage("stream_strata"):
+                out_file_name, anomalies = stream_strata(
+                    bucket_name,
+                    in_file_name,
+                    out_file_name,
+                    batch_size,
+                    current_period,
+                    strata_column,
+                    value_column,
+                    period_column,
+                    reference,
+                    region_column,
+                    segmentation,
+                    survey_column,
+                    strata_rules,
+                    output_part_size)
+            logger.info("Successfully ran calculation in batches and sent data to s3")
+        else:
+            if data is None:
+                with metrics.stage("s3_read") as stage:
+                    input_data = aws_functions.read_dataframe_from_s3(bucket_name,
+                                                                      in_file_name)
+                    stage["rows"] = len(input_data)
+                logger.info("Successfully retrieved data from s3")
+            else:
+                with metrics.stage("decode", payload_bytes=len(data)) as stage:
+                    input_data = strata_common.decode_dataframe(data, data_encoding)
+                    stage["rows"] = len(input_data)
+
+            strata_lookup = None
+            if strata_lookup_key is not None:
+                with metrics.stage("s3_read_lookup") as stage:
+                    strata_lookup = load_strata_lookup(bucket_name, strata_lookup_key)
+                    # The caller has left out the previous period rows the lookup
+                    # covers, so mismatch detection can't be run without it.
+                    if strata_lookup is None:
+                        raise ValueError(
+                            f"Strata lookup {strata_lookup_key} not found in "
+                            f"{bucket_name}.")
+                    stage["rows"] = len(strata_lookup["references"])
+                logger.info("Successfully retrieved strata lookup")
+
+            if classify_only:
+                # Mismatch detection is left to the caller, which has the strata of
+                # the other periods.
+                with metrics.stage("classify", rows=len(input_data)):
+                    strata_check = classify_strata(input_data, value_column,
+                                                   region_column, strata_column,
+                                                   survey_column, strata_rules)
+                anomalies = pd.DataFrame()
+            # Small inputs are quicker without the cost of starting the process pool.
+            elif executor == "process" and len(input_data) >= process_pool_threshold \
+                    and strata_lookup is None:
+                with metrics.stage("parallel_strata", rows=len(input_data)):
+                    strata_check, anomalies = run_strata_parallel(
+                        input_data,
+                        current_period,
+                        strata_column,
+                        value_column,
+                        period_column,
+                        reference,
+                        region_column,
+                        segmentation,
+                        survey_column,
+                        strata_rules,
+                        process_pool_workers)
+            else:
+                strata_check, anomalies = run_strata(
+                    input_data,
+                    current_period,
+                    strata_column,
+                    value_column,
+                    period_column,
+                    reference,
+                    region_column,
+                    segmentation,
+                    survey_column,
+                    strata_rules,
+                    metrics,
+                    compact_dtypes,
+                    strata_lookup)
+            logger.info("Successfully ran calculation")
+
+            if projected:
+                strata_check = strata_check[[
+                    column for column in strata_check.columns if column in
+                    [reference, period_column, strata_column, segmentation,
+                     ROW_POSITION_COLUMN]]]
+
+        with metrics.stage("encode") as stage:
+            anomalies_out = anomalies.to_json(orient="records")
+            # The streamed output has already been saved to s3.
+            json_out = ""
+            if data is not None:
+                json_out = strata_common.encode_dataframe(strata_check, data_encoding)
+            elif batch_size is None:
+                json_out = strata_check.to_json(orient="records")
+            # The encodings are all ascii, so their length is their size in bytes.
+            stage["payload_bytes"] = len(json_out) + len(anomalies_out)
+
+        if data is None:
+            write_bytes = len(json_out) + (len(anomalies_out) if len(anomalies) else 0)
+            with metrics.stage("s3_write", payload_bytes=write_bytes):
+                if batch_size is None:
+                    aws_functions.save_to_s3(bucket_name, out_file_name, json_out)
+                if len(anomalies) > 0:
+                    aws_functions.save_to_s3(bucket_name, anomalies_file_name,
+                                             anomalies_out)
+            logger.info("Successfully sent data to s3")
+
+            final_output = {"out_file_name": out_file_name,
+                            "anomaly_count": len(anomalies)}
+        else:
+            final_output = {"data": json_out,
+                            "data_encoding": data_encoding,
+                            "anomalies": anomalies_out}
+
+            if response_compression is not None or response_spill_bytes is not None:
+                with metrics.stage("pack_response") as stage:
+                    final_output = pack_response(
+                        final_output, response_compression, response_spill_bytes,
+                        bucket_name, f"{response_spill_prefix}{run_id}/")
+                    stage["payload_bytes"] = len(final_output["anomalies"]) + len(
+                        final_output["data"] or "")
+                if final_output["data"] is None:
+                    logger.info("Successfully saved the response data to s3")
 
     except Exception as e:
         error_message = general_functions.handle_exception(e,
@@ -136,10 +388,670 @@ def lambda_handler(event, context):
     return final_output
 
 
+def batch_lambda_handler(event, context):
+    """
+    Runs the method for each of a list of runs in one invocation, so a backfill over
+    many periods or surveys pays the setup cost once. Each run holds the
+    RuntimeVariables lambda_handler takes. The environment, schemas and strata rules
+    are parsed by the first run and reused by the rest. A failed run does not stop
+    the runs after it.
+    :param event: Event Object, with the runs in RuntimeVariables.
+    :param context: Context object.
+    :return: Dict with "success", false if any run failed, and "results", the response
+             of each run in order, or "success" and "error".
+    """
+    current_module = "Strata - Method Batch"
+    # Define run_id outside of try block
+    run_id = 0
+
+    try:
+        # Retrieve run_id before input validation
+        # Because it is used in exception handling
+        run_id = event["RuntimeVariables"]["run_id"]
+
+        runs = strata_common.load_runtime(BatchSchema, event["RuntimeVariables"])["runs"]
+
+    except Exception as e:
+        error_message = general_functions.handle_exception(e, current_module, run_id,
+                                                           context=context)
+        return {"success": False, "error": error_message}
+
+    results = [lambda_handler({"RuntimeVariables": run}, context) for run in runs]
+
+    return {"success": all(result["success"] for result in results),
+            "results": results}
+
+
+def run_strata(input_data, current_period, strata_column, value_column, period_column,
+               reference, region_column, segmentation, survey_column,
+               strata_rules=None, metrics=None, compact=False, strata_lookup=None):
+    """
+    Calculates the strata for the data then performs mismatch detection against the
+    other periods in it. This is the calculation done by the method, the wrangler calls
+    it directly when invoking the method locally.
+    With compact set the calculation is done on only the columns it needs, cast to
+    smaller dtypes, and the other columns are added back to the result afterwards.
+    Given a strata_lookup the current period is checked against it instead, and the
+    strata of other periods are left as calculated.
+    :param input_data: DataFrame containing the references for every period.
+    :param current_period: The current period of the run.
+    :param strata_column: Column of dataframe for the strata_column to be held.
+    :param value_column: Column of the dataframe containing the Q608 total.
+    :param period_column: Column name of the dataframe containing the period.
+    :param reference: Column name of the dataframe containing the reference.
+    :param region_column: Column name of the dataframe containing the region code.
+    :param segmentation: Column name of the segmentation checked for mismatches.
+    :param survey_column: Column name of the dataframe containing the survey code.
+    :param strata_rules: Rules from compile_strata_rules, defaults to the BMI rules.
+    :param metrics: StageMetrics to time the classification and mismatch detection.
+    :param compact: Whether to calculate on compacted columns, see compact_strata_input.
+    :param strata_lookup: Dict from load_strata_lookup.
+    :return: strata_check, anomalies: The data including the strata and the anomalies.
+    """
+    if metrics is None:
+        metrics = strata_metrics.StageMetrics(None, None)
+
+    data = input_data
+    if compact:
+        with metrics.stage("compact", rows=len(input_data)):
+            data, carried_data = compact_strata_input(
+                input_data, reference, period_column, value_column, region_column,
+                survey_column, [strata_column, segmentation])
+
+    with metrics.stage("classify", rows=len(data)):
+        post_strata = classify_strata(
+            data,
+            strata_column=strata_column,
+            value_column=value_column,
+            survey_column=survey_column,
+            region_column=region_column,
+            strata_rules=strata_rules
+        )
+
+    # Perform mismatch detection
+    with metrics.stage("mismatch_detection", rows=len(post_strata)):
+        if strata_lookup is not None:
+            strata_check = post_strata
+            anomalies = strata_lookup_detector(
+                post_strata,
+                current_period,
+                period_column,
+                reference,
+                segmentation,
+                strata_lookup,
+                "current_" + period_column,
+                "previous_" + period_column,
+                "current_" + segmentation,
+                "previous_" + segmentation)
+        else:
+            strata_check, anomalies = strata_mismatch_detector(
+                post_strata,
+                current_period,
+                period_column,
+                reference,
+                segmentation,
+                "good_" + segmentation,
+                "current_" + period_column,
+                "previous_" + period_column,
+                "current_" + segmentation,
+                "previous_" + segmentation)
+
+    if compact:
+        strata_check = restore_carried_columns(strata_check, carried_data,
+                                               input_data.columns)
+
+    return strata_check, anomalies
+
+
+def compact_strata_input(input_data, reference, period_column, value_column,
+                         region_column, survey_column, strata_columns):
+    """
+    Splits the data into the columns the strata calculation uses and the columns that
+    are only carried through it. The survey is made categorical and the integer
+    period, value and region columns are downcast to the smallest integer dtype. In the
+    carried columns integers are downcast and text repeated across rows is made
+    categorical. Every cast keeps the values, so the data serialises to the same json.
+    :param input_data: DataFrame containing the references for every period.
+    :param reference: Column name of the reference.
+    :param period_column: Column name of the period.
+    :param value_column: Column name of the Q608 total.
+    :param region_column: Column name of the region code.
+    :param survey_column: Column name of the survey code.
+    :param strata_columns: Column names of the strata, kept as they are if present.
+    :return: data, carried_data: The columns used by the calculation, with the row
+             position of each row in ROW_POSITION_COLUMN, and the other columns.
+    """
+    used_columns = [column for column in input_data.columns if column in
+                    [reference, period_column, value_column, region_column,
+                     survey_column] + strata_columns]
+
+    data = input_data[used_columns].copy()
+    data[survey_column] = data[survey_column].astype("category")
+    for column in [period_column, value_column, region_column]:
+        data[column] = downcast_integers(data[column])
+    data[ROW_POSITION_COLUMN] = np.arange(len(data))
+
+    carried_columns = {}
+    for column in input_data.columns.difference(used_columns, sort=False):
+        values = input_data[column]
+        if values.dtype == object:
+            codes, uniques = pd.factorize(values)
+            if len(uniques) <= len(values) // 2:
+                values = pd.Series(pd.Categorical.from_codes(codes, uniques),
+                                   index=values.index)
+        carried_columns[column] = downcast_integers(values)
+
+    return data, pd.DataFrame(carried_columns, index=input_data.index)
+
+
+def restore_carried_columns(data, carried_data, columns):
+    """
+    Adds the carried columns back to the result of a calculation on compacted data,
+    following ROW_POSITION_COLUMN so rows duplicated by the calculation get theirs.
+    :param data: Result of the calculation, including ROW_POSITION_COLUMN.
+    :param carried_data: The carried columns from compact_strata_input.
+    :param columns: Columns of the input data, the order the result is put in.
+    :return: data: The result with every column, new columns after the input's.
+    """
+    positions = data.pop(ROW_POSITION_COLUMN).to_numpy()
+    carried_data = carried_data.iloc[positions].set_index(data.index)
+
+    data = pd.concat([data, carried_data], axis=1)
+    new_columns = [column for column in data.columns if column not in columns]
+    return data[list(columns) + new_columns]
+
+
+def downcast_integers(values):
+    """
+    Downcasts a Series of integers to the smallest integer dtype holding its values,
+    any other Series is returned as it is.
+    :param values: Series to downcast.
+    :return: values: The downcast Series.
+    """
+    if pd.api.types.is_integer_dtype(values.dtype):
+        return pd.to_numeric(values, downcast="integer")
+    return values
+
+
+def run_strata_parallel(input_data, current_period, strata_column, value_column,
+                        period_column, reference, region_column, segmentation,
+                        survey_column, strata_rules=None, max_workers=None):
+    """
+    Runs the same calculation as run_strata across a pool of processes. The data is
+    sorted by reference and split into ranges of references, so every period of a
+    reference is in one partition, and each process runs the classification and
+    mismatch detection for a partition. The columns the processes need are saved as
+    numpy files which they memory map, rather than pickling the data to them.
+    Falls back to run_strata when the strata is not the segmentation being checked
+    or the period is not an integer column.
+    :param input_data: DataFrame containing the references for every period.
+    :param current_period: The current period of the run.
+    :param strata_column: Column of dataframe for the strata_column to be held.
+    :param value_column: Column of the dataframe containing the Q608 total.
+    :param period_column: Column name of the dataframe containing the period.
+    :param reference: Column name of the dataframe containing the reference.
+    :param region_column: Column name of the dataframe containing the region code.
+    :param segmentation: Column name of the segmentation checked for mismatches.
+    :param survey_column: Column name of the dataframe containing the survey code.
+    :param strata_rules: Rules from compile_strata_rules, defaults to the BMI rules.
+    :param max_workers: Number of processes, defaults to the number of CPUs.
+    :return: strata_check, anomalies: The data including the strata and the anomalies.
+    """
+    if strata_column != segmentation or \
+            not pd.api.types.is_integer_dtype(input_data[period_column]):
+        return run_strata(input_data, current_period, strata_column, value_column,
+                          period_column, reference, region_column, segmentation,
+                          survey_column, strata_rules)
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor
+
+    if strata_rules is None:
+        strata_rules = load_strata_rules()
+    max_workers = max_workers or os.cpu_count() or 1
+
+    values, regions, missing_value = get_strata_inputs(input_data[value_column],
+                                                       input_data[region_column])
+    survey_codes, surveys = pd.factorize(input_data[survey_column])
+    reference_codes, references = pd.factorize(input_data[reference], sort=True)
+    order = np.argsort(reference_codes, kind="mergesort")
+    columns = {
+        "position": order,
+        "reference": reference_codes[order],
+        "period": input_data[period_column].to_numpy(dtype=np.int64)[order],
+        "value": values[order],
+        "region": regions[order],
+        "missing_value": missing_value[order],
+        "survey": survey_codes[order]
+    }
+
+    # Move each split point back to the first row of its reference.
+    sorted_references = columns["reference"]
+    split_points = np.linspace(0, len(order), max_workers + 1).astype(int)[1:-1]
+    split_points = np.unique(np.searchsorted(
+        sorted_references, sorted_references[split_points], side="left"))
+    starts = [0] + [int(point) for point in split_points if point > 0]
+    ends = starts[1:] + [len(order)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        column_files = {}
+        for name, column in columns.items():
+            column_files[name] = os.path.join(directory, name + ".npy")
+            np.save(column_files[name], column)
+
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            partitions = list(executor.map(
+                classify_partition, repeat(column_files), starts, ends,
+                repeat(list(surveys)), repeat(strata_rules), repeat(current_period),
+                repeat(reference), repeat(segmentation), repeat(period_column)))
+
+    # Rows of each partition are put back in their original order, a reference with
+    # several current period strata can have had rows added by the mismatch detection.
+    positions = np.concatenate([partition[0] for partition in partitions])
+    strata = np.concatenate([partition[1] for partition in partitions])
+    output_order = np.argsort(positions, kind="mergesort")
+    strata_check = input_data.iloc[positions[output_order]] \
+        .assign(**{strata_column: strata[output_order]})
+
+    changed_partitions = [partition for partition in partitions if partition[4]]
+    if changed_partitions:
+        strata_check = strata_check.reset_index(drop=True)
+        anomalies = [partition[2] for partition in changed_partitions
+                     if len(partition[2]) > 0]
+        if not anomalies:
+            # An empty merge puts the reference column after the current period
+            # columns when there were no current period rows to merge, so the empty
+            # anomalies are taken from a partition which had some if there is one.
+            anomalies = [max((partition[2] for partition in changed_partitions),
+                             key=lambda frame: frame.columns[0] == reference)]
+        anomalies = pd.concat(anomalies, ignore_index=True)
+        anomaly_positions = np.concatenate(
+            [partition[3] for partition in changed_partitions])
+        anomalies = anomalies.iloc[np.argsort(anomaly_positions, kind="mergesort")] \
+            .reset_index(drop=True)
+        anomalies[reference] = references.take(anomalies[reference].to_numpy())
+    else:
+        # No strata changed, so there are no rows in the anomalies.
+        anomalies = strata_check[[reference, segmentation, period_column]][
+            np.zeros(len(strata_check), dtype=bool)]
+
+    return strata_check, anomalies
+
+
+def classify_partition(column_files, start, end, surveys, strata_rules, current_period,
+                       reference, segmentation, period_column):
+    """
+    Classifies one partition of the data for run_strata_parallel and performs its
+    mismatch detection. Run in a separate process.
+    :param column_files: Dict of column name to the numpy file holding it.
+    :param start: First row of the partition.
+    :param end: Row after the last row of the partition.
+    :param surveys: List of the survey codes.
+    :param strata_rules: Rules from compile_strata_rules.
+    :param current_period: The current period of the run.
+    :param reference: Column name of the reference.
+    :param segmentation: Column name of the segmentation checked for mismatches.
+    :param period_column: Column name of the period.
+    :return: positions, strata, anomalies, anomaly_positions, changed: Original
+             position and strata of each row after mismatch detection, the anomalies
+             with the position of their current period row and whether mismatch
+             detection changed the data.
+    """
+    columns = {name: np.load(column_file, mmap_mode="r")[start:end]
+               for name, column_file in column_files.items()}
+
+    strata = classify_strata_arrays(columns["value"], columns["region"],
+                                    columns["missing_value"], columns["survey"],
+                                    surveys, strata_rules)
+    partition = pd.DataFrame({
+        reference: columns["reference"],
+        segmentation: strata,
+        period_column: columns["period"],
+        "position": columns["position"]
+    })
+
+    strata_check, anomalies = strata_mismatch_detector(
+        partition,
+        current_period,
+        period_column,
+        reference,
+        segmentation,
+        "good_" + segmentation,
+        "current_" + period_column,
+        "previous_" + period_column,
+        "current_" + segmentation,
+        "previous_" + segmentation)
+    changed = "current_" + segmentation in anomalies.columns
+
+    # Each anomaly comes from the only current period row with its reference and strata.
+    # The anomalies of a reference are kept together, in the position of its first one.
+    anomaly_positions = np.array([], dtype=np.int64)
+    if len(anomalies) > 0:
+        current_rows = partition[partition[period_column] == int(current_period)] \
+            .drop_duplicates(subset=[reference, segmentation]) \
+            .set_index([reference, segmentation])["position"]
+        anomaly_positions = current_rows.reindex(pd.MultiIndex.from_arrays(
+            [anomalies[reference], anomalies["current_" + segmentation]]))
+        anomaly_positions = anomaly_positions.groupby(
+            anomalies[reference].to_numpy()).transform("min").to_numpy()
+
+    return (strata_check["position"].to_numpy(), strata_check[segmentation].to_numpy(),
+            anomalies, anomaly_positions, changed)
+
+
+def apply_strata_fixes(data, fix_data, reference, segmentation, stored_segmentation):
+    """
+    Sets the segmentation of every row of a reference to its current period strata, for
+    the references found to have changed strata by strata_mismatch_detector.
+    :param data: The DataFrame the strata is being fixed in.
+    :param fix_data: Series of current period strata indexed by reference.
+    :param reference: Field name which is used as a reference for CAC.
+    :param segmentation: Field name of the segmentation used for CAC.
+    :param stored_segmentation: Field name of stored segmentation for CAC.
+    :return: data: DataFrame with the fixed strata and a new index.
+    """
+    if fix_data.index.is_unique:
+        # Map the good strata onto every row of those references rather than
+        # merging it on as an extra column, the index is reset to match a merge.
+        data = data.reset_index(drop=True)
+        good_segmentation = data[reference].map(fix_data)
+    else:
+        # A reference with more than one strata in the current period gets a row
+        # for each of them, which only a merge can reproduce.
+        fix_data = fix_data.rename(stored_segmentation).reset_index()
+        data = pd.merge(data, fix_data, on=reference, how="left")
+        good_segmentation = data.pop(stored_segmentation)
+
+    data[segmentation] = good_segmentation.where(good_segmentation.notna(),
+                                                 data[segmentation])
+    return data
+
+
+def stream_strata(bucket_name, in_file_name, out_file_name, batch_size, current_period,
+                  strata_column, value_column, period_column, reference, region_column,
+                  segmentation, survey_column, strata_rules=None, part_size=8388608):
+    """
+    Runs the same calculation as run_strata on a file in s3 without holding all of it
+    in memory. The strata is calculated a batch of records at a time and only the
+    reference, period and strata are kept for mismatch detection. The file is then read
+    again, and each batch, with the strata fixed by mismatch detection, is uploaded to
+    the output file with an s3 multipart upload as it is classified. Each batch
+    uploaded is cast to the dtypes its columns would have had if the whole file was
+    read at once, so the output is the same as run_strata's.
+    :param bucket_name: Name of the s3 bucket holding the data.
+    :param in_file_name: Name of the input file, without the .json extension.
+    :param out_file_name: Name to save the output as.
+    :param batch_size: Number of records to calculate at a time.
+    :param current_period: The current period of the run.
+    :param strata_column: Column of dataframe for the strata_column to be held.
+    :param value_column: Column of the dataframe containing the Q608 total.
+    :param period_column: Column name of the dataframe containing the period.
+    :param reference: Column name of the dataframe containing the reference.
+    :param region_column: Column name of the dataframe containing the region code.
+    :param segmentation: Column name of the segmentation checked for mismatches.
+    :param survey_column: Column name of the dataframe containing the survey code.
+    :param strata_rules: Rules from compile_strata_rules, defaults to the BMI rules.
+    :param part_size: Size of each uploaded part of the output in bytes, at least 5MB.
+    :return: out_file_name, anomalies: The key of the output and the anomalies.
+    """
+    segmentation_columns = [reference, segmentation, period_column]
+    column_kinds = {}
+
+    def classified_batches(dtypes=None):
+        for batch in iter_s3_record_batches(bucket_name, in_file_name + ".json",
+                                            batch_size):
+            if dtypes is None:
+                update_column_kinds(column_kinds, batch)
+            else:
+                batch = batch.reindex(columns=list(dtypes)).astype(dtypes)
+            yield classify_strata(batch, value_column, region_column, strata_column,
+                                  survey_column, strata_rules)
+
+    segmentation_data = [batch[segmentation_columns] for batch in classified_batches()]
+    if segmentation_data:
+        segmentation_data = pd.concat(segmentation_data, ignore_index=True)
+    else:
+        segmentation_data = pd.DataFrame(columns=segmentation_columns)
+
+    _, anomalies = strata_mismatch_detector(
+        segmentation_data,
+        current_period,
+        period_column,
+        reference,
+        segmentation,
+        "good_" + segmentation,
+        "current_" + period_column,
+        "previous_" + period_column,
+        "current_" + segmentation,
+        "previous_" + segmentation)
+
+    # Same strata changes as found by strata_mismatch_detector, applied to each batch.
+    changed_data = segmentation_data.drop_duplicates(subset=[reference, segmentation],
+                                                     keep=False)
+    fix_data = changed_data[changed_data[period_column] == int(current_period)] \
+        .set_index(reference)[segmentation]
+    del segmentation_data, changed_data
+
+    def fixed_batches():
+        for batch in classified_batches(column_dtypes(column_kinds)):
+            if len(fix_data) > 0:
+                batch = apply_strata_fixes(batch, fix_data, reference, segmentation,
+                                           "good_" + segmentation)
+            yield batch
+
+    strata_common.save_records_to_s3(bucket_name, out_file_name, fixed_batches(),
+                                     part_size)
+
+    return out_file_name, anomalies
+
+
+def update_column_kinds(column_kinds, batch):
+    """
+    Records the kinds of value found in each column of a batch of records, along with
+    whether it has nulls. A column missing from a batch counts as null.
+    :param column_kinds: Dict of column name to its set of kinds, updated in place. The
+                         columns are kept in the order they were first seen.
+    :param batch: DataFrame of a batch of records.
+    :return:
+    """
+    if len(batch) == 0:
+        return
+    for column in column_kinds:
+        if column not in batch.columns:
+            column_kinds[column].add("null")
+
+    for column in batch.columns:
+        values = batch[column]
+        kinds = column_kinds.setdefault(column, set())
+        if values.isna().any():
+            kinds.add("null")
+
+        if values.dtype.kind in COLUMN_KINDS:
+            kinds.add(COLUMN_KINDS[values.dtype.kind])
+        else:
+            # Object columns hold strings, mixed values or bools alongside nulls.
+            inferred = pd.api.types.infer_dtype(values, skipna=True)
+            if inferred == "boolean":
+                kinds.add("bool")
+            elif inferred != "empty":
+                kinds.add("object")
+
+
+def column_dtypes(column_kinds):
+    """
+    Works out the dtype pandas gives each column when all of the records are read at
+    once, from the kinds of value found in each batch by update_column_kinds.
+    :param column_kinds: Dict of column name to its set of kinds.
+    :return: Dict of column name to dtype, in the order of column_kinds.
+    """
+    dtypes = {}
+    for column, kinds in column_kinds.items():
+        values = kinds - {"null"}
+        if values == {"bool"} and "null" not in kinds:
+            dtypes[column] = np.dtype(bool)
+        elif not values or "object" in values or "bool" in values:
+            # Bools alongside nulls or numbers are kept as objects by pandas.
+            dtypes[column] = np.dtype(object)
+        elif "float" in values or "null" in kinds or len(values) > 1:
+            dtypes[column] = np.dtype("float64")
+        else:
+            dtypes[column] = np.dtype("uint64" if values == {"uint"} else "int64")
+
+    return dtypes
+
+
+def iter_s3_record_batches(bucket_name, file_name, batch_size, chunk_size=1048576):
+    """
+    Reads a json records file from s3 in chunks, yielding it as DataFrames of at most
+    batch_size records.
+    :param bucket_name: Name of the s3 bucket holding the file.
+    :param file_name: Key of the file.
+    :param batch_size: Maximum number of records in each DataFrame.
+    :param chunk_size: Number of bytes read from s3 at a time.
+    :return: Generator of DataFrames.
+    """
+    s3 = strata_common.get_boto3_client("s3")
+    body = s3.get_object(Bucket=bucket_name, Key=file_name)["Body"]
+
+    batch = []
+    for record in iter_json_records(body.iter_chunks(chunk_size)):
+        batch.append(record)
+        if len(batch) == batch_size:
+            yield pd.DataFrame(batch)
+            batch = []
+    if batch:
+        yield pd.DataFrame(batch)
+
+
+def iter_json_records(chunks):
+    """
+    Decodes a json array of records a piece at a time, so the whole document never has
+    to be held in memory.
+    :param chunks: Iterable of utf-8 encoded bytes making up the json array.
+    :return: Generator of record dicts.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    separators = " \t\r\n,["
+    buffer = ""
+
+    for chunk in chunks:
+        buffer += text_decoder.decode(chunk)
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in separators:
+                position += 1
+            if position == len(buffer) or buffer[position] == "]":
+                break
+            try:
+                record, position = decoder.raw_decode(buffer, position)
+            except ValueError:
+                # The rest of the record is in the next chunk.
+                break
+            yield record
+        buffer = buffer[position:]
+
+    if buffer.strip() not in ("", "]"):
+        raise ValueError("Incomplete json records in file.")
+
+
+def pack_response(response, response_compression=None, spill_bytes=None,
+                  bucket_name=None, spill_prefix="strata_spill/"):
+    """
+    Compresses the data and anomalies of a response, then, if they are still more than
+    spill_bytes, saves the data to s3 under a new key in spill_prefix and returns the
+    key in its place. The wrangler undoes this with unpack_response.
+    :param response: Dict of the response with the data and anomalies inline.
+    :param response_compression: One of RESPONSE_COMPRESSIONS, or None to not compress.
+    :param spill_bytes: Most bytes to return inline, or None to never save to s3.
+    :param bucket_name: Name of the s3 bucket to save the data to.
+    :param spill_prefix: Prefix of the key to save the data under.
+    :return: Dict of the packed response.
+    """
+    data = response["data"].encode("UTF-8")
+    anomalies = response["anomalies"]
+    if response_compression is not None:
+        data = compress_bytes(data, response_compression)
+        anomalies = base64.b64encode(compress_bytes(
+            anomalies.encode("UTF-8"), response_compression)).decode("ascii")
+        response = dict(response, anomalies=anomalies,
+                        response_compression=response_compression)
+
+    # Compressed data is base64 encoded inline, a third bigger than its bytes.
+    inline_data = base64.b64encode(data).decode("ascii") \
+        if response_compression is not None else response["data"]
+    if spill_bytes is not None and len(inline_data) + len(anomalies) > spill_bytes:
+        data_key = f"{spill_prefix}{uuid.uuid4().hex}"
+        aws_functions.save_to_s3(bucket_name, data_key, data)
+        return dict(response, data=None, data_key=data_key)
+
+    return dict(response, data=inline_data)
+
+
+def unpack_response(response, bucket_name=None):
+    """
+    Undoes pack_response, reading back and deleting data saved to s3.
+    :param response: Dict of the response as returned by the method.
+    :param bucket_name: Name of the s3 bucket the data may have been saved to.
+    :return: Dict of the response with the data and anomalies inline.
+    """
+    response_compression = response.pop("response_compression", None)
+    data_key = response.pop("data_key", None)
+    if data_key is not None:
+        s3 = strata_common.get_boto3_client("s3")
+        data = s3.get_object(Bucket=bucket_name, Key=data_key)["Body"].read()
+        s3.delete_object(Bucket=bucket_name, Key=data_key)
+    elif response_compression is not None:
+        data = base64.b64decode(response["data"])
+    else:
+        return response
+
+    if response_compression is not None:
+        data = decompress_bytes(data, response_compression)
+        response["anomalies"] = decompress_bytes(
+            base64.b64decode(response["anomalies"]), response_compression) \
+            .decode("UTF-8")
+    response["data"] = data.decode("UTF-8")
+
+    return response
+
+
+def compress_bytes(data, compression):
+    """
+    Compresses bytes. zstd needs the zstandard package in the layer.
+    :param data: Bytes to compress.
+    :param compression: One of RESPONSE_COMPRESSIONS.
+    :return: Compressed bytes.
+    """
+    if compression == "gzip":
+        return gzip.compress(data)
+    if compression == "zstd":
+        import zstandard
+
+        return zstandard.ZstdCompressor().compress(data)
+    raise ValueError(f"Unknown compression: {compression}")
+
+
+def decompress_bytes(data, compression):
+    """
+    Decompresses bytes from compress_bytes.
+    :param data: Compressed bytes.
+    :param compression: One of RESPONSE_COMPRESSIONS, the compression used.
+    :return: Decompressed bytes.
+    """
+    if compression == "gzip":
+        return gzip.decompress(data)
+    if compression == "zstd":
+        import zstandard
+
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError(f"Unknown compression: {compression}")
+
+
 def calculate_strata(row, value_column, region_column, strata_column, survey_column):
     """
     Calculates the strata for the reference based on Land or Marine value, question total
-    value and region.
+    value and region. Kept for callers applying it row by row, the calculation itself is
+    done by classify_strata.
     :param row: Row of the dataframe that is being passed into the function.
     :param value_column: Column of the dataframe containing the Q608 total.
     :param region_column: Column name of the dataframe containing the region code.
@@ -147,39 +1059,167 @@ def calculate_strata(row, value_column, region_column, strata_column, survey_col
     :param survey_column: Column name of the dataframe containing the survey code.
     :return: row: The calculated row including the strata.
     """
-    row[strata_column] = ""
-
-    # While Updating Tests I Couldn't Trigger This.
-    # But Raised Question Of Should This Sort Of Data Validation Be Elsewhere?
-    if row[value_column] is None:
-        return row
-
-    if row[strata_column] == "":
-        if row[survey_column] == "076":
-            row[strata_column] = "M"
-        if row[survey_column] == "066" and row[value_column] < 30000:
-            row[strata_column] = "E"
-        if row[survey_column] == "066" and row[value_column] > 29999:
-            row[strata_column] = "D"
-        if row[survey_column] == "066" and row[value_column] > 79999:
-            row[strata_column] = "C"
-        if (
-            row[survey_column] == "066"
-            and row[value_column] > 129999
-            and row[region_column] > 9
-        ):
-            row[strata_column] = "B2"
-        if (
-            row[survey_column] == "066"
-            and row[value_column] > 129999
-            and row[region_column] < 10
-        ):
-            row[strata_column] = "B1"
-        if row[survey_column] == "066" and row[value_column] > 200000:
-            row[strata_column] = "A"
+    post_strata = classify_strata(row.to_frame().T, value_column, region_column,
+                                  strata_column, survey_column)
+    row[strata_column] = post_strata[strata_column].iloc[0]
     return row
 
 
+def classify_strata(data, value_column, region_column, strata_column, survey_column,
+                    strata_rules=None):
+    """
+    Calculates the strata for every reference in the DataFrame in one pass, based on
+    Land or Marine value, question total value and region. Gives the same strata as
+    calculate_strata would for each row.
+    :param data: DataFrame containing the references the strata is calculated for.
+    :param value_column: Column of the dataframe containing the Q608 total.
+    :param region_column: Column name of the dataframe containing the region code.
+    :param strata_column: Column of dataframe for the strata_column to be held.
+    :param survey_column: Column name of the dataframe containing the survey code.
+    :param strata_rules: Rules from compile_strata_rules, defaults to the BMI rules.
+    :return: data: Copy of the DataFrame including the strata.
+    """
+    values, regions, missing_value = get_strata_inputs(data[value_column],
+                                                       data[region_column])
+    survey_codes, surveys = pd.factorize(data[survey_column])
+
+    data = data.copy()
+    data[strata_column] = classify_strata_arrays(values, regions, missing_value,
+                                                 survey_codes, surveys, strata_rules)
+
+    return data
+
+
+def get_strata_inputs(values, regions):
+    """
+    Converts the value and region columns into float arrays for classify_strata_arrays.
+    :param values: Series of Q608 totals.
+    :param regions: Series of region codes.
+    :return: values, regions, missing_value: Float arrays of the values and regions and
+             a bool array of which values were None.
+    """
+    # A value of None leaves the strata blank. Only object columns can hold None,
+    # numeric columns store missing values as NaN which fail every comparison instead.
+    if values.dtype == object:
+        missing_value = np.equal(values.to_numpy(), None)
+        values = pd.to_numeric(values.where(~missing_value))
+    else:
+        missing_value = np.zeros(len(values), dtype=bool)
+    if regions.dtype == object:
+        regions = pd.to_numeric(regions.where(~np.equal(regions.to_numpy(), None)))
+
+    return values.to_numpy(dtype=float), regions.to_numpy(dtype=float), missing_value
+
+
+def classify_strata_arrays(values, regions, missing_value, survey_codes, surveys,
+                           strata_rules=None):
+    """
+    Calculates the strata from arrays of the inputs, see classify_strata.
+    :param values: Float array of Q608 totals.
+    :param regions: Float array of region codes.
+    :param missing_value: Bool array of which values were None.
+    :param survey_codes: Int array of positions in surveys, -1 for no survey.
+    :param surveys: Sequence of the survey codes.
+    :param strata_rules: Rules from compile_strata_rules, defaults to the BMI rules.
+    :return: strata: Object array of the strata.
+    """
+    if strata_rules is None:
+        strata_rules = load_strata_rules()
+
+    strata = np.full(len(values), "", dtype=object)
+
+    for survey_code, survey in enumerate(surveys):
+        if survey not in strata_rules:
+            continue
+        rule = strata_rules[survey]
+        rows = np.flatnonzero((survey_codes == survey_code) & ~missing_value)
+        row_values = values[rows]
+
+        bands = np.searchsorted(rule["thresholds"], row_values, side="left")
+        row_strata = rule["strata"][bands]
+
+        for band, (breakpoints, split_strata) in rule["region_splits"].items():
+            in_band = bands == band
+            row_regions = regions[rows[in_band]]
+            has_region = ~np.isnan(row_regions)
+            fallback = rule["strata"][band - 1] if band > 0 else ""
+            band_strata = np.full(len(row_regions), fallback, dtype=object)
+            band_strata[has_region] = split_strata[np.searchsorted(
+                breakpoints, row_regions[has_region], side="right")]
+            row_strata[in_band] = band_strata
+
+        # A missing value can only be placed when the survey has a single band.
+        if len(rule["thresholds"]) > 0:
+            row_strata[np.isnan(row_values)] = ""
+        strata[rows] = row_strata
+
+    return strata
+
+
+def compile_strata_rules(rules):
+    """
+    Turns strata rules, in the same layout as DEFAULT_STRATA_RULES, into sorted
+    breakpoint arrays so references can be classified with a binary search.
+    :param rules: Dict of survey code to thresholds, strata and region_splits.
+    :return: compiled_rules: Dict of survey code to the compiled arrays.
+    """
+    compiled_rules = {}
+    for survey, rule in rules.items():
+        thresholds = np.array(rule.get("thresholds", []), dtype=float)
+        strata = np.array(rule["strata"], dtype=object)
+        if np.any(np.diff(thresholds) <= 0):
+            raise ValueError(f"Strata thresholds for survey {survey} must be in "
+                             f"ascending order.")
+        if len(strata) != len(thresholds) + 1:
+            raise ValueError(f"Survey {survey} needs one more strata than thresholds.")
+
+        region_splits = {}
+        for split_strata, split in rule.get("region_splits", {}).items():
+            if split_strata not in rule["strata"]:
+                raise ValueError(f"Region split {split_strata} for survey {survey} "
+                                 f"is not one of its strata.")
+            breakpoints = np.array(split["breakpoints"], dtype=float)
+            if np.any(np.diff(breakpoints) <= 0):
+                raise ValueError(f"Region breakpoints for {split_strata} in survey "
+                                 f"{survey} must be in ascending order.")
+            if len(split["strata"]) != len(breakpoints) + 1:
+                raise ValueError(f"Region split {split_strata} for survey {survey} "
+                                 f"needs one more strata than breakpoints.")
+            band = rule["strata"].index(split_strata)
+            region_splits[band] = (breakpoints, np.array(split["strata"], dtype=object))
+
+        compiled_rules[str(survey)] = {
+            "thresholds": thresholds,
+            "strata": strata,
+            "region_splits": region_splits
+        }
+
+    return compiled_rules
+
+
+def load_strata_rules(strata_rules=None, strata_rules_file=None):
+    """
+    Gets the compiled strata rules from a JSON string or a JSON file, falling back to
+    the default BMI rules. Rules are only compiled the first time they are seen by
+    the container.
+    :param strata_rules: JSON string of strata rules.
+    :param strata_rules_file: Path to a JSON file of strata rules.
+    :return: compiled_rules: Dict of survey code to the compiled arrays.
+    """
+    cache_key = (strata_rules, strata_rules_file)
+    if cache_key not in compiled_rules_cache:
+        if strata_rules is not None:
+            rules = json.loads(strata_rules)
+        elif strata_rules_file is not None:
+            with open(strata_rules_file, "r") as file:
+                rules = json.load(file)
+        else:
+            rules = DEFAULT_STRATA_RULES
+        compiled_rules_cache[cache_key] = compile_strata_rules(rules)
+
+    return compiled_rules_cache[cache_key]
+
+
 def strata_mismatch_detector(data, current_period, time, reference, segmentation,
                              stored_segmentation, current_time, previous_time,
                              current_segmentation, previous_segmentation):
@@ -206,33 +1246,171 @@ def strata_mismatch_detector(data, current_period, time, reference, segmentation
                                                     keep=False)
 
     if data_anomalies.size > 0:
-        # Filter to only include data from the current period
-        fix_data = data_anomalies[data_anomalies[time] == int(current_period)][
-            [reference, segmentation]]
-        fix_data = fix_data.rename(columns={segmentation: stored_segmentation})
-
-        # Now merge these so that the fix_data strata is
-        # added as an extra column to the input data
-        data = pd.merge(data, fix_data, on=reference, how="left")
+        in_current_period = data_anomalies[time] == int(current_period)
 
-        # We should now have a good Strata column in the dataframe - mostly containing
-        # null values, containing strata where there was anomaly using an apply method,
-        # set strata to be the good strata.
-        data[segmentation] = data.apply(
-            lambda x: x[stored_segmentation]
-            if str(x[stored_segmentation]) != "nan" else x[segmentation], axis=1)
-        data = data.drop(stored_segmentation, axis=1)
+        # Strata from the current period for each reference whose strata has changed.
+        fix_data = data_anomalies[in_current_period].set_index(reference)[segmentation]
+        data = apply_strata_fixes(data, fix_data, reference, segmentation,
+                                  stored_segmentation)
 
         # Split on period then merge together so they're same row.
-        current_period_anomalies = data_anomalies[
-            data_anomalies[time] == int(current_period)].rename(
+        current_period_anomalies = data_anomalies[in_current_period].rename(
             columns={segmentation: current_segmentation, time: current_time})
 
-        prev_period_anomalies = data_anomalies[data_anomalies[time]
-                                               != int(current_period)].rename(
+        prev_period_anomalies = data_anomalies[~in_current_period].rename(
             columns={segmentation: previous_segmentation, time: previous_time})
 
         data_anomalies = pd.merge(current_period_anomalies, prev_period_anomalies,
                                   on=reference)
 
     return data, data_anomalies
+
+
+def strata_lookup_detector(data, current_period, time, reference, segmentation,
+                           strata_lookup, current_time, previous_time,
+                           current_segmentation, previous_segmentation):
+    """
+    Finds the references whose strata in the current period differs from their strata
+    in the lookup's period, with a binary search of the lookup's sorted references.
+    For data holding the current period and the lookup's period this gives the same
+    anomalies as strata_mismatch_detector, without the lookup's period being in the
+    data, as long as a reference has one row per period and the lookup's period has
+    not changed since it was saved.
+    :param data: The DataFrame with the strata calculated.
+    :param current_period: The current period of the run.
+    :param time: Field name which is used as a gauge of time'. Added for CAC.
+    :param reference: Field name which is used as a reference for CAC.
+    :param segmentation: Field name of the segmentation used for CAC.
+    :param strata_lookup: Dict from load_strata_lookup.
+    :param current_time: Field name of the current time used for CAC.
+    :param previous_time: Field name of the previous time used for CAC.
+    :param current_segmentation: Field name of the current segmentation used for CAC.
+    :param previous_segmentation: Field name of the current segmentation used for CAC.
+    :return: DataFrame of the anomalies, as strata_mismatch_detector gives them.
+    """
+    current_data = data[data[time] == int(current_period)]
+    references = strata_lookup_keys(current_data[reference])
+    lookup_references = strata_lookup["references"]
+
+    positions = np.searchsorted(lookup_references, references)
+    if len(lookup_references) > 0:
+        positions = np.minimum(positions, len(lookup_references) - 1)
+        found = (lookup_references[positions] == references) & \
+            (strata_lookup["periods"][positions] == strata_lookup["period"])
+    else:
+        positions = np.zeros(len(references), dtype=np.int64)
+        found = np.zeros(len(references), dtype=bool)
+
+    previous_strata = strata_lookup["strata_names"][
+        strata_lookup["strata_codes"][positions]].astype(object) \
+        if len(lookup_references) > 0 else np.full(len(references), None, dtype=object)
+    changed = found & (current_data[segmentation].to_numpy() != previous_strata)
+
+    return pd.DataFrame({
+        reference: current_data[reference].to_numpy()[changed],
+        current_segmentation: current_data[segmentation].to_numpy()[changed],
+        current_time: current_data[time].to_numpy()[changed],
+        previous_segmentation: previous_strata[changed],
+        previous_time: strata_lookup["periods"][positions[changed]].astype(
+            current_data[time].dtype)
+    })
+
+
+def strata_lookup_keys(references):
+    """
+    Converts references to the dtype they are kept as in a strata lookup.
+    :param references: Series of references.
+    :return: Array of integer references, or of strings for any other references.
+    """
+    references = references.to_numpy()
+    if references.dtype.kind in "iu":
+        return references.astype(np.int64)
+    return references.astype(str)
+
+
+def load_strata_lookup(bucket_name, lookup_key):
+    """
+    Reads a strata lookup saved by save_strata_lookup. It is kept for the life of the
+    container, and read again only when its ETag changes.
+    :param bucket_name: Name of the s3 bucket holding the lookup.
+    :param lookup_key: Key of the lookup.
+    :return: Dict of the lookup's arrays: references, sorted, strata_codes indexing
+             strata_names and periods, the period of each reference's strata, along with
+             period, the latest period saved to it. None if there is no lookup.
+    """
+    s3 = strata_common.get_boto3_client("s3")
+    try:
+        etag = s3.head_object(Bucket=bucket_name, Key=lookup_key)["ETag"]
+    except s3.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            return None
+        raise
+
+    cache_key = (bucket_name, lookup_key)
+    if cache_key not in strata_lookup_cache or \
+            strata_lookup_cache[cache_key][0] != etag:
+        body = s3.get_object(Bucket=bucket_name, Key=lookup_key, IfMatch=etag)["Body"]
+        with np.load(io.BytesIO(body.read()), allow_pickle=False) as lookup_file:
+            strata_lookup = {name: lookup_file[name] for name in lookup_file.files}
+        strata_lookup["period"] = int(strata_lookup["period"])
+        strata_lookup_cache[cache_key] = (etag, strata_lookup)
+
+    return strata_lookup_cache[cache_key][1]
+
+
+def update_strata_lookup(strata_lookup, references, strata, period):
+    """
+    Adds a period's strata to a lookup, replacing the strata held for its references.
+    :param strata_lookup: Dict from load_strata_lookup, or None to start a new lookup.
+    :param references: Series of the period's references.
+    :param strata: Series of the period's strata, references with none are left out.
+    :param period: The period.
+    :return: Dict of the updated lookup.
+    """
+    has_strata = strata.notna().to_numpy()
+    new_references = strata_lookup_keys(references)[has_strata]
+    new_strata = strata.to_numpy()[has_strata].astype(str)
+    # The last row of a reference wins.
+    new_references, last_rows = np.unique(new_references[::-1], return_index=True)
+    new_strata = new_strata[::-1][last_rows]
+
+    if strata_lookup is not None and len(strata_lookup["references"]) > 0:
+        kept = ~np.isin(strata_lookup["references"], new_references)
+        all_references = np.concatenate([strata_lookup["references"][kept],
+                                         new_references])
+        all_strata = np.concatenate([
+            strata_lookup["strata_names"][strata_lookup["strata_codes"][kept]],
+            new_strata])
+        all_periods = np.concatenate([strata_lookup["periods"][kept],
+                                      np.full(len(new_references), period)])
+    else:
+        all_references = new_references
+        all_strata = new_strata
+        all_periods = np.full(len(new_references), period)
+
+    order = np.argsort(all_references, kind="mergesort")
+    strata_names, strata_codes = np.unique(all_strata[order], return_inverse=True)
+    return {
+        "references": all_references[order],
+        "strata_codes": downcast_integers(strata_codes),
+        "strata_names": strata_names,
+        "periods": downcast_integers(all_periods[order].astype(np.int64)),
+        "period": int(period)
+    }
+
+
+def save_strata_lookup(bucket_name, lookup_key, strata_lookup):
+    """
+    Saves a strata lookup as an uncompressed npz file, arrays that np.load reads
+    without unpickling anything.
+    :param bucket_name: Name of the s3 bucket to save the lookup to.
+    :param lookup_key: Key to save the lookup as.
+    :param strata_lookup: Dict from update_strata_lookup.
+    :return:
+    """
+    lookup_file = io.BytesIO()
+    np.savez(lookup_file, **strata_lookup)
+    response = strata_common.get_boto3_client("s3").put_object(
+        Bucket=bucket_name, Key=lookup_key, Body=lookup_file.getvalue())
+    # This container already has the lookup, so needn't read it back.
+    strata_lookup_cache[(bucket_name, lookup_key)] = (response["ETag"], strata_lookup)
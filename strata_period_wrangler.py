@@ -1,10 +1,25 @@
+import hashlib
 import json
 import logging
 import os
+import time
 
 import boto3
+import numpy as np
+import pandas as pd
+from botocore.config import Config
 from es_aws_functions import aws_functions, exception_classes, general_functions
-from marshmallow import EXCLUDE, Schema, fields
+from marshmallow import (EXCLUDE, Schema, ValidationError, fields, validate,
+                         validates_schema)
+
+import strata_common
+import strata_metrics
+
+# Thread pool for overlapping s3 and notification calls, kept between invocations.
+io_executor = None
+
+# A batch can run for as long as a Lambda can, well past the default timeout.
+BATCH_LAMBDA_CONFIG = Config(read_timeout=900, retries={"max_attempts": 0})
 
 
 class EnvironmentSchema(Schema):
@@ -15,11 +30,96 @@ class EnvironmentSchema(Schema):
         logging.error(f"Error validating environment params: {e}")
         raise ValueError(f"Error validating environment params: {e}")
 
+    anomaly_store = fields.Bool(missing=False)
+    anomaly_store_prefix = fields.Str(missing="strata_anomalies/")
+    batch_method_name = fields.Str(missing=None)
+    batch_size = fields.Int(missing=None)
     bucket_name = fields.Str(required=True)
+    checkpoint = fields.Bool(missing=False)
+    checkpoint_prefix = fields.Str(missing="strata_checkpoints/")
+    compact_dtypes = fields.Bool(missing=False)
+    concurrent_io = fields.Bool(missing=False)
+    data_encoding = fields.Str(
+        missing="json-records",
+        validate=validate.OneOf(strata_common.DATA_ENCODINGS))
+    emit_metrics = fields.Bool(missing=False)
+    gzip_output = fields.Bool(missing=False)
+    incremental = fields.Bool(missing=False)
+    method_invocation = fields.Str(missing="lambda",
+                                   validate=validate.OneOf(["lambda", "local"]))
+    method_batch_size = fields.Int(missing=10, validate=validate.Range(min=1))
     method_name = fields.Str(required=True)
+    # s3 needs every part of a multipart upload but the last to be at least 5MB.
+    output_part_size = fields.Int(missing=8388608,
+                                  validate=validate.Range(min=5242880))
+    pass_data_by_reference = fields.Bool(missing=False)
     period_column = fields.Str(required=True)
+    projected = fields.Bool(missing=False)
     reference = fields.Str(required=True)
+    response_compression = fields.Str(
+        missing=None, validate=validate.OneOf(strata_common.RESPONSE_COMPRESSIONS))
+    response_spill_bytes = fields.Int(missing=None, validate=validate.Range(min=0))
+    response_spill_prefix = fields.Str(missing="strata_spill/")
+    result_cache = fields.Bool(missing=False)
+    result_cache_prefix = fields.Str(missing="strata_cache/")
+    # Seconds a cached result is used for, a week by default.
+    result_cache_ttl = fields.Int(missing=604800, validate=validate.Range(min=0))
     segmentation = fields.Str(required=True)
+    shard_count = fields.Int(missing=1, validate=validate.Range(min=1))
+    strata_index_prefix = fields.Str(missing="strata_index/")
+    strata_lookup = fields.Bool(missing=False)
+    strata_lookup_prefix = fields.Str(missing="strata_lookup/")
+    # Method configuration, only used when the method is run locally.
+    strata_column = fields.Str(missing=None)
+    strata_rules = fields.Str(missing=None)
+    strata_rules_file = fields.Str(
+        missing=None, validate=validate.Regexp(r".*\.json$",
+                                               error="Must be a .json file."))
+    stream_output = fields.Bool(missing=False)
+    value_column = fields.Str(missing=None)
+
+    @validates_schema
+    def validate_local_method(self, data, **kwargs):
+        if data.get("method_invocation") == "local" and not (
+                data.get("strata_column") and data.get("value_column")):
+            raise ValidationError("strata_column and value_column must be provided "
+                                  "to run the method locally.")
+
+    @validates_schema
+    def validate_incremental(self, data, **kwargs):
+        if data.get("incremental") and (data.get("method_invocation") == "local" or
+                                        data.get("pass_data_by_reference")):
+            raise ValidationError("incremental can only be used when the method "
+                                  "Lambda is invoked with the data.")
+
+    @validates_schema
+    def validate_projected(self, data, **kwargs):
+        if not data.get("projected"):
+            return
+        if (data.get("method_invocation") == "local" or
+                data.get("pass_data_by_reference") or data.get("incremental") or
+                data.get("shard_count", 1) > 1):
+            raise ValidationError("projected can only be used when the method Lambda "
+                                  "is invoked once with the data.")
+        if not data.get("value_column"):
+            raise ValidationError("value_column must be provided to project the data.")
+
+    @validates_schema
+    def validate_strata_lookup(self, data, **kwargs):
+        if data.get("strata_lookup") and (
+                data.get("method_invocation") == "local" or
+                data.get("pass_data_by_reference") or data.get("incremental") or
+                data.get("projected") or data.get("shard_count", 1) > 1):
+            raise ValidationError("strata_lookup can only be used when the method "
+                                  "Lambda is invoked once with the data.")
+
+    @validates_schema
+    def validate_stream_output(self, data, **kwargs):
+        if ((data.get("stream_output") or data.get("gzip_output")) and
+                data.get("pass_data_by_reference") and
+                data.get("method_invocation") != "local"):
+            raise ValidationError("stream_output and gzip_output can't be used when "
+                                  "the method saves the output itself.")
 
 
 class RuntimeSchema(Schema):
@@ -30,7 +130,9 @@ class RuntimeSchema(Schema):
         logging.error(f"Error validating runtime params: {e}")
         raise ValueError(f"Error validating runtime params: {e}")
 
+    anomalies_file_name = fields.Str(missing="Strata_Anomalies")
     bpm_queue_url = fields.Str(required=True)
+    bypass_cache = fields.Bool(missing=False)
     distinct_values = fields.List(fields.String, required=True)
     environment = fields.Str(Required=True)
     in_file_name = fields.Str(required=True)
@@ -42,12 +144,48 @@ class RuntimeSchema(Schema):
     total_steps = fields.Int(required=True)
 
 
+class BatchSchema(Schema):
+    class Meta:
+        unknown = EXCLUDE
+
+    def handle_error(self, e, data, **kwargs):
+        logging.error(f"Error validating batch params: {e}")
+        raise ValueError(f"Error validating batch params: {e}")
+
+    runs = fields.List(fields.Dict(), required=True, validate=validate.Length(min=1))
+
+
 def lambda_handler(event, context):
     """
     prepares the data for the Strata method.
     - Read in data from the SQS queue.
     - Invoke the Strata Method.
     - Send data from the Strata method to the SQS queue.
+    When pass_data_by_reference is set only the s3 file names are sent to the method,
+    which reads the data and saves its output itself.
+    When method_invocation is local the method's calculation is run in this function
+    instead of invoking the method Lambda, giving the same result.
+    A shard_count above 1 splits the data by reference and invokes the method for each
+    shard at the same time.
+    When incremental is set only the periods missing from the strata index in s3 are
+    sent to the method, and the index is updated with the periods it classified.
+    When projected is set only the columns the method uses are sent to it, and the
+    strata it returns are added back to the rest of the data here.
+    When strata_lookup is set the method checks the current period against a lookup
+    of each reference's last strata in s3, so the previous period isn't sent to it.
+    When concurrent_io is set, s3 writes and notifications that do not depend on each
+    other are made at the same time.
+    When result_cache is set the output and anomalies of a run are kept in s3 against
+    a hash of the input file and the parameters, and a rerun with the same input and
+    parameters copies them instead of invoking the method. bypass_cache reruns the
+    method anyway, replacing the cached result.
+    When anomaly_store is set the anomalies are also saved as parquet under a key for
+    the survey, period and run, with an index of the counts of each strata transition.
+    When checkpoint is set the stages each attempt at a run completes are recorded in
+    s3 against the run_id, and a retry of the run carries on from the first stage not
+    completed.
+    Each stage is run by its own function, which shares the state of the run with the
+    others in a dict.
 
     :param event:
     :param context:
@@ -61,36 +199,41 @@ def lambda_handler(event, context):
 
     # Define run_id outside of try block
     run_id = 0
+    bpm_started = None
     try:
         # Retrieve run_id before input validation
         # Because it is used in exception handling
         run_id = event["RuntimeVariables"]["run_id"]
         # Set up clients
-        var_lambda = boto3.client("lambda", region_name="eu-west-2")
+        var_lambda = strata_common.get_boto3_client("lambda", boto3.client)
 
-        environment_variables = EnvironmentSchema().load(os.environ)
+        environment_variables = strata_common.load_environment(
+            EnvironmentSchema, os.environ)
 
-        runtime_variables = RuntimeSchema().load(event["RuntimeVariables"])
+        runtime_variables = strata_common.load_runtime(
+            RuntimeSchema, event["RuntimeVariables"])
 
         # Environment Variables
-        bucket_name = environment_variables["bucket_name"]
-        method_name = environment_variables["method_name"]
-        period_column = environment_variables["period_column"]
-        segmentation = environment_variables["segmentation"]
-        reference = environment_variables["reference"]
+        concurrent_io = environment_variables["concurrent_io"]
+        emit_metrics = environment_variables["emit_metrics"]
 
         # Runtime Variables
         bpm_queue_url = runtime_variables["bpm_queue_url"]
-        current_period = runtime_variables["period"]
         environment = runtime_variables['environment']
-        in_file_name = runtime_variables["in_file_name"]
-        out_file_name = runtime_variables["out_file_name"]
-        region_column = runtime_variables["distinct_values"][0]
-        sns_topic_arn = runtime_variables["sns_topic_arn"]
         survey = runtime_variables["survey"]
-        survey_column = runtime_variables["survey_column"]
         total_steps = runtime_variables["total_steps"]
 
+        run = {
+            "run_id": run_id,
+            # A locally run method is always given the data directly.
+            "pass_data_by_reference": (
+                environment_variables["pass_data_by_reference"] and
+                environment_variables["method_invocation"] == "lambda"),
+            "region_column": runtime_variables["distinct_values"][0],
+            "stream_output": (environment_variables["stream_output"] or
+                              environment_variables["gzip_output"])
+        }
+
     except Exception as e:
         error_message = general_functions.handle_exception(e, current_module, run_id,
                                                            context=context)
@@ -108,60 +251,42 @@ def lambda_handler(event, context):
     try:
 
         logger.info("Started - retrieved configuration variables.")
+        metrics = strata_metrics.StageMetrics(current_module, run_id, emit_metrics)
 
         # Send start of module status to BPM.
         status = "IN PROGRESS"
-        aws_functions.send_bpm_status(bpm_queue_url, current_module, status, run_id,
-                                      current_step_num, total_steps)
-
-        data_df = aws_functions.read_dataframe_from_s3(bucket_name, in_file_name)
-        logger.info("Successfully retrieved data from s3")
-
-        data_json = data_df.to_json(orient="records")
-        json_payload = {
-            "RuntimeVariables": {
-                "bpm_queue_url": bpm_queue_url,
-                "current_period": current_period,
-                "data": data_json,
-                "environment": environment,
-                "period_column": period_column,
-                "reference": reference,
-                "region_column": region_column,
-                "run_id": run_id,
-                "segmentation": segmentation,
-                "survey": survey,
-                "survey_column": survey_column
-            }
-        }
-        returned_data = var_lambda.invoke(FunctionName=method_name,
-                                          Payload=json.dumps(json_payload))
-        logger.info("Successfully invoked method.")
-
-        json_response = json.loads(returned_data.get("Payload").read().decode("UTF-8"))
-        logger.info("JSON extracted from method response.")
-
-        if not json_response["success"]:
-            raise exception_classes.MethodFailure(json_response["error"])
-
-        # Push current period data onwards
-        aws_functions.save_to_s3(bucket_name, out_file_name, json_response["data"])
-        logger.info("Successfully sent data to s3")
-
-        anomalies = json_response["anomalies"]
-
-        if anomalies != "[]":
-            aws_functions.save_to_s3(bucket_name, "Strata_Anomalies", anomalies)
-            have_anomalies = True
+        if concurrent_io:
+            # Only needs to have been sent before the module is finished.
+            bpm_started = get_io_executor().submit(
+                aws_functions.send_bpm_status, bpm_queue_url, current_module, status,
+                run_id, current_step_num, total_steps)
         else:
-            have_anomalies = False
-        logger.info("Successfully sent anomalies to s3")
+            aws_functions.send_bpm_status(bpm_queue_url, current_module, status,
+                                          run_id, current_step_num, total_steps)
 
-        aws_functions.send_sns_message_with_anomalies(have_anomalies, sns_topic_arn,
-                                                      "Strata.")
-
-        logger.info("Successfully sent message to sns")
+        resolve_checkpoint(run, environment_variables, runtime_variables, metrics,
+                           logger)
+        lookup_result_cache(run, environment_variables, runtime_variables, metrics,
+                            logger)
+        if "have_anomalies" not in run:
+            json_response = run_method(run, var_lambda, environment_variables,
+                                       runtime_variables, metrics, logger)
+            save_output(run, json_response, environment_variables, runtime_variables,
+                        metrics, logger)
+        copy_checkpoint_output(run, environment_variables, runtime_variables, metrics,
+                               logger)
+        store_run_anomalies(run, environment_variables, runtime_variables, metrics,
+                            logger)
+        notify_run(run, bpm_started, environment_variables, runtime_variables,
+                   metrics, logger)
+        finish_checkpoint(run, environment_variables)
+        save_strata_state(run, environment_variables, runtime_variables, metrics,
+                          logger)
 
     except Exception as e:
+        # Let the start status reach BPM before the error status does.
+        if bpm_started is not None:
+            bpm_started.exception()
         error_message = general_functions.handle_exception(e,
                                                            current_module,
                                                            run_id,
@@ -179,3 +304,1281 @@ def lambda_handler(event, context):
     aws_functions.send_bpm_status(bpm_queue_url, current_module, status, run_id,
                                   current_step_num, total_steps)
     return {"success": True}
+
+
+def resolve_checkpoint(run, environment_variables, runtime_variables, metrics, logger):
+    """
+    Sets the keys the run saves its output and anomalies to. With checkpoint set they
+    are kept with the checkpoint, and the stages an earlier attempt at the run
+    completed are read, taking whether it had anomalies from a completed invoke.
+    :param run: Dict of the state of the run, updated with the keys, the completed
+                stages and any have_anomalies.
+    :param environment_variables: Dict of the validated environment variables.
+    :param runtime_variables: Dict of the validated runtime variables.
+    :param metrics: StageMetrics to time the stages.
+    :param logger: Logger for the run.
+    :return:
+    """
+    run.update(completed={}, checkpoint_key=None,
+               output_key=runtime_variables["out_file_name"],
+               anomalies_key=runtime_variables["anomalies_file_name"])
+    if not environment_variables["checkpoint"]:
+        return
+
+    # The method's output is saved with the checkpoint first, so it survives until it
+    # has been copied into place.
+    checkpoint_key = f"{environment_variables['checkpoint_prefix']}{run['run_id']}"
+    run.update(checkpoint_key=checkpoint_key,
+               output_key=f"{checkpoint_key}/output.json",
+               anomalies_key=f"{checkpoint_key}/anomalies.json")
+    with metrics.stage("checkpoint_read"):
+        run["completed"] = read_checkpoint(environment_variables["bucket_name"],
+                                           checkpoint_key)
+    if run["completed"]:
+        logger.info("Resuming run after the completed stages: " +
+                    ", ".join(run["completed"]))
+    if "invoke" in run["completed"]:
+        run["have_anomalies"] = run["completed"]["invoke"]["have_anomalies"]
+
+
+def lookup_result_cache(run, environment_variables, runtime_variables, metrics,
+                        logger):
+    """
+    With result_cache set works out the run's cache key and, unless bypass_cache is
+    set or the method has already been run, restores any result stored under it.
+    :param run: Dict of the state of the run, updated with the cache_key, the
+                cached_result and, once restored, have_anomalies.
+    :param environment_variables: Dict of the validated environment variables.
+    :param runtime_variables: Dict of the validated runtime variables.
+    :param metrics: StageMetrics to time the stages.
+    :param logger: Logger for the run.
+    :return:
+    """
+    run.update(cache_key=None, cached_result=None)
+    if not environment_variables["result_cache"]:
+        return
+
+    bucket_name = environment_variables["bucket_name"]
+    result_cache_prefix = environment_variables["result_cache_prefix"]
+    with metrics.stage("cache_lookup"):
+        # The cached output is copied as saved, so its encoding is part of the key as
+        # well as what it holds.
+        run["cache_key"] = get_cache_key(bucket_name, runtime_variables["in_file_name"], {
+            "current_period": runtime_variables["period"],
+            "gzip_output": environment_variables["gzip_output"],
+            "method_name": environment_variables["method_name"],
+            "period_column": environment_variables["period_column"],
+            "reference": environment_variables["reference"],
+            "region_column": run["region_column"],
+            "segmentation": environment_variables["segmentation"],
+            "strata_column": environment_variables["strata_column"],
+            "strata_rules": environment_variables["strata_rules"],
+            "strata_rules_file": environment_variables["strata_rules_file"],
+            "stream_output": run["stream_output"],
+            "survey": runtime_variables["survey"],
+            "survey_column": runtime_variables["survey_column"],
+            "value_column": environment_variables["value_column"]
+        })
+        if not runtime_variables["bypass_cache"] and "invoke" not in run["completed"]:
+            run["cached_result"] = read_cached_result(
+                bucket_name, result_cache_prefix, run["cache_key"],
+                environment_variables["result_cache_ttl"])
+
+    if run["cached_result"] is None:
+        return
+
+    with metrics.stage("cache_restore"):
+        restore_cached_result(bucket_name, result_cache_prefix, run["cache_key"],
+                              run["cached_result"], runtime_variables["out_file_name"],
+                              runtime_variables["anomalies_file_name"])
+    run["have_anomalies"] = run["cached_result"]["have_anomalies"]
+    logger.info("Successfully restored output from the result cache.")
+    if environment_variables["checkpoint"]:
+        record_checkpoint(bucket_name, run["checkpoint_key"], run["completed"],
+                          ["invoke", "output", "anomalies"],
+                          have_anomalies=run["have_anomalies"])
+
+
+def run_method(run, var_lambda, environment_variables, runtime_variables, metrics,
+               logger):
+    """
+    Runs the method, locally or by invoking the method Lambda in the mode the
+    environment variables set.
+    :param run: Dict of the state of the run.
+    :param var_lambda: boto3 Lambda client.
+    :param environment_variables: Dict of the validated environment variables.
+    :param runtime_variables: Dict of the validated runtime variables.
+    :param metrics: StageMetrics to time the stages.
+    :param logger: Logger for the run.
+    :return: json_response: Dict returned by the method.
+    """
+    bucket_name = environment_variables["bucket_name"]
+    current_period = runtime_variables["period"]
+    data_encoding = environment_variables["data_encoding"]
+    in_file_name = runtime_variables["in_file_name"]
+    method_name = environment_variables["method_name"]
+    period_column = environment_variables["period_column"]
+    reference = environment_variables["reference"]
+    region_column = run["region_column"]
+    segmentation = environment_variables["segmentation"]
+    survey = runtime_variables["survey"]
+    survey_column = runtime_variables["survey_column"]
+
+    if environment_variables["method_invocation"] == "local":
+        # The method module is only imported by the modes that use it, to keep it out
+        # of the wrangler's start up.
+        import strata_period_method
+
+        with metrics.stage("s3_read") as stage:
+            data_df = aws_functions.read_dataframe_from_s3(bucket_name, in_file_name)
+            stage["rows"] = len(data_df)
+        logger.info("Successfully retrieved data from s3")
+
+        strata_data, anomalies_df = strata_period_method.run_strata(
+            data_df,
+            current_period,
+            environment_variables["strata_column"],
+            environment_variables["value_column"],
+            period_column,
+            reference,
+            region_column,
+            segmentation,
+            survey_column,
+            strata_period_method.load_strata_rules(
+                environment_variables["strata_rules"],
+                environment_variables["strata_rules_file"]),
+            metrics,
+            environment_variables["compact_dtypes"])
+        logger.info("Successfully ran method locally.")
+
+        # The data is encoded when it is saved.
+        return {
+            "success": True,
+            "data": strata_data,
+            "anomalies": anomalies_df.to_json(orient="records")
+        }
+
+    json_payload = {
+        "RuntimeVariables": {
+            "bpm_queue_url": runtime_variables["bpm_queue_url"],
+            "current_period": current_period,
+            "data_encoding": data_encoding,
+            "environment": runtime_variables["environment"],
+            "period_column": period_column,
+            "reference": reference,
+            "region_column": region_column,
+            "run_id": run["run_id"],
+            "segmentation": segmentation,
+            "survey": survey,
+            "survey_column": survey_column
+        }
+    }
+
+    # Let the method compress or spill to s3 data too big to return inline.
+    if environment_variables["response_compression"] is not None:
+        json_payload["RuntimeVariables"]["response_compression"] = \
+            environment_variables["response_compression"]
+    if environment_variables["response_spill_bytes"] is not None:
+        json_payload["RuntimeVariables"].update({
+            "bucket_name": bucket_name,
+            "response_spill_bytes": environment_variables["response_spill_bytes"],
+            "response_spill_prefix": environment_variables["response_spill_prefix"]
+        })
+
+    if run["pass_data_by_reference"]:
+        json_payload["RuntimeVariables"].update({
+            "anomalies_file_name": runtime_variables["anomalies_file_name"],
+            "batch_size": environment_variables["batch_size"],
+            "bucket_name": bucket_name,
+            "in_file_name": in_file_name,
+            "out_file_name": runtime_variables["out_file_name"],
+            "output_part_size": environment_variables["output_part_size"]
+        })
+
+        json_response = invoke_method(var_lambda, method_name, json_payload, metrics)
+        logger.info("Successfully invoked method.")
+        return json_response
+
+    with metrics.stage("s3_read") as stage:
+        data_df = aws_functions.read_dataframe_from_s3(bucket_name, in_file_name)
+        stage["rows"] = len(data_df)
+    logger.info("Successfully retrieved data from s3")
+
+    shard_count = environment_variables["shard_count"]
+    if environment_variables["incremental"]:
+        json_response = invoke_method_incremental(
+            var_lambda, method_name, json_payload, data_df, data_encoding, bucket_name,
+            f"{environment_variables['strata_index_prefix']}{survey}/", reference,
+            segmentation, period_column, current_period, metrics)
+        logger.info("Successfully invoked method for the periods not in the strata "
+                    "index.")
+    elif shard_count > 1:
+        with metrics.stage("invoke_shards", rows=len(data_df)):
+            json_response = invoke_method_shards(
+                var_lambda, method_name, json_payload, data_df, shard_count,
+                data_encoding, reference, period_column, current_period)
+        logger.info(f"Successfully invoked method for {shard_count} shards.")
+    elif environment_variables["strata_lookup"]:
+        json_response = invoke_method_lookup(
+            var_lambda, method_name, json_payload, data_df, data_encoding, bucket_name,
+            f"{environment_variables['strata_lookup_prefix']}{survey}.npz", reference,
+            segmentation, period_column, current_period, metrics)
+        logger.info("Successfully invoked method with the strata lookup.")
+    elif environment_variables["projected"]:
+        json_response = invoke_method_projected(
+            var_lambda, method_name, json_payload, data_df, data_encoding,
+            [reference, period_column, environment_variables["value_column"],
+             region_column, survey_column, segmentation],
+            metrics)
+        logger.info("Successfully invoked method with the projected data.")
+    else:
+        with metrics.stage("encode", rows=len(data_df)):
+            json_payload["RuntimeVariables"]["data"] = \
+                strata_common.encode_dataframe(data_df, data_encoding)
+
+        json_response = invoke_method(var_lambda, method_name, json_payload, metrics)
+        logger.info("Successfully invoked method.")
+
+    return json_response
+
+
+def save_output(run, json_response, environment_variables, runtime_variables, metrics,
+                logger):
+    """
+    Checks the method succeeded and saves its output, with the anomalies if there are
+    any, unless the method saved them itself. The strata index or lookup it returned
+    is kept to be saved once the run has succeeded.
+    :param run: Dict of the state of the run, updated with have_anomalies, any
+                anomalies, strata_index and strata_lookup.
+    :param json_response: Dict returned by run_method.
+    :param environment_variables: Dict of the validated environment variables.
+    :param runtime_variables: Dict of the validated runtime variables.
+    :param metrics: StageMetrics to time the stages.
+    :param logger: Logger for the run.
+    :return:
+    """
+    if not json_response["success"]:
+        raise exception_classes.MethodFailure(json_response["error"])
+    run["strata_index"] = json_response.pop("strata_index", None)
+    run["strata_lookup"] = json_response.pop("strata_lookup", None)
+
+    bucket_name = environment_variables["bucket_name"]
+    if run["pass_data_by_reference"]:
+        # The method has already saved its output and any anomalies.
+        run["have_anomalies"] = json_response["anomaly_count"] > 0
+        if environment_variables["checkpoint"]:
+            record_checkpoint(bucket_name, run["checkpoint_key"], run["completed"],
+                              ["invoke", "output", "anomalies"],
+                              have_anomalies=run["have_anomalies"])
+        return
+
+    # Output data is saved as json records whichever encoding the method used.
+    # Data put together by the wrangler is already a DataFrame.
+    stream_output = run["stream_output"]
+    output_data = json_response["data"]
+    output_encoding = json_response.get("data_encoding", "json-records")
+    if not isinstance(output_data, pd.DataFrame) and output_encoding != "json-records":
+        with metrics.stage("decode_output"):
+            output_data = strata_common.decode_dataframe(output_data, output_encoding)
+    if isinstance(output_data, pd.DataFrame) and not stream_output:
+        with metrics.stage("encode_output", rows=len(output_data)):
+            output_data = output_data.to_json(orient="records")
+
+    anomalies = json_response["anomalies"]
+    run.update(anomalies=anomalies, have_anomalies=anomalies != "[]")
+
+    # Push current period data onwards, with the anomalies if there are any.
+    if stream_output:
+        writes = [(strata_common.save_records_to_s3,
+                   (bucket_name, run["output_key"], output_data,
+                    environment_variables["output_part_size"],
+                    environment_variables["gzip_output"]))]
+    else:
+        writes = [(aws_functions.save_to_s3,
+                   (bucket_name, run["output_key"], output_data))]
+    if run["have_anomalies"]:
+        writes.append((aws_functions.save_to_s3,
+                       (bucket_name, run["anomalies_key"], anomalies)))
+    with metrics.stage("s3_write") as stage:
+        saved = run_io(writes, environment_variables["concurrent_io"])
+        stage["payload_bytes"] = len(anomalies) + (
+            saved[0] if stream_output else len(output_data))
+    logger.info("Successfully sent data and anomalies to s3")
+    if environment_variables["checkpoint"]:
+        record_checkpoint(bucket_name, run["checkpoint_key"], run["completed"],
+                          ["invoke"], have_anomalies=run["have_anomalies"])
+
+
+def copy_checkpoint_output(run, environment_variables, runtime_variables, metrics,
+                           logger):
+    """
+    With checkpoint set copies the output and any anomalies saved with the checkpoint
+    into place, unless an earlier attempt at the run already has.
+    :param run: Dict of the state of the run.
+    :param environment_variables: Dict of the validated environment variables.
+    :param runtime_variables: Dict of the validated runtime variables.
+    :param metrics: StageMetrics to time the stages.
+    :param logger: Logger for the run.
+    :return:
+    """
+    if not environment_variables["checkpoint"] or "output" in run["completed"]:
+        return
+
+    bucket_name = environment_variables["bucket_name"]
+    copies = [(copy_s3_object,
+               (bucket_name, run["output_key"], runtime_variables["out_file_name"]))]
+    if run["have_anomalies"]:
+        copies.append((copy_s3_object,
+                       (bucket_name, run["anomalies_key"],
+                        runtime_variables["anomalies_file_name"])))
+    with metrics.stage("s3_copy_checkpoint"):
+        run_io(copies, environment_variables["concurrent_io"])
+    record_checkpoint(bucket_name, run["checkpoint_key"], run["completed"],
+                      ["output", "anomalies"])
+    logger.info("Successfully copied data and anomalies into place")
+
+
+def store_run_anomalies(run, environment_variables, runtime_variables, metrics,
+                        logger):
+    """
+    With anomaly_store set saves the anomalies to the anomaly store, unless an earlier
+    attempt at the run has already finished.
+    :param run: Dict of the state of the run, with have_anomalies updated to whether
+                any anomalies were stored.
+    :param environment_variables: Dict of the validated environment variables.
+    :param runtime_variables: Dict of the validated runtime variables.
+    :param metrics: StageMetrics to time the stages.
+    :param logger: Logger for the run.
+    :return:
+    """
+    if not environment_variables["anomaly_store"] or "notify" in run["completed"]:
+        return
+
+    bucket_name = environment_variables["bucket_name"]
+    with metrics.stage("anomaly_store") as stage:
+        anomalies = run.get("anomalies")
+        if anomalies is None:
+            # The anomalies were saved by the method or copied from the cache.
+            anomalies = read_saved_anomalies(bucket_name,
+                                             runtime_variables["anomalies_file_name"],
+                                             run["have_anomalies"])
+        anomaly_index = store_anomalies(
+            bucket_name, environment_variables["anomaly_store_prefix"],
+            runtime_variables["survey"], runtime_variables["period"], run["run_id"],
+            pd.read_json(anomalies, dtype=False), environment_variables["segmentation"])
+        stage["rows"] = anomaly_index["anomaly_count"]
+    run["have_anomalies"] = anomaly_index["anomaly_count"] > 0
+    logger.info("Successfully stored anomalies, strata transitions: " +
+                json.dumps(anomaly_index["transitions"]))
+
+
+def notify_run(run, bpm_started, environment_variables, runtime_variables, metrics,
+               logger):
+    """
+    Sends the sns message, storing the result in the cache at the same time when it
+    wasn't restored from it, unless an earlier attempt at the run already has.
+    :param run: Dict of the state of the run.
+    :param bpm_started: Future of the start status sent to BPM, waited for here, or None.
+    :param environment_variables: Dict of the validated environment variables.
+    :param runtime_variables: Dict of the validated runtime variables.
+    :param metrics: StageMetrics to time the stages.
+    :param logger: Logger for the run.
+    :return:
+    """
+    # The sns message tells the next module the output is ready, so is only sent once
+    # it is saved. Storing it in the cache can happen at the same time.
+    notifications = []
+    if "notify" not in run["completed"]:
+        notifications.append((aws_functions.send_sns_message_with_anomalies,
+                              (run["have_anomalies"],
+                               runtime_variables["sns_topic_arn"], "Strata.")))
+        if run["cache_key"] is not None and run["cached_result"] is None:
+            notifications.insert(0, (store_cached_result, (
+                environment_variables["bucket_name"],
+                environment_variables["result_cache_prefix"], run["cache_key"],
+                runtime_variables["out_file_name"],
+                runtime_variables["anomalies_file_name"], run["have_anomalies"])))
+    with metrics.stage("notify"):
+        run_io(notifications, environment_variables["concurrent_io"])
+        if bpm_started is not None:
+            bpm_started.result()
+
+    logger.info("Successfully sent message to sns")
+
+
+def finish_checkpoint(run, environment_variables):
+    """
+    With checkpoint set records the run as notified and deletes the output and
+    anomalies saved with the checkpoint, so a retry of a finished run does nothing.
+    :param run: Dict of the state of the run.
+    :param environment_variables: Dict of the validated environment variables.
+    :return:
+    """
+    if not environment_variables["checkpoint"] or "notify" in run["completed"]:
+        return
+
+    bucket_name = environment_variables["bucket_name"]
+    record_checkpoint(bucket_name, run["checkpoint_key"], run["completed"], ["notify"])
+    # Only the manifest is kept.
+    strata_common.get_boto3_client("s3", boto3.client).delete_objects(
+        Bucket=bucket_name, Delete={"Objects": [{"Key": run["output_key"]},
+                                                {"Key": run["anomalies_key"]}]})
+
+
+def save_strata_state(run, environment_variables, runtime_variables, metrics, logger):
+    """
+    Saves any strata index or strata lookup the method's run updated. It is only done
+    once the run has succeeded, so a failed run leaves them as they were for its retry.
+    A period missing from the index is just classified again.
+    :param run: Dict of the state of the run.
+    :param environment_variables: Dict of the validated environment variables.
+    :param runtime_variables: Dict of the validated runtime variables.
+    :param metrics: StageMetrics to time the stages.
+    :param logger: Logger for the run.
+    :return:
+    """
+    bucket_name = environment_variables["bucket_name"]
+    survey = runtime_variables["survey"]
+    strata_index = run.get("strata_index")
+    if strata_index is not None:
+        with metrics.stage("s3_write_index", rows=len(strata_index)):
+            save_strata_index(bucket_name,
+                              f"{environment_variables['strata_index_prefix']}{survey}/",
+                              strata_index, environment_variables["period_column"],
+                              environment_variables["reference"],
+                              environment_variables["segmentation"])
+        logger.info("Successfully updated the strata index.")
+
+    strata_lookup = run.get("strata_lookup")
+    if strata_lookup is not None:
+        import strata_period_method
+
+        with metrics.stage("s3_write_lookup", rows=len(strata_lookup["references"])):
+            strata_period_method.save_strata_lookup(
+                bucket_name,
+                f"{environment_variables['strata_lookup_prefix']}{survey}.npz",
+                strata_lookup)
+        logger.info("Successfully updated the strata lookup.")
+
+
+def get_io_executor():
+    """
+    Gets the thread pool used for concurrent I/O, creating it the first time it is
+    needed by the container.
+    :return: ThreadPoolExecutor.
+    """
+    global io_executor
+    if io_executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+
+        io_executor = ThreadPoolExecutor(max_workers=4)
+
+    return io_executor
+
+
+def run_io(calls, concurrent=False):
+    """
+    Makes calls that do not depend on each other, at the same time on the I/O thread
+    pool when concurrent is set, otherwise one after another. Every call is waited for
+    before the error of the first failed call, in the order given, is raised, so it
+    reaches handle_exception just as it would have without the thread pool.
+    :param calls: List of (function, args) tuples.
+    :param concurrent: Whether to make the calls at the same time.
+    :return: List of the results of the calls, in order.
+    """
+    if not concurrent or len(calls) < 2:
+        return [function(*args) for function, args in calls]
+
+    futures = [get_io_executor().submit(function, *args) for function, args in calls]
+    for future in futures:
+        future.exception()
+    return [future.result() for future in futures]
+
+
+def batch_lambda_handler(event, context):
+    """
+    Runs the strata module for a queue of runs. The runs are packed, in order, into
+    batches of up to method_batch_size runs, and each batch is sent to the method's
+    batch handler in one invocation. The runs come from the runs list in
+    RuntimeVariables or from the bodies of SQS records, each holding the
+    RuntimeVariables lambda_handler takes. As with pass_data_by_reference the method
+    reads each run's data and saves its output itself. The method runs the runs of a
+    batch one after another, so they are saved in their queued order.
+
+    :param event: Event Object, with the runs in RuntimeVariables or SQS records.
+    :param context: Context object.
+    :return: Dict with "success", false if any run failed, and "results", holding the
+             run_id, success and any error of each run in order. For SQS records it
+             also has "batchItemFailures", with the messageId of each failed run, so
+             only those are returned to the queue.
+    """
+    current_module = "Strata - Wrangler Batch"
+    # Define run_id outside of try block
+    run_id = 0
+
+    try:
+        if "Records" in event:
+            runs = [json.loads(record["body"])["RuntimeVariables"]
+                    for record in event["Records"]]
+        else:
+            # Retrieve run_id before input validation
+            # Because it is used in exception handling
+            run_id = event["RuntimeVariables"]["run_id"]
+            runs = strata_common.load_runtime(
+                BatchSchema, event["RuntimeVariables"])["runs"]
+
+        var_lambda = strata_common.get_boto3_client(
+            "lambda", boto3.client, cache_key="lambda-batch", config=BATCH_LAMBDA_CONFIG)
+
+        environment_variables = strata_common.load_environment(
+            EnvironmentSchema, os.environ)
+        if environment_variables["batch_method_name"] is None:
+            raise ValueError("batch_method_name must be provided to run batches.")
+
+    except Exception as e:
+        error_message = general_functions.handle_exception(e, current_module, run_id,
+                                                           context=context)
+        raise exception_classes.LambdaFailure(error_message)
+
+    results = [None] * len(runs)
+    batch = []
+    for position, run in enumerate(runs):
+        run_id = run.get("run_id", 0)
+        try:
+            runtime_variables = dict(
+                strata_common.load_runtime(RuntimeSchema, run), run_id=run_id)
+        except Exception as e:
+            error_message = general_functions.handle_exception(e, current_module, run_id,
+                                                               context=context)
+            results[position] = {"run_id": run_id, "success": False,
+                                 "error": error_message}
+            continue
+
+        if len(batch) == environment_variables["method_batch_size"]:
+            run_method_batch(var_lambda, environment_variables, batch, results,
+                             context)
+            batch = []
+        batch.append((position, runtime_variables))
+
+    if batch:
+        run_method_batch(var_lambda, environment_variables, batch, results, context)
+
+    response = {"success": all(result["success"] for result in results),
+                "results": results}
+    if "Records" in event:
+        response["batchItemFailures"] = [
+            {"itemIdentifier": record["messageId"]}
+            for record, result in zip(event["Records"], results)
+            if not result["success"]]
+
+    return response
+
+
+def run_method_batch(var_lambda, environment_variables, batch, results, context):
+    """
+    Invokes the method's batch handler for a batch of runs, then sends the sns message
+    and bpm status of each run, as lambda_handler does for a single run. If the invoke
+    fails, for example by timing out or being throttled, every run in the batch fails
+    with its error.
+    :param var_lambda: boto3 Lambda client.
+    :param environment_variables: Dict of the validated environment variables.
+    :param batch: List of the position and validated runtime variables of each run.
+    :param results: List the result of each run is set in, at the run's position.
+    :param context: Context object.
+    :return:
+    """
+    current_module = "Strata - Wrangler"
+    current_step_num = 3
+
+    method_runs = []
+    for _, runtime_variables in batch:
+        aws_functions.send_bpm_status(runtime_variables["bpm_queue_url"],
+                                      current_module, "IN PROGRESS",
+                                      runtime_variables["run_id"], current_step_num,
+                                      runtime_variables["total_steps"])
+        method_runs.append({
+            "anomalies_file_name": runtime_variables["anomalies_file_name"],
+            "batch_size": environment_variables["batch_size"],
+            "bpm_queue_url": runtime_variables["bpm_queue_url"],
+            "bucket_name": environment_variables["bucket_name"],
+            "current_period": runtime_variables["period"],
+            "environment": runtime_variables["environment"],
+            "in_file_name": runtime_variables["in_file_name"],
+            "out_file_name": runtime_variables["out_file_name"],
+            "output_part_size": environment_variables["output_part_size"],
+            "period_column": environment_variables["period_column"],
+            "reference": environment_variables["reference"],
+            "region_column": runtime_variables["distinct_values"][0],
+            "run_id": runtime_variables["run_id"],
+            "segmentation": environment_variables["segmentation"],
+            "survey": runtime_variables["survey"],
+            "survey_column": runtime_variables["survey_column"]
+        })
+
+    try:
+        json_response = invoke_method(
+            var_lambda, environment_variables["batch_method_name"],
+            {"RuntimeVariables": {"run_id": method_runs[0]["run_id"],
+                                  "runs": method_runs}})
+    except Exception as e:
+        for position, runtime_variables in batch:
+            error_message = general_functions.handle_exception(
+                e, current_module, runtime_variables["run_id"], context=context,
+                bpm_queue_url=runtime_variables["bpm_queue_url"])
+            results[position] = {"run_id": runtime_variables["run_id"],
+                                 "success": False, "error": error_message}
+        return
+
+    # A batch that could not be started fails every run in it.
+    method_results = json_response.get("results", [json_response] * len(batch))
+
+    for (position, runtime_variables), method_result in zip(batch, method_results):
+        run_id = runtime_variables["run_id"]
+        bpm_queue_url = runtime_variables["bpm_queue_url"]
+        try:
+            logger = general_functions.get_logger(runtime_variables["survey"],
+                                                  current_module,
+                                                  runtime_variables["environment"],
+                                                  run_id)
+            if not method_result["success"]:
+                raise exception_classes.MethodFailure(method_result["error"])
+
+            aws_functions.send_sns_message_with_anomalies(
+                method_result["anomaly_count"] > 0, runtime_variables["sns_topic_arn"],
+                "Strata.")
+            logger.info("Successfully completed module: " + current_module)
+            aws_functions.send_bpm_status(bpm_queue_url, current_module, "DONE",
+                                          run_id, current_step_num,
+                                          runtime_variables["total_steps"])
+            results[position] = {"run_id": run_id, "success": True}
+        except Exception as e:
+            error_message = general_functions.handle_exception(
+                e, current_module, run_id, context=context, bpm_queue_url=bpm_queue_url)
+            results[position] = {"run_id": run_id, "success": False,
+                                 "error": error_message}
+
+
+def invoke_method(var_lambda, method_name, json_payload, metrics=None):
+    """
+    Invokes the method and decodes its response, decompressing the data and reading it
+    from s3 if the method saved it there.
+    :param var_lambda: boto3 Lambda client.
+    :param method_name: Name of the method Lambda.
+    :param json_payload: Payload for the method.
+    :param metrics: StageMetrics to time the invoke and the decoding of the response.
+    :return: json_response: Dict returned by the method.
+    """
+    if metrics is None:
+        metrics = strata_metrics.StageMetrics(None, None)
+
+    with metrics.stage("encode_payload") as stage:
+        payload = json.dumps(json_payload)
+        stage["payload_bytes"] = len(payload)
+
+    with metrics.stage("invoke", payload_bytes=len(payload)):
+        returned_data = var_lambda.invoke(FunctionName=method_name, Payload=payload)
+        response = returned_data.get("Payload").read().decode("UTF-8")
+
+    with metrics.stage("decode", payload_bytes=len(response)):
+        json_response = json.loads(response)
+
+    if "response_compression" in json_response or "data_key" in json_response:
+        import strata_period_method
+
+        with metrics.stage("unpack_response"):
+            json_response = strata_period_method.unpack_response(
+                json_response, json_payload["RuntimeVariables"].get("bucket_name"))
+
+    return json_response
+
+
+def invoke_method_projected(var_lambda, method_name, json_payload, data_df,
+                            data_encoding, strata_columns, metrics=None):
+    """
+    Invokes the method with only the columns it uses, along with the position of each
+    row, and adds the reference, period and strata it returns back to the rest of the
+    data. Rows the method duplicates get a copy of the rest of their row.
+    :param var_lambda: boto3 Lambda client.
+    :param method_name: Name of the method Lambda.
+    :param json_payload: Payload for the method, without the data.
+    :param data_df: DataFrame of all of the data.
+    :param data_encoding: Encoding used for the data sent to the method.
+    :param strata_columns: Column names the method uses, those missing from the data
+                           are skipped.
+    :param metrics: StageMetrics to time the stages.
+    :return: json_response: Dict in the same form as the method's response, with the
+                           data as a DataFrame.
+    """
+    import strata_period_method
+
+    if metrics is None:
+        metrics = strata_metrics.StageMetrics(None, None)
+
+    projected_data = data_df[[column for column in data_df.columns
+                              if column in strata_columns]]
+    projected_data = projected_data.assign(**{
+        strata_period_method.ROW_POSITION_COLUMN: np.arange(len(data_df))})
+
+    json_payload["RuntimeVariables"]["projected"] = True
+    with metrics.stage("encode", rows=len(projected_data)):
+        json_payload["RuntimeVariables"]["data"] = \
+            strata_common.encode_dataframe(projected_data, data_encoding)
+
+    json_response = invoke_method(var_lambda, method_name, json_payload, metrics)
+    if not json_response["success"]:
+        return json_response
+
+    with metrics.stage("restore_columns") as stage:
+        returned_data = strata_common.decode_dataframe(
+            json_response["data"], json_response.get("data_encoding", "json-records"))
+        carried_data = data_df.drop(columns=[column for column in returned_data.columns
+                                             if column in data_df.columns])
+        output_data = strata_period_method.restore_carried_columns(
+            returned_data, carried_data, data_df.columns)
+        stage["rows"] = len(output_data)
+
+    return dict(json_response, data=output_data, data_encoding="json-records")
+
+
+def invoke_method_shards(var_lambda, method_name, json_payload, data_df, shard_count,
+                         data_encoding, reference, period_column, current_period):
+    """
+    Splits the data into shards by a hash of the reference, so every period of a
+    reference is in the same shard, and invokes the method for all of the shards at
+    once. The shards' data and anomalies are put back into the order the method would
+    have returned them in for the whole of the data. Anomalies are ordered by the
+    reference's first row in the current period, which matches the method as long as
+    a reference has one row per period.
+    :param var_lambda: boto3 Lambda client.
+    :param method_name: Name of the method Lambda.
+    :param json_payload: Payload for the method, without the data.
+    :param data_df: DataFrame of all of the data.
+    :param shard_count: Number of shards to split the data into.
+    :param data_encoding: Encoding used for the data sent to the method.
+    :param reference: Column name of the reference.
+    :param period_column: Column name of the period.
+    :param current_period: The current period of the run.
+    :return: json_response: Dict in the same form as the method's response, with the
+                           data as a DataFrame.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    # The method keeps extra columns, so each row carries its position back with it.
+    position_column = "shard_position"
+    data_df = data_df.assign(**{position_column: range(len(data_df))})
+    shard_ids = pd.util.hash_pandas_object(data_df[reference], index=False) \
+        .to_numpy() % shard_count
+
+    shard_payloads = []
+    for shard_id in range(shard_count):
+        shard_data = data_df[shard_ids == shard_id]
+        if len(shard_data) > 0:
+            shard_payload = {"RuntimeVariables": dict(
+                json_payload["RuntimeVariables"],
+                data=strata_common.encode_dataframe(shard_data, data_encoding))}
+            shard_payloads.append(shard_payload)
+
+    with ThreadPoolExecutor(max_workers=max(len(shard_payloads), 1)) as executor:
+        shard_responses = list(executor.map(
+            lambda payload: invoke_method(var_lambda, method_name, payload),
+            shard_payloads))
+
+    for shard_response in shard_responses:
+        if not shard_response["success"]:
+            return shard_response
+
+    shard_data = [strata_common.decode_dataframe(
+        shard_response["data"],
+        shard_response.get("data_encoding", "json-records"))
+        for shard_response in shard_responses]
+    if shard_data:
+        output_data = pd.concat(shard_data, ignore_index=True)
+        output_data = output_data.sort_values(position_column, kind="mergesort") \
+            .drop(columns=position_column)
+    else:
+        output_data = data_df.drop(columns=position_column)
+
+    # Anomalies are ordered by where the reference's current period data was.
+    shard_anomalies = [pd.read_json(shard_response["anomalies"], dtype=False)
+                       for shard_response in shard_responses
+                       if shard_response["anomalies"] != "[]"]
+    if shard_anomalies:
+        current_data = data_df[data_df[period_column] == int(current_period)]
+        current_positions = current_data.drop_duplicates(subset=reference) \
+            .set_index(reference)[position_column]
+        anomalies = pd.concat(shard_anomalies, ignore_index=True)
+        anomalies = anomalies.iloc[np.argsort(
+            anomalies[reference].map(current_positions).to_numpy(), kind="mergesort")]
+        anomalies_out = anomalies.to_json(orient="records")
+    else:
+        anomalies_out = "[]"
+
+    return {
+        "success": True,
+        "data": output_data,
+        "anomalies": anomalies_out
+    }
+
+
+def invoke_method_incremental(var_lambda, method_name, json_payload, data_df,
+                              data_encoding, bucket_name, index_prefix, reference,
+                              segmentation, period_column, current_period,
+                              metrics=None):
+    """
+    Takes the strata of the earlier periods from the strata index in s3 and invokes the
+    method to classify only the current period, along with any earlier period the
+    index does not cover. Mismatch detection is then run over every period here, which
+    gives the same result as the method would for the whole of the data as long as
+    the earlier periods have not changed since they were indexed. The strata of the
+    periods classified are returned for save_strata_index, to be saved once the run has
+    succeeded.
+    :param var_lambda: boto3 Lambda client.
+    :param method_name: Name of the method Lambda.
+    :param json_payload: Payload for the method, without the data.
+    :param data_df: DataFrame of all of the data.
+    :param data_encoding: Encoding used for the data sent to the method.
+    :param bucket_name: Name of the s3 bucket holding the index.
+    :param index_prefix: Prefix of the index files, one for each period.
+    :param reference: Column name of the reference.
+    :param segmentation: Column name of the strata.
+    :param period_column: Column name of the period.
+    :param current_period: The current period of the run.
+    :param metrics: StageMetrics to time the stages.
+    :return: json_response: Dict in the same form as the method's response, with the
+                           data as a DataFrame, and the strata of the periods
+                           classified as strata_index.
+    """
+    import strata_period_method
+
+    if metrics is None:
+        metrics = strata_metrics.StageMetrics(None, None)
+
+    periods = data_df[period_column]
+    strata = pd.Series(None, index=data_df.index, dtype=object)
+    with metrics.stage("s3_read_index") as stage:
+        stored_periods = list_strata_index_periods(bucket_name, index_prefix)
+        for period in periods.unique():
+            if period == int(current_period) or period not in stored_periods:
+                continue
+            index_data = read_strata_index(bucket_name,
+                                           strata_index_key(index_prefix, period))
+            in_period = periods == period
+            strata[in_period] = match_strata_index(
+                data_df.loc[in_period, reference], index_data, reference, segmentation)
+        stage["rows"] = int(strata.notna().sum())
+
+    # Periods with any row missing from the index are classified again.
+    to_classify = periods.isin(periods[strata.isna()].unique())
+    if to_classify.any():
+        json_payload["RuntimeVariables"]["classify_only"] = True
+        with metrics.stage("encode", rows=int(to_classify.sum())):
+            json_payload["RuntimeVariables"]["data"] = \
+                strata_common.encode_dataframe(data_df[to_classify], data_encoding)
+
+        json_response = invoke_method(var_lambda, method_name, json_payload, metrics)
+        if not json_response["success"]:
+            return json_response
+
+        classified = strata_common.decode_dataframe(
+            json_response["data"], json_response.get("data_encoding", "json-records"))
+        classified.index = data_df.index[to_classify]
+    else:
+        classified = data_df[to_classify].assign(**{segmentation: None})
+
+    indexed = data_df[~to_classify].assign(**{segmentation: strata[~to_classify]})
+    post_strata = pd.concat([classified, indexed]).sort_index()
+
+    with metrics.stage("mismatch_detection", rows=len(post_strata)):
+        strata_check, anomalies = strata_period_method.strata_mismatch_detector(
+            post_strata,
+            current_period,
+            period_column,
+            reference,
+            segmentation,
+            "good_" + segmentation,
+            "current_" + period_column,
+            "previous_" + period_column,
+            "current_" + segmentation,
+            "previous_" + segmentation)
+
+    # Saved by the caller once the run has succeeded.
+    return {
+        "success": True,
+        "data": strata_check,
+        "anomalies": anomalies.to_json(orient="records"),
+        "strata_index": classified[[period_column, reference, segmentation]]
+    }
+
+
+def invoke_method_lookup(var_lambda, method_name, json_payload, data_df,
+                         data_encoding, bucket_name, lookup_key, reference,
+                         segmentation, period_column, current_period, metrics=None):
+    """
+    Invokes the method with the current period, having it check the current strata
+    against the strata lookup in s3 instead of the previous period's data. Rows of the
+    previous period take the current strata of their reference, as mismatch detection
+    would set them to, so only those whose reference isn't in the current period are
+    sent. The lookup is used when it is of the previous period and the data has just
+    the one previous period, otherwise all the data is sent as usual. Either way the
+    lookup updated with the current period is returned, to be saved with
+    save_strata_lookup once the run has succeeded.
+    :param var_lambda: boto3 Lambda client.
+    :param method_name: Name of the method Lambda.
+    :param json_payload: Payload for the method, without the data.
+    :param data_df: DataFrame of all of the data.
+    :param data_encoding: Encoding used for the data sent to the method.
+    :param bucket_name: Name of the s3 bucket holding the lookup.
+    :param lookup_key: Key of the lookup.
+    :param reference: Column name of the reference.
+    :param segmentation: Column name of the strata.
+    :param period_column: Column name of the period.
+    :param current_period: The current period of the run.
+    :param metrics: StageMetrics to time the stages.
+    :return: json_response: Dict in the same form as the method's response, with the
+                           data as a DataFrame, and the updated lookup as
+                           strata_lookup.
+    """
+    import strata_period_method
+
+    if metrics is None:
+        metrics = strata_metrics.StageMetrics(None, None)
+
+    with metrics.stage("s3_read_lookup") as stage:
+        strata_lookup = strata_period_method.load_strata_lookup(bucket_name,
+                                                                lookup_key)
+        stage["rows"] = 0 if strata_lookup is None else len(
+            strata_lookup["references"])
+
+    in_current = (data_df[period_column] == int(current_period)).to_numpy()
+    previous_periods = data_df.loc[~in_current, period_column].unique()
+    use_lookup = strata_lookup is not None and len(previous_periods) == 1 and \
+        previous_periods[0] == strata_lookup["period"]
+
+    if use_lookup:
+        to_send = in_current | ~data_df[reference].isin(
+            data_df.loc[in_current, reference]).to_numpy()
+        json_payload["RuntimeVariables"].update({"bucket_name": bucket_name,
+                                                 "strata_lookup_key": lookup_key})
+    else:
+        to_send = np.ones(len(data_df), dtype=bool)
+
+    with metrics.stage("encode", rows=int(to_send.sum())):
+        json_payload["RuntimeVariables"]["data"] = \
+            strata_common.encode_dataframe(data_df[to_send], data_encoding)
+
+    json_response = invoke_method(var_lambda, method_name, json_payload, metrics)
+    if not json_response["success"]:
+        return json_response
+
+    output_data = strata_common.decode_dataframe(
+        json_response["data"], json_response.get("data_encoding", "json-records"))
+
+    if use_lookup:
+        # Rows come back one for each row sent, in the same order.
+        output_data.index = np.flatnonzero(to_send)
+        current_strata = output_data[in_current[to_send]] \
+            .drop_duplicates(subset=reference, keep="last") \
+            .set_index(reference)[segmentation]
+        previous_data = data_df[~to_send]
+        previous_data = previous_data.assign(**{
+            segmentation: previous_data[reference].map(current_strata)})
+        previous_data.index = np.flatnonzero(~to_send)
+        output_data = pd.concat([output_data, previous_data]).sort_index() \
+            .reset_index(drop=True)
+
+    current_data = output_data[output_data[period_column] == int(current_period)]
+    updated_lookup = strata_period_method.update_strata_lookup(
+        strata_lookup, current_data[reference], current_data[segmentation],
+        int(current_period))
+
+    return dict(json_response, data=output_data, data_encoding="json-records",
+                strata_lookup=updated_lookup)
+
+
+def list_strata_index_periods(bucket_name, index_prefix):
+    """
+    Finds the periods held in the strata index.
+    :param bucket_name: Name of the s3 bucket holding the index.
+    :param index_prefix: Prefix of the index files.
+    :return: Set of the periods as ints.
+    """
+    s3 = strata_common.get_boto3_client("s3", boto3.client)
+    paginator = s3.get_paginator("list_objects_v2")
+
+    periods = set()
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=index_prefix):
+        for stored_object in page.get("Contents", []):
+            period = stored_object["Key"][len(index_prefix):]
+            if period.endswith(".json") and period[:-len(".json")].isdigit():
+                periods.add(int(period[:-len(".json")]))
+
+    return periods
+
+
+def strata_index_key(index_prefix, period):
+    """
+    Gets the key of a period's file in the strata index.
+    :param index_prefix: Prefix of the index files.
+    :param period: The period.
+    :return: Key of the file.
+    """
+    return f"{index_prefix}{period}.json"
+
+
+def read_strata_index(bucket_name, index_key):
+    """
+    Reads a period's file from the strata index.
+    :param bucket_name: Name of the s3 bucket holding the index.
+    :param index_key: Key of the file, from strata_index_key.
+    :return: DataFrame of the references and strata.
+    """
+    s3 = strata_common.get_boto3_client("s3", boto3.client)
+    return strata_common.decode_dataframe(
+        s3.get_object(Bucket=bucket_name, Key=index_key)["Body"].read().decode("UTF-8"))
+
+
+def save_strata_index(bucket_name, index_prefix, index_data, period_column, reference,
+                      segmentation):
+    """
+    Saves the strata of each period in index_data to the strata index, replacing the
+    period's file.
+    :param bucket_name: Name of the s3 bucket holding the index.
+    :param index_prefix: Prefix of the index files.
+    :param index_data: DataFrame of the period, reference and strata of each row.
+    :param period_column: Column name of the period.
+    :param reference: Column name of the reference.
+    :param segmentation: Column name of the strata.
+    :return:
+    """
+    for period, period_data in index_data.groupby(period_column, sort=False):
+        aws_functions.save_to_s3(
+            bucket_name, strata_index_key(index_prefix, period),
+            period_data[[reference, segmentation]].to_json(orient="records"))
+
+
+def match_strata_index(references, index_data, reference, segmentation):
+    """
+    Looks up the strata of a period's rows in its index. A reference with more than one
+    row in the period is matched to its index rows in order.
+    :param references: Series of the period's references.
+    :param index_data: DataFrame of the period's index.
+    :param reference: Column name of the reference.
+    :param segmentation: Column name of the strata.
+    :return: Array of the strata, None for references missing from the index.
+    """
+    if len(index_data) == 0:
+        return np.full(len(references), None, dtype=object)
+
+    keys = pd.DataFrame({reference: references.to_numpy(),
+                         "occurrence": references.groupby(references).cumcount()
+                         .to_numpy()})
+    index_keys = index_data[[reference, segmentation]].assign(
+        occurrence=index_data.groupby(reference).cumcount())
+
+    matched = pd.merge(keys, index_keys, on=[reference, "occurrence"], how="left")
+    return matched[segmentation].to_numpy(dtype=object)
+
+
+def read_saved_anomalies(bucket_name, anomalies_file_name, have_anomalies):
+    """
+    Reads back the anomalies saved for a run.
+    :param bucket_name: Name of the s3 bucket holding the anomalies.
+    :param anomalies_file_name: Name the anomalies were saved as.
+    :param have_anomalies: Whether any anomalies were saved.
+    :return: String of the anomalies as json records.
+    """
+    if not have_anomalies:
+        return "[]"
+
+    s3 = strata_common.get_boto3_client("s3", boto3.client)
+    return s3.get_object(Bucket=bucket_name,
+                         Key=anomalies_file_name)["Body"].read().decode("UTF-8")
+
+
+def store_anomalies(bucket_name, store_prefix, survey, period, run_id, anomalies,
+                    segmentation):
+    """
+    Saves the anomalies of a run as parquet under
+    <store_prefix>survey=<survey>/period=<period>/run_id=<run_id>/, a layout query
+    engines read as partitions. Next to them is index.json, holding the number of
+    anomalies and of references moving between each pair of strata, keyed as
+    "<previous strata>-><current strata>", so the anomalies can be counted without
+    reading them. The index is written last, so it only ever refers to saved anomalies.
+    :param bucket_name: Name of the s3 bucket to save to.
+    :param store_prefix: Prefix of the anomaly store in the bucket.
+    :param survey: The survey of the run.
+    :param period: The current period of the run.
+    :param run_id: Id of the run.
+    :param anomalies: DataFrame of the anomalies from strata_mismatch_detector.
+    :param segmentation: Column name of the strata.
+    :return: Dict of the index.
+    """
+    partition = f"{store_prefix}survey={survey}/period={period}/run_id={run_id}/"
+    s3 = strata_common.get_boto3_client("s3", boto3.client)
+
+    index = {
+        "anomaly_count": len(anomalies),
+        "anomalies_key": None,
+        "period": period,
+        "run_id": run_id,
+        "survey": survey,
+        "transitions": {}
+    }
+    if len(anomalies) > 0:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        transitions = anomalies.groupby(["previous_" + segmentation,
+                                         "current_" + segmentation]).size()
+        index["transitions"] = {f"{previous}->{current}": int(count)
+                                for (previous, current), count in transitions.items()}
+
+        sink = pa.BufferOutputStream()
+        pq.write_table(pa.Table.from_pandas(anomalies, preserve_index=False), sink)
+        index["anomalies_key"] = partition + "anomalies.parquet"
+        s3.put_object(Bucket=bucket_name, Key=index["anomalies_key"],
+                      Body=sink.getvalue().to_pybytes())
+
+    s3.put_object(Bucket=bucket_name, Key=partition + "index.json",
+                  Body=json.dumps(index).encode("UTF-8"))
+
+    return index
+
+
+def read_checkpoint(bucket_name, checkpoint_key):
+    """
+    Reads the stages of a run completed by earlier attempts at it.
+    :param bucket_name: Name of the s3 bucket holding the checkpoint.
+    :param checkpoint_key: Key of the run's checkpoint, without its extension.
+    :return: Dict of each completed stage to its details, empty for a new run.
+    """
+    s3 = strata_common.get_boto3_client("s3", boto3.client)
+    try:
+        manifest = json.loads(s3.get_object(
+            Bucket=bucket_name, Key=f"{checkpoint_key}.json")["Body"].read())
+    except s3.exceptions.NoSuchKey:
+        return {}
+
+    return manifest["stages"]
+
+
+def record_checkpoint(bucket_name, checkpoint_key, completed, stages, **details):
+    """
+    Adds stages to the completed stages of a run and saves them as its checkpoint.
+    :param bucket_name: Name of the s3 bucket holding the checkpoint.
+    :param checkpoint_key: Key of the run's checkpoint, without its extension.
+    :param completed: Dict from read_checkpoint, updated in place.
+    :param stages: List of the names of the stages completed.
+    :param details: Details to record with the stages, such as have_anomalies.
+    :return:
+    """
+    for stage in stages:
+        completed[stage] = dict(details, completed=time.time())
+
+    s3 = strata_common.get_boto3_client("s3", boto3.client)
+    s3.put_object(Bucket=bucket_name, Key=f"{checkpoint_key}.json",
+                  Body=json.dumps({"stages": completed}).encode("UTF-8"))
+
+
+def copy_s3_object(bucket_name, source_key, key):
+    """
+    Copies an object within a bucket, keeping its metadata.
+    :param bucket_name: Name of the s3 bucket.
+    :param source_key: Key of the object to copy.
+    :param key: Key to copy it to.
+    :return:
+    """
+    s3 = strata_common.get_boto3_client("s3", boto3.client)
+    s3.copy_object(Bucket=bucket_name, Key=key,
+                   CopySource={"Bucket": bucket_name, "Key": source_key})
+
+
+def get_cache_key(bucket_name, in_file_name, parameters):
+    """
+    Hashes the ETag of the input file together with the parameters of the run. Any new
+    upload of the input gives it a new ETag, so changes the key.
+    :param bucket_name: Name of the s3 bucket holding the input.
+    :param in_file_name: Name of the input file, without its extension.
+    :param parameters: Dict of the parameters that affect the output or how it is
+                       saved.
+    :return: Hex digest to store the result under.
+    """
+    s3 = strata_common.get_boto3_client("s3", boto3.client)
+    etag = s3.head_object(Bucket=bucket_name, Key=in_file_name + ".json")["ETag"]
+
+    key_data = json.dumps({"input_etag": etag, "parameters": parameters},
+                          sort_keys=True)
+    return hashlib.sha256(key_data.encode("UTF-8")).hexdigest()
+
+
+def read_cached_result(bucket_name, cache_prefix, cache_key, ttl):
+    """
+    Reads the manifest of a cached result. A result older than the ttl is deleted.
+    :param bucket_name: Name of the s3 bucket holding the cache.
+    :param cache_prefix: Prefix of the cache in the bucket.
+    :param cache_key: Key from get_cache_key.
+    :param ttl: Seconds a cached result can be used for.
+    :return: Dict of the manifest, or None if there is no result to use.
+    """
+    s3 = strata_common.get_boto3_client("s3", boto3.client)
+    try:
+        manifest = json.loads(s3.get_object(
+            Bucket=bucket_name, Key=f"{cache_prefix}{cache_key}.json")["Body"].read())
+    except s3.exceptions.NoSuchKey:
+        return None
+
+    if time.time() - manifest["created"] > ttl:
+        s3.delete_objects(Bucket=bucket_name, Delete={"Objects": [
+            {"Key": f"{cache_prefix}{cache_key}.json"},
+            {"Key": f"{cache_prefix}{cache_key}/output.json"},
+            {"Key": f"{cache_prefix}{cache_key}/anomalies.json"}
+        ]})
+        return None
+
+    return manifest
+
+
+def restore_cached_result(bucket_name, cache_prefix, cache_key, manifest,
+                          out_file_name, anomalies_file_name):
+    """
+    Copies a cached output, and its anomalies if it had any, to where a run saves them.
+    :param bucket_name: Name of the s3 bucket holding the cache.
+    :param cache_prefix: Prefix of the cache in the bucket.
+    :param cache_key: Key from get_cache_key.
+    :param manifest: Dict from read_cached_result.
+    :param out_file_name: Name to save the output as.
+    :param anomalies_file_name: Name to save the anomalies as.
+    :return:
+    """
+    s3 = strata_common.get_boto3_client("s3", boto3.client)
+    s3.copy_object(Bucket=bucket_name, Key=out_file_name, CopySource={
+        "Bucket": bucket_name, "Key": f"{cache_prefix}{cache_key}/output.json"})
+    if manifest["have_anomalies"]:
+        s3.copy_object(Bucket=bucket_name, Key=anomalies_file_name, CopySource={
+            "Bucket": bucket_name, "Key": f"{cache_prefix}{cache_key}/anomalies.json"})
+
+
+def store_cached_result(bucket_name, cache_prefix, cache_key, out_file_name,
+                        anomalies_file_name, have_anomalies):
+    """
+    Copies the saved output and anomalies of a run into the cache. The manifest is
+    written last so a partly stored result is never used.
+    :param bucket_name: Name of the s3 bucket holding the cache.
+    :param cache_prefix: Prefix of the cache in the bucket.
+    :param cache_key: Key from get_cache_key.
+    :param out_file_name: Name the output was saved as.
+    :param anomalies_file_name: Name the anomalies were saved as.
+    :param have_anomalies: Whether the run saved any anomalies.
+    :return:
+    """
+    s3 = strata_common.get_boto3_client("s3", boto3.client)
+    s3.copy_object(Bucket=bucket_name, Key=f"{cache_prefix}{cache_key}/output.json",
+                   CopySource={"Bucket": bucket_name, "Key": out_file_name})
+    if have_anomalies:
+        s3.copy_object(Bucket=bucket_name,
+                       Key=f"{cache_prefix}{cache_key}/anomalies.json",
+                       CopySource={"Bucket": bucket_name, "Key": anomalies_file_name})
+
+    manifest = {"created": time.time(), "have_anomalies": have_anomalies}
+    s3.put_object(Bucket=bucket_name, Key=f"{cache_prefix}{cache_key}.json",
+                  Body=json.dumps(manifest).encode("UTF-8"))
@@ -1,12 +1,22 @@
+import contextlib
+import gzip
+import io
 import json
+import subprocess
+import sys
 from unittest import mock
 
+import boto3
+import numpy as np
 import pandas as pd
 import pytest
+from botocore.exceptions import ReadTimeoutError
 from es_aws_functions import exception_classes, test_generic_library
 from moto import mock_s3
 from pandas.testing import assert_frame_equal
 
+import strata_common
+import strata_metrics
 import strata_period_method as lambda_method_function
 import strata_period_wrangler as lambda_wrangler_function
 
@@ -28,6 +38,7 @@ method_runtime_variables = {
         "bpm_queue_url": "fake_queue_url",
         "current_period": "201809",
         "data": None,
+        "data_encoding": "json-records",
         "environment": "sandbox",
         "period_column": "period",
         "reference": "responder_id",
@@ -57,6 +68,46 @@ wrangler_runtime_variables = {
 }
 
 
+@pytest.fixture(autouse=True)
+def clear_container_caches():
+    # Clients and validated environments are kept between invocations,
+    # so each test starts from a cold container.
+    strata_common.boto3_clients.clear()
+    strata_common.environment_cache.clear()
+    strata_common.schema_cache.clear()
+    lambda_method_function.strata_lookup_cache.clear()
+
+
+class InProcessMethod:
+    """
+    Stands in for the Lambda client's invoke, running the method in this process and
+    returning its response as Lambda would. Each payload and response is recorded.
+    """
+    def __init__(self, handler=None, save_to_s3=None):
+        """
+        :param handler: Method handler to run. Default: the method's lambda_handler
+        :param save_to_s3: Replacement for the method's save_to_s3, if any.
+        """
+        self.handler = handler or lambda_method_function.lambda_handler
+        self.save_to_s3 = save_to_s3
+        self.payloads = []
+        self.responses = []
+
+    def __call__(self, FunctionName, Payload):  # noqa: N803
+        self.payloads.append(json.loads(Payload))
+        save_patch = contextlib.nullcontext() if self.save_to_s3 is None else \
+            mock.patch("strata_period_method.aws_functions.save_to_s3",
+                       side_effect=self.save_to_s3)
+        with mock.patch.dict(lambda_method_function.os.environ,
+                             method_environment_variables), save_patch:
+            output = self.handler(json.loads(Payload),
+                                  test_generic_library.context_object)
+        self.responses.append(output)
+        payload = mock.Mock()
+        payload.read.return_value = json.dumps(output).encode("UTF-8")
+        return {"Payload": payload}
+
+
 ##########################################################################################
 #                                     Generic                                            #
 ##########################################################################################
@@ -186,6 +237,136 @@ def test_calculate_strata():
     assert_frame_equal(produced_data, prepared_data)
 
 
+def test_classify_strata():
+    """
+    Runs the classify_strata function that is called by the method.
+    :param None
+    :return Test Pass/Fail
+    """
+    with open("tests/fixtures/test_method_input.json", "r") as file_1:
+        file_data = file_1.read()
+    input_data = pd.DataFrame(json.loads(file_data))
+
+    produced_data = lambda_method_function.classify_strata(
+        input_data,
+        strata_column="strata",
+        value_column="Q608_total",
+        survey_column="survey",
+        region_column="region"
+    )
+    produced_data = produced_data.sort_index(axis=1)
+
+    with open("tests/fixtures/test_calculate_strata_prepared_output.json", "r") as file_2:
+        file_data = file_2.read()
+    prepared_data = pd.DataFrame(json.loads(file_data)).sort_index(axis=1)
+
+    assert_frame_equal(produced_data, prepared_data)
+
+
+@pytest.mark.parametrize(
+    "survey,value,region,expected_strata",
+    [
+        ("066", None, 9, ""),
+        ("066", 29999, 9, "E"),
+        ("066", 30000, 9, "D"),
+        ("066", 79999, 9, "D"),
+        ("066", 80000, 9, "C"),
+        ("066", 129999, 9, "C"),
+        ("066", 130000, 9, "B1"),
+        ("066", 130000, 10, "B2"),
+        ("066", 200000, 10, "B2"),
+        ("066", 200001, 10, "A"),
+        ("076", 2, 9, "M"),
+        ("076", None, 9, ""),
+        ("999", 200001, 9, "")
+    ])
+def test_classify_strata_boundaries(survey, value, region, expected_strata):
+    """
+    Checks classify_strata matches calculate_strata at the strata boundaries.
+    :param survey: Survey code of the reference.
+    :param value: Q608 total of the reference.
+    :param region: Region code of the reference.
+    :param expected_strata: Strata the reference should be given.
+    :return Test Pass/Fail
+    """
+    input_data = pd.DataFrame({"survey": [survey], "Q608_total": [value],
+                               "region": [region]}, dtype=object)
+
+    produced_data = lambda_method_function.classify_strata(
+        input_data, "Q608_total", "region", "strata", "survey")
+    produced_row = lambda_method_function.calculate_strata(
+        input_data.iloc[0].copy(), "Q608_total", "region", "strata", "survey")
+
+    assert produced_data["strata"].iloc[0] == expected_strata
+    assert produced_row["strata"] == expected_strata
+
+
+@pytest.mark.parametrize("data_encoding", ["json-records", "json-split", "arrow-base64"])
+def test_encode_decode_dataframe(data_encoding):
+    """
+    Checks data survives being encoded and decoded for the payload.
+    :param data_encoding: Encoding used for the payload data.
+    :return Test Pass/Fail
+    """
+    with open("tests/fixtures/test_method_input.json", "r") as file_1:
+        file_data = file_1.read()
+    input_data = pd.DataFrame(json.loads(file_data))
+
+    encoded_data = strata_common.encode_dataframe(input_data, data_encoding)
+    produced_data = strata_common.decode_dataframe(encoded_data, data_encoding)
+
+    assert isinstance(encoded_data, str)
+    assert_frame_equal(produced_data, input_data)
+
+
+def test_load_strata_rules():
+    """
+    Runs the load_strata_rules function with a rule table adding a new survey.
+    :param None
+    :return Test Pass/Fail
+    """
+    rules = dict(lambda_method_function.DEFAULT_STRATA_RULES)
+    rules["999"] = {"thresholds": [100], "strata": ["Y", "X"]}
+    strata_rules = lambda_method_function.load_strata_rules(json.dumps(rules))
+
+    input_data = pd.DataFrame({"survey": ["999", "999", "066", "076"],
+                               "Q608_total": [100, 101, 130000, 5],
+                               "region": [1, 1, 12, 1]})
+    produced_data = lambda_method_function.classify_strata(
+        input_data, "Q608_total", "region", "strata", "survey", strata_rules)
+
+    assert list(produced_data["strata"]) == ["Y", "X", "B2", "M"]
+    assert lambda_method_function.load_strata_rules(json.dumps(rules)) is strata_rules
+
+
+def test_compile_strata_rules_error():
+    """
+    Checks thresholds out of order are rejected when compiling the strata rules.
+    :param None
+    :return Test Pass/Fail
+    """
+    with pytest.raises(ValueError) as exc_info:
+        lambda_method_function.compile_strata_rules(
+            {"066": {"thresholds": [79999, 29999], "strata": ["E", "D", "C"]}})
+
+    assert "ascending order" in str(exc_info.value)
+
+
+def test_strata_rules_file_must_be_json():
+    """
+    Checks a strata rules file that isn't json is rejected by the environment schema,
+    as yaml isn't packaged with the lambdas.
+    :param None
+    :return Test Pass/Fail
+    """
+    environment = dict(method_environment_variables, strata_rules_file="rules.yaml")
+    with pytest.raises(ValueError) as exc_info:
+        strata_common.load_environment(
+            lambda_method_function.EnvironmentSchema, environment)
+
+    assert "Must be a .json file." in str(exc_info.value)
+
+
 @mock_s3
 def test_method_success():
     """
@@ -212,6 +393,362 @@ def test_method_success():
     assert_frame_equal(produced_data, prepared_data)
 
 
+@mock_s3
+def test_method_success_arrow_encoding():
+    """
+    Runs the method function with the data sent as an Arrow IPC stream.
+    :param None
+    :return Test Pass/Fail
+    """
+    with open("tests/fixtures/test_method_input.json", "r") as file_1:
+        test_data = pd.DataFrame(json.loads(file_1.read()))
+
+    runtime_variables = {"RuntimeVariables": dict(
+        method_runtime_variables["RuntimeVariables"],
+        data=strata_common.encode_dataframe(test_data, "arrow-base64"),
+        data_encoding="arrow-base64")}
+
+    with mock.patch.dict(lambda_method_function.os.environ,
+                         method_environment_variables):
+        output = lambda_method_function.lambda_handler(
+            runtime_variables, test_generic_library.context_object)
+
+    with open("tests/fixtures/test_method_prepared_output.json", "r") as file_2:
+        file_data = file_2.read()
+    prepared_data = pd.DataFrame(json.loads(file_data)).sort_index(axis=1)
+
+    produced_data = strata_common.decode_dataframe(
+        output["data"], output["data_encoding"]).sort_index(axis=1)
+
+    assert output["success"]
+    assert output["data_encoding"] == "arrow-base64"
+    assert_frame_equal(produced_data, prepared_data)
+
+
+@pytest.mark.parametrize("response_compression,response_spill_bytes", [
+    ("gzip", None),
+    (None, 0),
+    ("gzip", 0),
+    ("zstd", None)
+])
+@mock_s3
+def test_method_success_packed_response(response_compression, response_spill_bytes):
+    """
+    Runs the method function with its response compressed or its data saved to s3,
+    and checks unpacking the response gives the same response as without.
+    :param response_compression - Compression for the response.
+    :param response_spill_bytes - Most bytes for the method to return inline.
+    :return Test Pass/Fail
+    """
+    if response_compression == "zstd":
+        pytest.importorskip("zstandard")
+
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    client = test_generic_library.create_bucket(bucket_name)
+
+    with open("tests/fixtures/test_method_input.json", "r") as file_1:
+        test_data = file_1.read()
+
+    runtime_variables = dict(method_runtime_variables["RuntimeVariables"],
+                             data=test_data)
+    packed_runtime_variables = dict(runtime_variables, bucket_name=bucket_name,
+                                    response_compression=response_compression,
+                                    response_spill_bytes=response_spill_bytes)
+
+    with mock.patch.dict(lambda_method_function.os.environ,
+                         method_environment_variables):
+        output = lambda_method_function.lambda_handler(
+            {"RuntimeVariables": runtime_variables},
+            test_generic_library.context_object)
+        packed_output = lambda_method_function.lambda_handler(
+            {"RuntimeVariables": packed_runtime_variables},
+            test_generic_library.context_object)
+
+    assert packed_output["success"]
+    assert (packed_output["data"] is None) == (response_spill_bytes is not None)
+    assert lambda_method_function.unpack_response(packed_output, bucket_name) == output
+    # Data saved to s3 is deleted once it has been read.
+    assert "Contents" not in client.list_objects_v2(Bucket=bucket_name,
+                                                    Prefix="strata_spill/")
+
+
+@mock_s3
+def test_method_success_by_reference():
+    """
+    Runs the method function with the data read from and written to s3.
+    :param None
+    :return Test Pass/Fail
+    """
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    client = test_generic_library.create_bucket(bucket_name)
+    test_generic_library.upload_files(client, bucket_name, ["test_method_input.json"])
+
+    runtime_variables = {"RuntimeVariables": dict(
+        method_runtime_variables["RuntimeVariables"],
+        bucket_name=bucket_name,
+        data=None,
+        in_file_name="test_method_input",
+        out_file_name="test_method_output.json")}
+
+    with mock.patch.dict(lambda_method_function.os.environ,
+                         method_environment_variables):
+        output = lambda_method_function.lambda_handler(
+            runtime_variables, test_generic_library.context_object)
+
+    with open("tests/fixtures/test_method_prepared_output.json", "r") as file_1:
+        file_data = file_1.read()
+    prepared_data = pd.DataFrame(json.loads(file_data)).sort_index(axis=1)
+
+    produced_file = client.get_object(Bucket=bucket_name, Key="test_method_output.json")
+    produced_data = pd.DataFrame(json.loads(produced_file["Body"].read()))
+
+    assert output == {"success": True, "out_file_name": "test_method_output.json",
+                      "anomaly_count": 0}
+    assert_frame_equal(produced_data.sort_index(axis=1), prepared_data)
+
+
+@mock_s3
+def test_method_success_batched():
+    """
+    Runs the method function streaming the data from s3 in batches.
+    :param None
+    :return Test Pass/Fail
+    """
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    client = test_generic_library.create_bucket(bucket_name)
+    test_generic_library.upload_files(client, bucket_name, ["test_method_input.json"])
+
+    runtime_variables = {"RuntimeVariables": dict(
+        method_runtime_variables["RuntimeVariables"],
+        batch_size=2,
+        bucket_name=bucket_name,
+        data=None,
+        in_file_name="test_method_input",
+        out_file_name="test_method_output.json")}
+
+    with mock.patch.dict(lambda_method_function.os.environ,
+                         method_environment_variables):
+        output = lambda_method_function.lambda_handler(
+            runtime_variables, test_generic_library.context_object)
+
+    with open("tests/fixtures/test_method_prepared_output.json", "r") as file_1:
+        file_data = file_1.read()
+    prepared_data = pd.DataFrame(json.loads(file_data)).sort_index(axis=1)
+
+    produced_file = client.get_object(Bucket=bucket_name, Key="test_method_output.json")
+    produced_data = pd.DataFrame(json.loads(produced_file["Body"].read()))
+
+    assert output == {"success": True, "out_file_name": "test_method_output.json",
+                      "anomaly_count": 0}
+    assert_frame_equal(produced_data.sort_index(axis=1), prepared_data)
+
+
+@mock_s3
+def test_method_batched_uploads_batches():
+    """
+    Runs the method with batch_size and checks the output is uploaded from a generator
+    of batches, rather than saved from a json string of all of it.
+    :param None
+    :return Test Pass/Fail
+    """
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    client = test_generic_library.create_bucket(bucket_name)
+    test_generic_library.upload_files(client, bucket_name, ["test_method_input.json"])
+
+    runtime_variables = {"RuntimeVariables": dict(
+        method_runtime_variables["RuntimeVariables"],
+        batch_size=2,
+        bucket_name=bucket_name,
+        data=None,
+        in_file_name="test_method_input",
+        out_file_name="test_method_output.json",
+        output_part_size=5242880)}
+
+    uploaded = []
+
+    def save_records(bucket_name, file_name, data, part_size):
+        uploaded.append((file_name, type(data), part_size,
+                         [len(batch) for batch in data]))
+
+    with mock.patch.dict(lambda_method_function.os.environ,
+                         method_environment_variables), \
+            mock.patch("strata_period_method.strata_common.save_records_to_s3",
+                       side_effect=save_records), \
+            mock.patch("strata_period_method.aws_functions.save_to_s3") as mock_save:
+        output = lambda_method_function.lambda_handler(
+            runtime_variables, test_generic_library.context_object)
+
+    with open("tests/fixtures/test_method_prepared_output.json", "r") as file_1:
+        row_count = len(json.loads(file_1.read()))
+
+    assert output["success"]
+    assert output["out_file_name"] == "test_method_output.json"
+    assert len(uploaded) == 1
+    file_name, data_type, part_size, batch_sizes = uploaded[0]
+    assert file_name == "test_method_output.json"
+    assert not issubclass(data_type, (str, pd.DataFrame))
+    assert part_size == 5242880
+    assert len(batch_sizes) > 1
+    assert sum(batch_sizes) == row_count
+    assert "test_method_output.json" not in [
+        call[0][1] for call in mock_save.call_args_list]
+
+
+@mock_s3
+def test_method_batched_matches_unbatched_dtypes():
+    """
+    Runs the method with and without batch_size on data whose batches differ in which
+    columns have nulls, checking both write the same bytes.
+    :param None
+    :return Test Pass/Fail
+    """
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    client = test_generic_library.create_bucket(bucket_name)
+    with open("tests/fixtures/test_method_input.json", "r") as file_1:
+        records = json.loads(file_1.read())[:6]
+    for position, record in enumerate(records):
+        record["flag"] = position % 2 == 0
+    # Nulls only in the second batch, and a column missing from the first.
+    records[2]["Q601_asphalting_sand"] = None
+    records[3]["flag"] = None
+    records[5]["late_column"] = 1
+    client.put_object(Bucket=bucket_name, Key="test_method_nulls.json",
+                      Body=json.dumps(records).encode("UTF-8"))
+
+    produced_files = []
+    for batch_size in [None, 2]:
+        runtime_variables = {"RuntimeVariables": dict(
+            method_runtime_variables["RuntimeVariables"],
+            batch_size=batch_size,
+            bucket_name=bucket_name,
+            data=None,
+            in_file_name="test_method_nulls",
+            out_file_name=f"test_method_output_{batch_size}.json")}
+
+        with mock.patch.dict(lambda_method_function.os.environ,
+                             method_environment_variables):
+            output = lambda_method_function.lambda_handler(
+                runtime_variables, test_generic_library.context_object)
+
+        assert output["success"]
+        produced_files.append(client.get_object(
+            Bucket=bucket_name, Key=output["out_file_name"])["Body"].read())
+
+    assert b'"Q601_asphalting_sand":1.0' in produced_files[0]
+    assert produced_files[1] == produced_files[0]
+
+
+@pytest.mark.parametrize("option", ["classify_only", "projected"])
+def test_method_option_needs_data(option):
+    """
+    Runs the method function with an option that only works on data in the payload,
+    reading the data from s3 instead, and checks it is rejected when the runtime
+    variables are validated.
+    :param option: Name of the option.
+    :return Test Pass/Fail
+    """
+    runtime_variables = {"RuntimeVariables": dict(
+        method_runtime_variables["RuntimeVariables"],
+        batch_size=2,
+        bucket_name=wrangler_environment_variables["bucket_name"],
+        data=None,
+        in_file_name="test_method_input",
+        out_file_name="test_method_output.json",
+        **{option: True})}
+
+    with mock.patch.dict(lambda_method_function.os.environ,
+                         method_environment_variables):
+        output = lambda_method_function.lambda_handler(
+            runtime_variables, test_generic_library.context_object)
+
+    assert not output["success"]
+    assert f"{option} needs the data in the payload." in output["error"]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 5, 100000])
+def test_iter_json_records(chunk_size):
+    """
+    Runs the iter_json_records function over a json array split into chunks.
+    :param chunk_size: Number of bytes in each chunk.
+    :return Test Pass/Fail
+    """
+    with open("tests/fixtures/test_method_input.json", "rb") as file_1:
+        file_data = file_1.read()
+    chunks = [file_data[i:i + chunk_size] for i in range(0, len(file_data), chunk_size)]
+
+    produced_records = list(lambda_method_function.iter_json_records(chunks))
+
+    assert produced_records == json.loads(file_data)
+
+
+@pytest.mark.parametrize("method_data", [
+    "tests/fixtures/test_method_input.json",
+    pd.DataFrame({
+        "responder_id": [1, 2, 1, 2, 3, 4, 4],
+        "period": [201806, 201806, 201809, 201809, 201809, 201806, 201809],
+        "survey": ["066", "066", "066", "076", "066", "066", "066"],
+        "Q608_total": [150000, 90000, 250000, 5, 100, 40000, 35000],
+        "region": [3, 12, 3, 12, 1, 9, 9]
+    })
+])
+def test_run_strata_parallel(method_data):
+    """
+    Runs the run_strata_parallel function and checks it matches run_strata.
+    :param method_data: Input data or the path of a fixture holding it.
+    :return Test Pass/Fail
+    """
+    if isinstance(method_data, str):
+        with open(method_data, "r") as file_1:
+            method_data = pd.DataFrame(json.loads(file_1.read()))
+    strata_arguments = (method_data, "201809", "strata", "Q608_total", "period",
+                        "responder_id", "region", "strata", "survey")
+
+    prepared_data, prepared_anomalies = lambda_method_function.run_strata(
+        *strata_arguments)
+    produced_data, produced_anomalies = lambda_method_function.run_strata_parallel(
+        *strata_arguments, max_workers=2)
+
+    assert_frame_equal(produced_data, prepared_data)
+    assert_frame_equal(produced_anomalies, prepared_anomalies, check_index_type=False)
+
+
+@pytest.mark.parametrize("method_data", [
+    "tests/fixtures/test_method_input.json",
+    pd.DataFrame({
+        "responder_id": [1, 2, 1, 2, 3, 4, 4],
+        "name": ["a", "b", "a", "b", "c", "d", "d"],
+        "period": [201806, 201806, 201809, 201809, 201809, 201806, 201809],
+        "survey": ["066", "066", "066", "076", "066", "066", "066"],
+        "Q607_constructional_fill": [1, 2, 3, 4, 5, 6, 7],
+        "Q608_total": [150000, 90000, 250000, 5, 100, 40000, 35000],
+        "region": [3, 12, 3, 12, 1, 9, 9]
+    })
+])
+def test_run_strata_compact(method_data):
+    """
+    Runs the run_strata function on compacted data and checks it serialises to the
+    same json as the data as it was given.
+    :param method_data: Input data or the path of a fixture holding it.
+    :return Test Pass/Fail
+    """
+    if isinstance(method_data, str):
+        with open(method_data, "r") as file_1:
+            method_data = pd.DataFrame(json.loads(file_1.read()))
+    strata_arguments = (method_data, "201809", "strata", "Q608_total", "period",
+                        "responder_id", "region", "strata", "survey")
+
+    prepared_data, prepared_anomalies = lambda_method_function.run_strata(
+        *strata_arguments)
+    produced_data, produced_anomalies = lambda_method_function.run_strata(
+        *strata_arguments, compact=True)
+
+    assert produced_data.to_json(orient="records") == \
+        prepared_data.to_json(orient="records")
+    assert produced_anomalies.to_json(orient="records") == \
+        prepared_anomalies.to_json(orient="records")
+    assert produced_data["survey"].dtype == "category"
+
+
 def test_strata_mismatch_detector():
     """
     Runs the strata_mismatch_detector function that is called by the wrangler.
@@ -240,6 +777,79 @@ def test_strata_mismatch_detector():
     assert_frame_equal(produced_data, prepared_data)
 
 
+def test_strata_mismatch_detector_anomalies():
+    """
+    Runs the strata_mismatch_detector function over two periods where one reference
+    has changed strata.
+    :param None
+    :return Test Pass/Fail
+    """
+    method_data = pd.DataFrame({
+        "responder_id": [1, 2, 1, 2, 3],
+        "period": [201806, 201806, 201809, 201809, 201809],
+        "strata": ["B1", "C", "A", "C", "E"]
+    })
+
+    produced_data, anomalies = lambda_method_function.strata_mismatch_detector(
+        method_data,
+        "201809", "period",
+        "responder_id", "strata",
+        "good_strata",
+        "current_period",
+        "previous_period",
+        "current_strata",
+        "previous_strata")
+
+    prepared_data = method_data.assign(strata=["A", "C", "A", "C", "E"])
+    prepared_anomalies = pd.DataFrame({
+        "responder_id": [1],
+        "current_strata": ["A"],
+        "current_period": [201809],
+        "previous_strata": ["B1"],
+        "previous_period": [201806]
+    })
+
+    assert_frame_equal(produced_data, prepared_data)
+    assert_frame_equal(anomalies, prepared_anomalies)
+
+
+@pytest.mark.parametrize("references", [
+    [1, 2, 3, 4, 5, 1, 2, 3, 4, 6],
+    ["a", "b", "c", "d", "e", "a", "b", "c", "d", "f"]
+])
+def test_strata_lookup_detector(references):
+    """
+    Checks the current period against a strata lookup of the previous period gives the
+    same anomalies as strata_mismatch_detector does with the previous period's data.
+    :param references - References of the previous then the current period's rows.
+    :return Test Pass/Fail
+    """
+    method_data = pd.DataFrame({
+        "responder_id": references,
+        "period": [201806] * 5 + [201809] * 5,
+        "strata": ["B1", "C", "E", "M", "A", "A", "C", "D", "M", "E"]
+    })
+    previous_data = method_data[method_data["period"] == 201806]
+    current_data = method_data[method_data["period"] == 201809]
+    # The new reference's strata from an earlier period isn't compared with, as
+    # mismatch detection only compares with the previous period.
+    strata_lookup = lambda_method_function.update_strata_lookup(
+        lambda_method_function.update_strata_lookup(
+            None, pd.Series(references[-1:]), pd.Series(["B2"]), 201803),
+        previous_data["responder_id"], previous_data["strata"], 201806)
+
+    mismatch_arguments = ("201809", "period", "responder_id", "strata")
+    anomaly_columns = ("current_period", "previous_period", "current_strata",
+                       "previous_strata")
+    _, prepared_anomalies = lambda_method_function.strata_mismatch_detector(
+        method_data, *mismatch_arguments, "good_strata", *anomaly_columns)
+    produced_anomalies = lambda_method_function.strata_lookup_detector(
+        current_data, *mismatch_arguments, strata_lookup, *anomaly_columns)
+
+    assert len(prepared_anomalies) == 2
+    assert_frame_equal(produced_anomalies, prepared_anomalies)
+
+
 @mock_s3
 def test_wrangler_success_passed():
     """
@@ -339,3 +949,1275 @@ def test_wrangler_success_returned(mock_s3_put):
 
     assert output
     assert_frame_equal(produced_data, prepared_data)
+
+
+@mock_s3
+@mock.patch('strata_period_wrangler.aws_functions.save_to_s3')
+@mock.patch('strata_period_wrangler.aws_functions.read_dataframe_from_s3')
+def test_wrangler_success_by_reference(mock_s3_get, mock_s3_put):
+    """
+    Runs the wrangler function passing the data to the method by s3 reference.
+    :param mock_s3_get - Replacement Function For The Data Retrieval AWS Functionality.
+    :param mock_s3_put - Replacement Function For The Data Saving AWS Functionality.
+    :return Test Pass/Fail
+    """
+    with mock.patch.dict(lambda_wrangler_function.os.environ,
+                         wrangler_environment_variables):
+        with mock.patch.dict(lambda_wrangler_function.os.environ,
+                             {"pass_data_by_reference": "True"}):
+            with mock.patch("strata_period_wrangler.boto3.client") as mock_client:
+                mock_client_object = mock.Mock()
+                mock_client.return_value = mock_client_object
+
+                mock_client_object.invoke.return_value.get.return_value.read \
+                    .return_value.decode.return_value = json.dumps({
+                     "out_file_name": "test_wrangler_output.json",
+                     "success": True,
+                     "anomaly_count": 0
+                    })
+
+                output = lambda_wrangler_function.lambda_handler(
+                    wrangler_runtime_variables, test_generic_library.context_object
+                )
+
+    payload = json.loads(mock_client_object.invoke.call_args[1]["Payload"])
+
+    assert output
+    assert "data" not in payload["RuntimeVariables"]
+    assert payload["RuntimeVariables"]["in_file_name"] == "test_wrangler_input"
+    assert payload["RuntimeVariables"]["bucket_name"] == "test_bucket"
+    mock_s3_get.assert_not_called()
+    mock_s3_put.assert_not_called()
+
+
+@mock_s3
+@mock.patch('strata_period_wrangler.aws_functions.save_to_s3',
+            side_effect=test_generic_library.replacement_save_to_s3)
+def test_wrangler_success_local(mock_s3_put):
+    """
+    Runs the wrangler function with the method run locally rather than invoked.
+    :param mock_s3_put - Replacement Function For The Data Saveing AWS Functionality.
+    :return Test Pass/Fail
+    """
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    client = test_generic_library.create_bucket(bucket_name)
+
+    file_list = ["test_wrangler_input.json"]
+
+    test_generic_library.upload_files(client, bucket_name, file_list)
+
+    with mock.patch.dict(lambda_wrangler_function.os.environ,
+                         wrangler_environment_variables):
+        with mock.patch.dict(lambda_wrangler_function.os.environ,
+                             {"method_invocation": "local",
+                              "strata_column": "strata",
+                              "value_column": "Q608_total"}):
+            with mock.patch("strata_period_wrangler.boto3.client") as mock_client:
+                mock_client_object = mock.Mock()
+                mock_client.return_value = mock_client_object
+
+                output = lambda_wrangler_function.lambda_handler(
+                    wrangler_runtime_variables, test_generic_library.context_object
+                )
+
+    with open("tests/fixtures/test_wrangler_prepared_output.json", "r") as file_3:
+        test_data_prepared = file_3.read()
+    prepared_data = pd.DataFrame(json.loads(test_data_prepared)).sort_index(axis=1)
+
+    with open("tests/fixtures/" +
+              wrangler_runtime_variables["RuntimeVariables"]["out_file_name"],
+              "r") as file_4:
+        test_data_produced = file_4.read()
+    produced_data = pd.DataFrame(json.loads(test_data_produced)).sort_index(axis=1)
+
+    assert output
+    mock_client_object.invoke.assert_not_called()
+    assert_frame_equal(produced_data, prepared_data)
+
+
+@mock_s3
+@mock.patch('strata_period_wrangler.aws_functions.save_to_s3')
+def test_wrangler_success_sharded(mock_s3_put):
+    """
+    Runs the wrangler function with the data split into shards and checks the output
+    matches invoking the method once.
+    :param mock_s3_put - Replacement Function For The Data Saving AWS Functionality.
+    :return Test Pass/Fail
+    """
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    client = test_generic_library.create_bucket(bucket_name)
+
+    file_list = ["test_wrangler_input.json"]
+
+    test_generic_library.upload_files(client, bucket_name, file_list)
+
+    method_invoke = InProcessMethod()
+
+    saved_output = {}
+    for shard_count in ["1", "3"]:
+        mock_s3_put.reset_mock()
+        strata_common.boto3_clients.clear()
+        with mock.patch.dict(lambda_wrangler_function.os.environ,
+                             wrangler_environment_variables):
+            with mock.patch.dict(lambda_wrangler_function.os.environ,
+                                 {"shard_count": shard_count}):
+                with mock.patch("strata_period_wrangler.boto3.client") as mock_client:
+                    mock_client_object = mock.Mock()
+                    mock_client.return_value = mock_client_object
+                    mock_client_object.invoke.side_effect = method_invoke
+
+                    output = lambda_wrangler_function.lambda_handler(
+                        wrangler_runtime_variables, test_generic_library.context_object
+                    )
+
+        assert output
+        saved_output[shard_count] = mock_s3_put.call_args_list
+
+    assert mock_client_object.invoke.call_count > 1
+    assert saved_output["3"] == saved_output["1"]
+
+
+def test_load_environment_reuses_validated_variables():
+    """
+    Loads the method's environment variables twice and checks the validated result is
+    reused, then changes a declared variable and checks it is validated again.
+    :param None
+    :return Test Pass/Fail
+    """
+    environment = dict(method_environment_variables)
+    first = strata_common.load_environment(
+        lambda_method_function.EnvironmentSchema, environment)
+    second = strata_common.load_environment(
+        lambda_method_function.EnvironmentSchema, environment)
+    assert first is second
+
+    environment["value_column"] = "Q609_total"
+    third = strata_common.load_environment(
+        lambda_method_function.EnvironmentSchema, environment)
+    assert third is not first
+    assert third["value_column"] == "Q609_total"
+
+
+@pytest.mark.parametrize("changes", [
+    {},
+    {"unknown": "ignored"},
+    {"data": 5},
+    {"data": None},
+    {"data": "[]", "strata_lookup_key": "strata_lookup/BMI_SG.npz"},
+    {"current_period": None},
+    {"data_encoding": "xml"}
+])
+def test_load_runtime_matches_schema(changes):
+    """
+    Loads the method's runtime variables with load_runtime and checks it gives the
+    same result, or the same error, as loading them with the schema, passing the data
+    through as is.
+    :param changes: Runtime variables to change from the method's.
+    :return Test Pass/Fail
+    """
+    runtime_variables = dict(method_runtime_variables["RuntimeVariables"],
+                             data="[]" * 100000)
+    runtime_variables.update(changes)
+    schema = strata_common.get_schema(lambda_method_function.RuntimeSchema)
+    try:
+        expected = schema.load(runtime_variables)
+    except ValueError as e:
+        with pytest.raises(ValueError) as exc_info:
+            strata_common.load_runtime(lambda_method_function.RuntimeSchema,
+                                       runtime_variables)
+        assert str(exc_info.value) == str(e)
+    else:
+        produced = strata_common.load_runtime(
+            lambda_method_function.RuntimeSchema, runtime_variables)
+        assert produced == expected
+        assert produced["data"] is runtime_variables["data"]
+
+
+def test_get_boto3_client_is_created_once():
+    """
+    Gets the same boto3 client twice and checks it is only created the first time.
+    :param None
+    :return Test Pass/Fail
+    """
+    factory = mock.Mock()
+    first = strata_common.get_boto3_client("lambda", factory)
+    second = strata_common.get_boto3_client("lambda", factory)
+    assert first is second
+    factory.assert_called_once_with("lambda", region_name="eu-west-2")
+
+
+def test_wrangler_import_leaves_out_method():
+    """
+    Imports the wrangler in a new interpreter and checks the method module isn't
+    imported with it.
+    :param None
+    :return Test Pass/Fail
+    """
+    completed = subprocess.run(
+        [sys.executable, "-c",
+         "import sys, strata_period_wrangler; "
+         "print('strata_period_method' in sys.modules)"],
+        stdout=subprocess.PIPE, universal_newlines=True, check=True)
+
+    assert completed.stdout.strip() == "False"
+
+
+def test_stage_metrics_emits_embedded_metric_format(capsys):
+    """
+    Times a stage with metrics enabled and checks the record written to stdout is in
+    the Embedded Metric Format.
+    :param capsys: Pytest fixture capturing stdout.
+    :return Test Pass/Fail
+    """
+    metrics = strata_metrics.StageMetrics("Strata - Method", "bob", enabled=True)
+    with metrics.stage("decode", payload_bytes=120) as stage:
+        stage["rows"] = 3
+
+    record = json.loads(capsys.readouterr().out)
+    cloudwatch_metrics = record["_aws"]["CloudWatchMetrics"][0]
+    assert cloudwatch_metrics["Dimensions"] == [["Module", "Stage"]]
+    assert {metric["Name"] for metric in cloudwatch_metrics["Metrics"]} <= \
+        {"Duration", "Rows", "PayloadBytes", "RssDelta"}
+    assert record["Module"] == "Strata - Method"
+    assert record["Stage"] == "decode"
+    assert record["Rows"] == 3
+    assert record["PayloadBytes"] == 120
+    assert record["Duration"] >= 0
+
+
+def test_stage_metrics_disabled(capsys):
+    """
+    Times a stage with metrics disabled and checks nothing is written to stdout.
+    :param capsys: Pytest fixture capturing stdout.
+    :return Test Pass/Fail
+    """
+    metrics = strata_metrics.StageMetrics("Strata - Method", "bob")
+    with metrics.stage("decode") as stage:
+        stage["rows"] = 3
+
+    assert capsys.readouterr().out == ""
+
+
+def test_method_emits_stage_metrics(capsys):
+    """
+    Runs the method function with emit_metrics set and checks a record is written for
+    each of its stages.
+    :param capsys: Pytest fixture capturing stdout.
+    :return Test Pass/Fail
+    """
+    with open("tests/fixtures/test_method_input.json", "r") as file_1:
+        test_data = file_1.read()
+    runtime_variables = {"RuntimeVariables": dict(
+        method_runtime_variables["RuntimeVariables"], data=test_data)}
+
+    with mock.patch.dict(lambda_method_function.os.environ,
+                         dict(method_environment_variables, emit_metrics="true")):
+        output = lambda_method_function.lambda_handler(
+            runtime_variables, test_generic_library.context_object)
+
+    assert output["success"]
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()
+               if line.startswith('{"_aws"')]
+    assert [record["Stage"] for record in records] == \
+        ["decode", "classify", "mismatch_detection", "encode"]
+    assert records[0]["Rows"] == len(json.loads(test_data))
+
+
+@mock_s3
+def test_wrangler_success_incremental():
+    """
+    Runs the wrangler function incrementally, first with an empty strata index and then
+    with the index the first run stored, and checks the output matches a full run.
+    :param None
+    :return Test Pass/Fail
+    """
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    client = test_generic_library.create_bucket(bucket_name)
+
+    file_list = ["test_wrangler_input.json"]
+
+    test_generic_library.upload_files(client, bucket_name, file_list)
+
+    method_invoke = InProcessMethod()
+
+    saved_output = []
+    for incremental in ["false", "true", "true"]:
+        with mock.patch.dict(lambda_wrangler_function.os.environ,
+                             wrangler_environment_variables):
+            with mock.patch.dict(lambda_wrangler_function.os.environ,
+                                 {"incremental": incremental}):
+                with mock.patch("strata_period_wrangler.boto3.client") as mock_client:
+                    mock_client_object = mock.Mock()
+                    mock_client.return_value = mock_client_object
+                    mock_client_object.invoke.side_effect = method_invoke
+                    mock_client_object.get_paginator.side_effect = \
+                        client.get_paginator
+
+                    output = lambda_wrangler_function.lambda_handler(
+                        wrangler_runtime_variables, test_generic_library.context_object
+                    )
+
+        assert output
+        saved_output.append(client.get_object(
+            Bucket=bucket_name,
+            Key=wrangler_runtime_variables["RuntimeVariables"]["out_file_name"])
+            ["Body"].read())
+        strata_common.boto3_clients.clear()
+
+    with open("tests/fixtures/test_wrangler_input.json", "r") as file_1:
+        input_data = json.loads(file_1.read())
+    current_period = int(wrangler_runtime_variables["RuntimeVariables"]["period"])
+    sent_data = [json.loads(payload["RuntimeVariables"]["data"])
+                 for payload in method_invoke.payloads]
+
+    assert saved_output[1] == saved_output[0]
+    assert saved_output[2] == saved_output[0]
+    # With nothing indexed every period is classified, after that only the current.
+    assert len(sent_data[1]) == len(input_data)
+    assert [row["period"] for row in sent_data[2]] == \
+        [row["period"] for row in input_data if row["period"] == current_period]
+
+
+@mock_s3
+def test_wrangler_incremental_failure_keeps_index():
+    """
+    Runs the wrangler function incrementally with the sns message failing, and checks
+    the strata index is only saved by the next run, which succeeds.
+    :param None
+    :return Test Pass/Fail
+    """
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    client = test_generic_library.create_bucket(bucket_name)
+    test_generic_library.upload_files(client, bucket_name, ["test_wrangler_input.json"])
+    index_prefix = "strata_index/" + \
+        wrangler_runtime_variables["RuntimeVariables"]["survey"] + "/"
+
+    method_invoke = InProcessMethod()
+
+    for sns_error in [Exception("sns is down"), None]:
+        with mock.patch.dict(lambda_wrangler_function.os.environ,
+                             dict(wrangler_environment_variables, incremental="true")):
+            with mock.patch("strata_period_wrangler.boto3.client") as mock_client, \
+                    mock.patch("strata_period_wrangler.aws_functions."
+                               "send_sns_message_with_anomalies",
+                               side_effect=sns_error):
+                mock_client_object = mock.Mock()
+                mock_client.return_value = mock_client_object
+                mock_client_object.invoke.side_effect = method_invoke
+                mock_client_object.get_paginator.side_effect = client.get_paginator
+                mock_client_object.get_object.side_effect = client.get_object
+
+                if sns_error is None:
+                    lambda_wrangler_function.lambda_handler(
+                        wrangler_runtime_variables, test_generic_library.context_object)
+                else:
+                    with pytest.raises(exception_classes.LambdaFailure):
+                        lambda_wrangler_function.lambda_handler(
+                            wrangler_runtime_variables,
+                            test_generic_library.context_object)
+                    assert "Contents" not in client.list_objects_v2(
+                        Bucket=bucket_name, Prefix=index_prefix)
+        strata_common.boto3_clients.clear()
+
+    with open("tests/fixtures/test_wrangler_input.json", "r") as file_1:
+        periods = {row["period"] for row in json.loads(file_1.read())}
+    assert lambda_wrangler_function.list_strata_index_periods(
+        bucket_name, index_prefix) == periods
+    assert {lambda_wrangler_function.strata_index_key(index_prefix, period)
+            for period in periods} == {
+        stored_object["Key"] for stored_object in client.list_objects_v2(
+            Bucket=bucket_name, Prefix=index_prefix)["Contents"]}
+
+
+@mock_s3
+def test_strata_index_round_trip():
+    """
+    Saves a strata index for two periods and checks each period reads back from the
+    key it was saved under.
+    :param None
+    :return Test Pass/Fail
+    """
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    test_generic_library.create_bucket(bucket_name)
+    index_data = pd.DataFrame({"period": [201806, 201809, 201809],
+                               "responder_id": [1, 1, 2],
+                               "strata": ["E", "D", "M"]})
+
+    lambda_wrangler_function.save_strata_index(
+        bucket_name, "strata_index/BMI_SG/", index_data, "period", "responder_id",
+        "strata")
+
+    assert lambda_wrangler_function.list_strata_index_periods(
+        bucket_name, "strata_index/BMI_SG/") == {201806, 201809}
+    for period, period_data in index_data.groupby("period"):
+        produced_data = lambda_wrangler_function.read_strata_index(
+            bucket_name, lambda_wrangler_function.strata_index_key(
+                "strata_index/BMI_SG/", period))
+        assert_frame_equal(produced_data,
+                           period_data[["responder_id", "strata"]]
+                           .reset_index(drop=True))
+
+
+@mock_s3
+def test_wrangler_result_cache():
+    """
+    Runs the wrangler function three times with the result cache on, checks the rerun
+    is served from the cache without invoking the method, and that bypass_cache
+    invokes it again.
+    :param None
+    :return Test Pass/Fail
+    """
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    client = test_generic_library.create_bucket(bucket_name)
+
+    file_list = ["test_wrangler_input.json"]
+
+    test_generic_library.upload_files(client, bucket_name, file_list)
+
+    method_invoke = InProcessMethod()
+
+    mock_lambda = mock.Mock()
+    mock_lambda.invoke.side_effect = method_invoke
+    out_file_name = wrangler_runtime_variables["RuntimeVariables"]["out_file_name"]
+
+    saved_output = []
+    for bypass_cache in [False, False, True]:
+        runtime_variables = {"RuntimeVariables": dict(
+            wrangler_runtime_variables["RuntimeVariables"], bypass_cache=bypass_cache)}
+        with mock.patch.dict(lambda_wrangler_function.os.environ,
+                             dict(wrangler_environment_variables, result_cache="true")):
+            with mock.patch("strata_period_wrangler.boto3.client") as mock_client:
+                mock_client.side_effect = lambda service_name, **kwargs: \
+                    mock_lambda if service_name == "lambda" else client
+
+                output = lambda_wrangler_function.lambda_handler(
+                    runtime_variables, test_generic_library.context_object)
+
+        assert output
+        saved_output.append(
+            client.get_object(Bucket=bucket_name, Key=out_file_name)["Body"].read())
+        client.delete_object(Bucket=bucket_name, Key=out_file_name)
+        strata_common.boto3_clients.clear()
+
+    assert mock_lambda.invoke.call_count == 2
+    assert saved_output[1] == saved_output[0]
+    assert saved_output[2] == saved_output[0]
+
+
+@mock_s3
+def test_wrangler_result_cache_output_encoding():
+    """
+    Runs the wrangler function with the result cache on, first with gzip_output and
+    then without, and checks the second run invokes the method instead of restoring the
+    gzipped output.
+    :param None
+    :return Test Pass/Fail
+    """
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    client = test_generic_library.create_bucket(bucket_name)
+
+    file_list = ["test_wrangler_input.json"]
+
+    test_generic_library.upload_files(client, bucket_name, file_list)
+
+    mock_lambda = mock.Mock()
+    mock_lambda.invoke.side_effect = InProcessMethod()
+    out_file_name = wrangler_runtime_variables["RuntimeVariables"]["out_file_name"]
+
+    saved_output = []
+    for gzip_output in ["true", "false"]:
+        with mock.patch.dict(lambda_wrangler_function.os.environ,
+                             dict(wrangler_environment_variables, result_cache="true",
+                                  gzip_output=gzip_output)):
+            with mock.patch("strata_period_wrangler.boto3.client") as mock_client:
+                mock_client.side_effect = lambda service_name, **kwargs: \
+                    mock_lambda if service_name == "lambda" else client
+
+                output = lambda_wrangler_function.lambda_handler(
+                    wrangler_runtime_variables, test_generic_library.context_object)
+
+        assert output
+        saved_output.append(
+            client.get_object(Bucket=bucket_name, Key=out_file_name)["Body"].read())
+        strata_common.boto3_clients.clear()
+
+    assert mock_lambda.invoke.call_count == 2
+    assert gzip.decompress(saved_output[0]) == saved_output[1]
+
+
+@mock_s3
+def test_read_cached_result_expires():
+    """
+    Reads a cached result within and past its ttl, and checks the expired result is
+    deleted instead of being returned.
+    :param None
+    :return Test Pass/Fail
+    """
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    client = test_generic_library.create_bucket(bucket_name)
+    client.put_object(Bucket=bucket_name, Key="strata_cache/key.json",
+                      Body=json.dumps({"created": 0, "have_anomalies": False}))
+
+    with mock.patch("strata_period_wrangler.boto3.client", return_value=client):
+        assert lambda_wrangler_function.read_cached_result(
+            bucket_name, "strata_cache/", "key", 10 ** 12) is not None
+        assert lambda_wrangler_function.read_cached_result(
+            bucket_name, "strata_cache/", "key", 60) is None
+
+    assert "Contents" not in client.list_objects_v2(Bucket=bucket_name,
+                                                    Prefix="strata_cache/")
+
+
+@mock_s3
+@mock.patch('strata_period_wrangler.aws_functions.save_to_s3')
+def test_wrangler_success_projected(mock_s3_put):
+    """
+    Runs the wrangler function sending only the columns the method uses and checks the
+    output matches sending all of the data.
+    :param mock_s3_put - Replacement Function For The Data Saving AWS Functionality.
+    :return Test Pass/Fail
+    """
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    client = test_generic_library.create_bucket(bucket_name)
+
+    file_list = ["test_wrangler_input.json"]
+
+    test_generic_library.upload_files(client, bucket_name, file_list)
+
+    method_invoke = InProcessMethod()
+
+    saved_output = {}
+    for projected in ["false", "true"]:
+        mock_s3_put.reset_mock()
+        with mock.patch.dict(lambda_wrangler_function.os.environ,
+                             dict(wrangler_environment_variables, projected=projected,
+                                  value_column="Q608_total")):
+            with mock.patch("strata_period_wrangler.boto3.client") as mock_client:
+                mock_client_object = mock.Mock()
+                mock_client.return_value = mock_client_object
+                mock_client_object.invoke.side_effect = method_invoke
+
+                output = lambda_wrangler_function.lambda_handler(
+                    wrangler_runtime_variables, test_generic_library.context_object
+                )
+
+        assert output
+        saved_output[projected] = mock_s3_put.call_args_list
+        strata_common.boto3_clients.clear()
+
+    sent_data = json.loads(method_invoke.payloads[1]["RuntimeVariables"]["data"])
+    assert sorted(sent_data[0]) == ["Q608_total", "period", "region", "responder_id",
+                                    "row_position", "survey"]
+    assert saved_output["true"] == saved_output["false"]
+
+
+@mock_s3
+@mock.patch('strata_period_wrangler.aws_functions.save_to_s3')
+def test_wrangler_success_concurrent_io(mock_s3_put):
+    """
+    Runs the wrangler function with concurrent s3 and notification calls and checks
+    it saves the same output and sends the same statuses as without.
+    :param mock_s3_put - Replacement Function For The Data Saving AWS Functionality.
+    :return Test Pass/Fail
+    """
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    client = test_generic_library.create_bucket(bucket_name)
+
+    file_list = ["test_wrangler_input.json"]
+
+    test_generic_library.upload_files(client, bucket_name, file_list)
+
+    with open("tests/fixtures/test_method_prepared_output.json", "r") as file_2:
+        test_data_out = file_2.read()
+
+    calls = {}
+    for concurrent_io in ["false", "true"]:
+        mock_s3_put.reset_mock()
+        with mock.patch.dict(lambda_wrangler_function.os.environ,
+                             dict(wrangler_environment_variables,
+                                  concurrent_io=concurrent_io)):
+            with mock.patch("strata_period_wrangler.boto3.client") as mock_client, \
+                    mock.patch("strata_period_wrangler.aws_functions."
+                               "send_bpm_status") as mock_bpm, \
+                    mock.patch("strata_period_wrangler.aws_functions."
+                               "send_sns_message_with_anomalies") as mock_sns:
+                mock_client_object = mock.Mock()
+                mock_client.return_value = mock_client_object
+                mock_client_object.invoke.return_value.get.return_value \
+                    .read.return_value.decode.return_value = json.dumps({
+                        "data": test_data_out,
+                        "success": True,
+                        "anomalies": test_data_out
+                    })
+
+                output = lambda_wrangler_function.lambda_handler(
+                    wrangler_runtime_variables, test_generic_library.context_object
+                )
+
+        assert output
+        calls[concurrent_io] = (
+            sorted(mock_s3_put.call_args_list, key=lambda call: call[0][1]),
+            mock_bpm.call_args_list, mock_sns.call_args_list)
+        strata_common.boto3_clients.clear()
+
+    assert len(calls["true"][0]) == 2
+    assert calls["true"] == calls["false"]
+
+
+def test_run_io_raises_first_error():
+    """
+    Checks concurrent calls are all made and the error of the first failed call, in
+    the order given, is raised.
+    :param None
+    :return Test Pass/Fail
+    """
+    made = []
+
+    def succeed(name):
+        made.append(name)
+        return name
+
+    def fail(name):
+        made.append(name)
+        raise ValueError(name)
+
+    assert lambda_wrangler_function.run_io(
+        [(succeed, ("a",)), (succeed, ("b",))], True) == ["a", "b"]
+
+    with pytest.raises(ValueError, match="first"):
+        lambda_wrangler_function.run_io(
+            [(succeed, ("c",)), (fail, ("first",)), (fail, ("second",))], True)
+
+    assert sorted(made) == ["a", "b", "c", "first", "second"]
+
+
+@pytest.mark.parametrize("compress", [False, True])
+@mock_s3
+def test_save_records_to_s3(compress):
+    """
+    Saves data larger than a part with a multipart upload, the same data as batches,
+    and data smaller than a part with a single put, and checks each gives the same
+    json as DataFrame.to_json.
+    :param compress - Whether to gzip the data.
+    :return Test Pass/Fail
+    """
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    test_generic_library.create_bucket(bucket_name)
+    large_data = pd.DataFrame({
+        "responder_id": np.arange(150000) + 49900000000,
+        "period": 201809,
+        "Q608_total": np.arange(150000) * 7 % 300000,
+        "strata": np.where(np.arange(150000) % 3 == 0, "A", "E"),
+        "region_name": "Yorkshire and The Humber"
+    })
+    small_data = large_data.head(3)
+
+    # Newer botocore sends bodies over 1MB with aws-chunked encoding, which moto
+    # doesn't decode unless checksums are only sent when required.
+    batches = [large_data.iloc[:70000], large_data.iloc[:0], large_data.iloc[70000:]]
+
+    with mock.patch.dict(strata_common.os.environ,
+                         {"AWS_REQUEST_CHECKSUM_CALCULATION": "when_required"}):
+        client = boto3.client("s3", region_name="eu-west-2")
+        for file_name, data, expected in [
+                ("large.json", large_data, large_data.to_json(orient="records")),
+                ("batches.json", iter(batches), large_data.to_json(orient="records")),
+                ("small.json", small_data, small_data.to_json(orient="records")),
+                ("text.json", small_data.to_json(orient="records"),
+                 small_data.to_json(orient="records"))]:
+            strata_common.save_records_to_s3(
+                bucket_name, file_name, data, part_size=5242880, compress=compress,
+                rows_per_chunk=10000)
+
+            saved = client.get_object(Bucket=bucket_name, Key=file_name)
+            body = saved["Body"].read()
+            if compress:
+                assert saved["ContentEncoding"] == "gzip"
+                body = gzip.decompress(body)
+            assert body == expected.encode("UTF-8")
+
+            # Multipart uploads have the number of parts at the end of their ETag.
+            assert ("-" in saved["ETag"]) == (
+                file_name in ["large.json", "batches.json"] and not compress)
+
+
+@mock_s3
+def test_save_records_to_s3_aborts():
+    """
+    Checks a multipart upload that fails part way is aborted, leaving no object.
+    :param None
+    :return Test Pass/Fail
+    """
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    client = test_generic_library.create_bucket(bucket_name)
+
+    def failing_pieces(data, rows_per_chunk):
+        yield b"[" + b" " * 5242880
+        raise ValueError("Encoding failed.")
+
+    with mock.patch.dict(strata_common.os.environ,
+                         {"AWS_REQUEST_CHECKSUM_CALCULATION": "when_required"}), \
+            mock.patch("strata_common.iter_json_record_bytes",
+                       side_effect=failing_pieces):
+        with pytest.raises(ValueError, match="Encoding failed."):
+            strata_common.save_records_to_s3(
+                bucket_name, "failed.json", pd.DataFrame(), part_size=5242880)
+
+    assert "Uploads" not in client.list_multipart_uploads(Bucket=bucket_name)
+    assert "Contents" not in client.list_objects_v2(Bucket=bucket_name,
+                                                    Prefix="failed.json")
+
+
+@mock_s3
+@mock.patch('strata_period_wrangler.aws_functions.save_to_s3',
+            side_effect=test_generic_library.replacement_save_to_s3)
+def test_wrangler_success_stream_output(mock_s3_put):
+    """
+    Runs the wrangler function with the method run locally, streaming the output to s3,
+    and checks it saves the same json as without.
+    :param mock_s3_put - Replacement Function For The Data Saving AWS Functionality.
+    :return Test Pass/Fail
+    """
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    client = test_generic_library.create_bucket(bucket_name)
+
+    file_list = ["test_wrangler_input.json"]
+
+    test_generic_library.upload_files(client, bucket_name, file_list)
+
+    out_file_name = wrangler_runtime_variables["RuntimeVariables"]["out_file_name"]
+    with mock.patch.dict(lambda_wrangler_function.os.environ,
+                         dict(wrangler_environment_variables, method_invocation="local",
+                              strata_column="strata", value_column="Q608_total")):
+        lambda_wrangler_function.lambda_handler(
+            wrangler_runtime_variables, test_generic_library.context_object)
+
+        with open("tests/fixtures/" + out_file_name, "rb") as file_1:
+            saved_output = file_1.read()
+
+        mock_s3_put.reset_mock()
+        with mock.patch.dict(lambda_wrangler_function.os.environ,
+                             {"stream_output": "true"}):
+            output = lambda_wrangler_function.lambda_handler(
+                wrangler_runtime_variables, test_generic_library.context_object)
+
+    streamed_output = client.get_object(Bucket=bucket_name,
+                                        Key=out_file_name)["Body"].read()
+
+    assert output
+    assert out_file_name not in [call[0][1] for call in mock_s3_put.call_args_list]
+    assert streamed_output == saved_output
+
+
+@mock_s3
+@mock.patch('strata_period_wrangler.aws_functions.save_to_s3',
+            side_effect=test_generic_library.replacement_save_to_s3)
+def test_wrangler_anomaly_store(mock_s3_put):
+    """
+    Runs the wrangler function with the anomaly store and checks the stored anomalies
+    and index match the anomalies report, and that the index gives have_anomalies.
+    :param mock_s3_put - Replacement Function For The Data Saving AWS Functionality.
+    :return Test Pass/Fail
+    """
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    client = test_generic_library.create_bucket(bucket_name)
+
+    file_list = ["test_wrangler_input.json"]
+
+    test_generic_library.upload_files(client, bucket_name, file_list)
+
+    with open("tests/fixtures/test_method_prepared_output.json", "r") as file_1:
+        test_data_out = file_1.read()
+
+    report = pd.DataFrame({
+        "responder_id": [49900001, 49900002, 49900003],
+        "current_strata": ["A", "A", "C"],
+        "current_period": [201809, 201809, 201809],
+        "previous_strata": ["B", "B", "A"],
+        "previous_period": [201806, 201806, 201806]
+    })
+
+    with mock.patch.dict(lambda_wrangler_function.os.environ,
+                         dict(wrangler_environment_variables, anomaly_store="true")):
+        with mock.patch("strata_period_wrangler.boto3.client") as mock_client, \
+                mock.patch("strata_period_wrangler.aws_functions."
+                           "send_sns_message_with_anomalies") as mock_sns:
+            mock_lambda = mock.Mock()
+            mock_client.side_effect = lambda service_name, **kwargs: \
+                mock_lambda if service_name == "lambda" else client
+            mock_lambda.invoke.return_value.get.return_value.read.return_value \
+                .decode.return_value = json.dumps({
+                    "data": test_data_out,
+                    "success": True,
+                    "anomalies": report.to_json(orient="records")
+                })
+
+            output = lambda_wrangler_function.lambda_handler(
+                wrangler_runtime_variables, test_generic_library.context_object
+            )
+
+    partition = "strata_anomalies/survey=BMI_SG/period=201809/run_id=bob/"
+    index = json.loads(client.get_object(
+        Bucket=bucket_name, Key=partition + "index.json")["Body"].read())
+    stored = pd.read_parquet(io.BytesIO(client.get_object(
+        Bucket=bucket_name, Key=index["anomalies_key"])["Body"].read()))
+
+    assert output
+    assert index["anomaly_count"] == 3
+    assert index["transitions"] == {"B->A": 2, "A->C": 1}
+    assert_frame_equal(stored, report)
+    assert mock_sns.call_args[0][0] is True
+
+
+@mock_s3
+@mock.patch('strata_period_wrangler.aws_functions.save_to_s3')
+def test_wrangler_success_packed_response(mock_s3_put):
+    """
+    Runs the wrangler function with the method compressing its response and saving
+    its data to s3, and checks the output matches an inline response.
+    :param mock_s3_put - Replacement Function For The Data Saving AWS Functionality.
+    :return Test Pass/Fail
+    """
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    client = test_generic_library.create_bucket(bucket_name)
+
+    file_list = ["test_wrangler_input.json"]
+
+    test_generic_library.upload_files(client, bucket_name, file_list)
+
+    method_invoke = InProcessMethod(
+        save_to_s3=lambda bucket, key, data: client.put_object(Bucket=bucket, Key=key,
+                                                               Body=data))
+
+    saved_output = {}
+    for response_variables in [{}, {"response_compression": "gzip",
+                                    "response_spill_bytes": "0"}]:
+        mock_s3_put.reset_mock()
+        with mock.patch.dict(lambda_wrangler_function.os.environ,
+                             dict(wrangler_environment_variables,
+                                  **response_variables)):
+            with mock.patch("strata_period_wrangler.boto3.client") as mock_client:
+                mock_lambda = mock.Mock()
+                mock_client.side_effect = lambda service_name, **kwargs: \
+                    mock_lambda if service_name == "lambda" else client
+                mock_lambda.invoke.side_effect = method_invoke
+
+                output = lambda_wrangler_function.lambda_handler(
+                    wrangler_runtime_variables, test_generic_library.context_object
+                )
+
+        assert output
+        saved_output[bool(response_variables)] = mock_s3_put.call_args_list
+        strata_common.boto3_clients.clear()
+
+    assert "data_key" in method_invoke.responses[1]
+    assert saved_output[True] == saved_output[False]
+    assert "Contents" not in client.list_objects_v2(Bucket=bucket_name,
+                                                    Prefix="strata_spill/")
+
+
+@mock_s3
+@mock.patch('strata_period_wrangler.aws_functions.save_to_s3')
+def test_wrangler_success_strata_lookup(mock_s3_put):
+    """
+    Runs the wrangler function with the strata lookup, first for the previous period to
+    fill the lookup, then for the current period, and checks the current period's
+    output and anomalies match sending all of the data.
+    :param mock_s3_put - Replacement Function For The Data Saving AWS Functionality.
+    :return Test Pass/Fail
+    """
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    client = test_generic_library.create_bucket(bucket_name)
+
+    with open("tests/fixtures/test_wrangler_input.json", "r") as file_1:
+        current_data = pd.DataFrame(json.loads(file_1.read())) \
+            .drop_duplicates(subset="responder_id")
+    # Two references change strata, one leaves and one joins.
+    previous_data = current_data.assign(
+        period=201806, Q608_total=[3214, 250000, 1697, 50000, 130000])
+    previous_data.iloc[0, previous_data.columns.get_loc("responder_id")] = 49910391668
+    test_data = pd.concat([current_data, previous_data], ignore_index=True)
+    client.put_object(Bucket=bucket_name, Key="test_wrangler_input.json",
+                      Body=test_data.to_json(orient="records").encode("UTF-8"))
+
+    method_invoke = InProcessMethod()
+
+    saved_output = {}
+    for strata_lookup, period in [("false", "201809"), ("true", "201806"),
+                                  ("true", "201809")]:
+        mock_s3_put.reset_mock()
+        runtime_variables = {"RuntimeVariables": dict(
+            wrangler_runtime_variables["RuntimeVariables"], period=period)}
+        with mock.patch.dict(lambda_wrangler_function.os.environ,
+                             dict(wrangler_environment_variables,
+                                  strata_lookup=strata_lookup)):
+            with mock.patch("strata_period_wrangler.boto3.client") as mock_client:
+                mock_lambda = mock.Mock()
+                mock_client.side_effect = lambda service_name, **kwargs: \
+                    mock_lambda if service_name == "lambda" else client
+                mock_lambda.invoke.side_effect = method_invoke
+
+                output = lambda_wrangler_function.lambda_handler(
+                    runtime_variables, test_generic_library.context_object
+                )
+
+        assert output
+        saved_output[strata_lookup] = mock_s3_put.call_args_list
+        strata_common.boto3_clients.clear()
+
+    # Only the current period and the reference that left are sent.
+    sent_data = [payload["RuntimeVariables"] for payload in method_invoke.payloads]
+    assert "strata_lookup_key" not in sent_data[1]
+    assert sent_data[2]["strata_lookup_key"] == "strata_lookup/BMI_SG.npz"
+    assert len(json.loads(sent_data[2]["data"])) == 6
+    assert len(saved_output["true"]) == 2
+    assert saved_output["true"] == saved_output["false"]
+
+    strata_lookup = lambda_method_function.strata_lookup_cache[
+        (bucket_name, "strata_lookup/BMI_SG.npz")][1]
+    assert strata_lookup["period"] == 201809
+    assert len(strata_lookup["references"]) == 6
+
+
+@mock_s3
+def test_wrangler_strata_lookup_failure_keeps_lookup():
+    """
+    Runs the wrangler function with the strata lookup and the sns message failing, and
+    checks the lookup is only saved by the next run, which succeeds.
+    :param None
+    :return Test Pass/Fail
+    """
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    client = test_generic_library.create_bucket(bucket_name)
+    test_generic_library.upload_files(client, bucket_name, ["test_wrangler_input.json"])
+    lookup_key = "strata_lookup/" + \
+        wrangler_runtime_variables["RuntimeVariables"]["survey"] + ".npz"
+
+    method_invoke = InProcessMethod()
+
+    for sns_error in [Exception("sns is down"), None]:
+        with mock.patch.dict(lambda_wrangler_function.os.environ,
+                             dict(wrangler_environment_variables, strata_lookup="true")):
+            with mock.patch("strata_period_wrangler.boto3.client") as mock_client, \
+                    mock.patch("strata_period_wrangler.aws_functions."
+                               "send_sns_message_with_anomalies",
+                               side_effect=sns_error):
+                mock_lambda = mock.Mock()
+                mock_client.side_effect = lambda service_name, **kwargs: \
+                    mock_lambda if service_name == "lambda" else client
+                mock_lambda.invoke.side_effect = method_invoke
+
+                if sns_error is None:
+                    lambda_wrangler_function.lambda_handler(
+                        wrangler_runtime_variables, test_generic_library.context_object)
+                else:
+                    with pytest.raises(exception_classes.LambdaFailure):
+                        lambda_wrangler_function.lambda_handler(
+                            wrangler_runtime_variables,
+                            test_generic_library.context_object)
+                    assert "Contents" not in client.list_objects_v2(
+                        Bucket=bucket_name, Prefix=lookup_key)
+        strata_common.boto3_clients.clear()
+
+    strata_lookup = lambda_method_function.load_strata_lookup(bucket_name, lookup_key)
+    assert strata_lookup["period"] == \
+        int(wrangler_runtime_variables["RuntimeVariables"]["period"])
+
+
+@mock_s3
+def test_method_strata_lookup_missing():
+    """
+    Runs the method function with a strata_lookup_key that isn't in s3, and checks it
+    fails with an error naming the lookup.
+    :param None
+    :return Test Pass/Fail
+    """
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    test_generic_library.create_bucket(bucket_name)
+
+    with open("tests/fixtures/test_method_input.json", "r") as file_1:
+        test_data = file_1.read()
+    runtime_variables = {"RuntimeVariables": dict(
+        method_runtime_variables["RuntimeVariables"], bucket_name=bucket_name,
+        data=test_data, strata_lookup_key="strata_lookup/missing.npz")}
+
+    with mock.patch.dict(lambda_method_function.os.environ,
+                         method_environment_variables):
+        output = lambda_method_function.lambda_handler(
+            runtime_variables, test_generic_library.context_object)
+
+    assert not output["success"]
+    assert "Strata lookup strata_lookup/missing.npz not found" in output["error"]
+
+
+@mock_s3
+def test_wrangler_checkpoint_resumes():
+    """
+    Runs the wrangler function with checkpoints, failing to send the sns message the
+    first time, and checks the retry doesn't invoke the method or save the output again,
+    and that a retry of the finished run does nothing.
+    :param None
+    :return Test Pass/Fail
+    """
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    client = test_generic_library.create_bucket(bucket_name)
+
+    file_list = ["test_wrangler_input.json"]
+
+    test_generic_library.upload_files(client, bucket_name, file_list)
+
+    with open("tests/fixtures/test_method_prepared_output.json", "r") as file_1:
+        test_data_out = file_1.read()
+    anomalies = json.dumps([{"responder_id": 49910391670, "current_strata": "C",
+                             "current_period": 201809, "previous_strata": "D",
+                             "previous_period": 201806}])
+
+    with mock.patch.dict(lambda_wrangler_function.os.environ,
+                         dict(wrangler_environment_variables, checkpoint="true")):
+        with mock.patch("strata_period_wrangler.boto3.client") as mock_client, \
+                mock.patch("strata_period_wrangler.aws_functions.save_to_s3",
+                           wraps=lambda_wrangler_function.aws_functions.save_to_s3
+                           ) as mock_s3_put, \
+                mock.patch("strata_period_wrangler.aws_functions."
+                           "send_sns_message_with_anomalies",
+                           side_effect=[ValueError("SNS unavailable."), None]
+                           ) as mock_sns:
+            mock_lambda = mock.Mock()
+            mock_client.side_effect = lambda service_name, **kwargs: \
+                mock_lambda if service_name == "lambda" else client
+            mock_lambda.invoke.return_value.get.return_value.read.return_value \
+                .decode.return_value = json.dumps({
+                    "data": test_data_out,
+                    "success": True,
+                    "anomalies": anomalies
+                })
+
+            with pytest.raises(exception_classes.LambdaFailure) as exc_info:
+                lambda_wrangler_function.lambda_handler(
+                    wrangler_runtime_variables, test_generic_library.context_object)
+            for _ in range(2):
+                output = lambda_wrangler_function.lambda_handler(
+                    wrangler_runtime_variables, test_generic_library.context_object)
+
+    manifest = json.loads(client.get_object(
+        Bucket=bucket_name, Key="strata_checkpoints/bob.json")["Body"].read())
+    out_file_name = wrangler_runtime_variables["RuntimeVariables"]["out_file_name"]
+
+    assert "SNS unavailable." in str(exc_info.value)
+    assert output
+    assert mock_lambda.invoke.call_count == 1
+    assert mock_s3_put.call_count == 2
+    assert mock_sns.call_count == 2
+    assert sorted(manifest["stages"]) == ["anomalies", "invoke", "notify", "output"]
+    assert client.get_object(Bucket=bucket_name, Key=out_file_name)["Body"].read() \
+        .decode("UTF-8") == test_data_out
+    assert client.get_object(Bucket=bucket_name, Key="Strata_Anomalies")["Body"] \
+        .read().decode("UTF-8") == anomalies
+    assert "Contents" not in client.list_objects_v2(Bucket=bucket_name,
+                                                    Prefix="strata_checkpoints/bob/")
+
+
+def test_method_batch():
+    """
+    Runs the method's batch handler with two runs and an invalid one, and checks each
+    valid run matches running it alone.
+    :param None
+    :return Test Pass/Fail
+    """
+    with open("tests/fixtures/test_method_input.json", "r") as file_1:
+        test_data = file_1.read()
+    run = dict(method_runtime_variables["RuntimeVariables"], data=test_data)
+    invalid_run = dict(run, data=None)
+
+    with mock.patch.dict(lambda_method_function.os.environ,
+                         method_environment_variables):
+        prepared_output = lambda_method_function.lambda_handler(
+            {"RuntimeVariables": run}, test_generic_library.context_object)
+        output = lambda_method_function.batch_lambda_handler(
+            {"RuntimeVariables": {"run_id": "bob", "runs": [run, invalid_run, run]}},
+            test_generic_library.context_object)
+
+    assert not output["success"]
+    assert [result["success"] for result in output["results"]] == [True, False, True]
+    assert output["results"][0] == prepared_output
+    assert output["results"][2] == prepared_output
+
+
+@mock_s3
+def test_wrangler_batch():
+    """
+    Runs the wrangler's batch handler for three runs, two of which save to the same
+    file, with a method_batch_size of 2, and checks the runs are packed into batches
+    and their output saved.
+    :param None
+    :return Test Pass/Fail
+    """
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    client = test_generic_library.create_bucket(bucket_name)
+
+    file_list = ["test_wrangler_input.json"]
+
+    test_generic_library.upload_files(client, bucket_name, file_list)
+
+    method_invoke = InProcessMethod(lambda_method_function.batch_lambda_handler)
+
+    runs = [dict(wrangler_runtime_variables["RuntimeVariables"], run_id=run_id,
+                 out_file_name=out_file_name,
+                 anomalies_file_name=out_file_name + "_anomalies")
+            for run_id, out_file_name in [("run1", "output_1.json"),
+                                          ("run2", "output_2.json"),
+                                          ("run3", "output_1.json")]]
+
+    with mock.patch.dict(lambda_wrangler_function.os.environ,
+                         dict(wrangler_environment_variables,
+                              batch_method_name="strata_period_method_batch",
+                              method_batch_size="2")):
+        with mock.patch("strata_period_wrangler.boto3.client") as mock_client:
+            mock_client.side_effect = lambda service_name, **kwargs: \
+                mock.Mock(invoke=mock.Mock(side_effect=method_invoke)) \
+                if service_name == "lambda" else client
+            with mock.patch("strata_period_wrangler.aws_functions.send_bpm_status"), \
+                    mock.patch("strata_period_wrangler.aws_functions."
+                               "send_sns_message_with_anomalies") as mock_sns:
+                output = lambda_wrangler_function.batch_lambda_handler(
+                    {"Records": [{"body": json.dumps({"RuntimeVariables": run}),
+                                  "messageId": run["run_id"]}
+                                 for run in runs]},
+                    test_generic_library.context_object)
+
+    assert output["success"]
+    assert output["batchItemFailures"] == []
+    assert [result["run_id"] for result in output["results"]] == \
+        ["run1", "run2", "run3"]
+    assert [len(payload["RuntimeVariables"]["runs"])
+            for payload in method_invoke.payloads] == [2, 1]
+    assert mock_sns.call_count == 3
+
+    with open("tests/fixtures/test_wrangler_prepared_output.json", "r") as file_1:
+        prepared_data = pd.DataFrame(json.loads(file_1.read())).sort_index(axis=1)
+    for out_file_name in ["output_1.json", "output_2.json"]:
+        produced_data = pd.DataFrame(json.loads(client.get_object(
+            Bucket=bucket_name, Key=out_file_name)["Body"].read())).sort_index(axis=1)
+        assert_frame_equal(produced_data, prepared_data)
+
+
+@pytest.mark.parametrize("method_batch_size,batch_sizes", [
+    (None, [5]),
+    ("2", [2, 2, 1])
+])
+@mock_s3
+def test_wrangler_batch_default_anomalies_file(method_batch_size, batch_sizes):
+    """
+    Runs the wrangler's batch handler for five runs that all save their anomalies to
+    the default file, and checks they are packed by method_batch_size alone.
+    :param method_batch_size: Environment variable for the runs in a batch, if set.
+    :param batch_sizes: Number of runs expected in each batch.
+    :return Test Pass/Fail
+    """
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    client = test_generic_library.create_bucket(bucket_name)
+
+    file_list = ["test_wrangler_input.json"]
+
+    test_generic_library.upload_files(client, bucket_name, file_list)
+
+    method_invoke = InProcessMethod(lambda_method_function.batch_lambda_handler)
+
+    runs = [dict(wrangler_runtime_variables["RuntimeVariables"], run_id=f"run{number}",
+                 out_file_name=f"output_{number}.json")
+            for number in range(5)]
+    environment_variables = dict(wrangler_environment_variables,
+                                 batch_method_name="strata_period_method_batch")
+    if method_batch_size is not None:
+        environment_variables["method_batch_size"] = method_batch_size
+
+    with mock.patch.dict(lambda_wrangler_function.os.environ, environment_variables):
+        with mock.patch("strata_period_wrangler.boto3.client") as mock_client:
+            mock_client.side_effect = lambda service_name, **kwargs: \
+                mock.Mock(invoke=mock.Mock(side_effect=method_invoke)) \
+                if service_name == "lambda" else client
+            with mock.patch("strata_period_wrangler.aws_functions.send_bpm_status"), \
+                    mock.patch("strata_period_wrangler.aws_functions."
+                               "send_sns_message_with_anomalies"):
+                output = lambda_wrangler_function.batch_lambda_handler(
+                    {"Records": [{"body": json.dumps({"RuntimeVariables": run}),
+                                  "messageId": run["run_id"]}
+                                 for run in runs]},
+                    test_generic_library.context_object)
+
+    assert output["success"]
+    assert [len(payload["RuntimeVariables"]["runs"])
+            for payload in method_invoke.payloads] == batch_sizes
+    assert {run["anomalies_file_name"] for payload in method_invoke.payloads
+            for run in payload["RuntimeVariables"]["runs"]} == {"Strata_Anomalies"}
+
+
+@mock_s3
+def test_wrangler_batch_invoke_failure():
+    """
+    Runs the wrangler's batch handler twice for three runs in batches of two, with the
+    first invoke of each handler call timing out, and checks only the runs in that
+    batch fail, are reported to the queue, and that the Lambda client is reused.
+    :param None
+    :return Test Pass/Fail
+    """
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    client = test_generic_library.create_bucket(bucket_name)
+
+    file_list = ["test_wrangler_input.json"]
+
+    test_generic_library.upload_files(client, bucket_name, file_list)
+
+    method_invoke = InProcessMethod(lambda_method_function.batch_lambda_handler)
+    invoke_calls = []
+
+    def timing_out_invoke(**kwargs):
+        invoke_calls.append(kwargs)
+        if len(invoke_calls) % 2:
+            raise ReadTimeoutError(endpoint_url="lambda")
+        return method_invoke(**kwargs)
+
+    runs = [dict(wrangler_runtime_variables["RuntimeVariables"], run_id=run_id,
+                 out_file_name=out_file_name,
+                 anomalies_file_name=out_file_name + "_anomalies")
+            for run_id, out_file_name in [("run1", "output_1.json"),
+                                          ("run2", "output_2.json"),
+                                          ("run3", "output_1.json")]]
+    event = {"Records": [{"body": json.dumps({"RuntimeVariables": run}),
+                          "messageId": "message-" + run["run_id"]} for run in runs]}
+
+    with mock.patch.dict(lambda_wrangler_function.os.environ,
+                         dict(wrangler_environment_variables,
+                              batch_method_name="strata_period_method_batch",
+                              method_batch_size="2")):
+        with mock.patch("strata_period_wrangler.boto3.client") as mock_client:
+            mock_client.side_effect = lambda service_name, **kwargs: \
+                mock.Mock(invoke=mock.Mock(side_effect=timing_out_invoke)) \
+                if service_name == "lambda" else client
+            with mock.patch("strata_period_wrangler.aws_functions.send_bpm_status"), \
+                    mock.patch("strata_period_wrangler.aws_functions."
+                               "send_sns_message_with_anomalies"), \
+                    mock.patch("strata_period_wrangler.general_functions."
+                               "handle_exception",
+                               side_effect=lambda e, *args, **kwargs:
+                               type(e).__name__) as mock_exception:
+                outputs = [lambda_wrangler_function.batch_lambda_handler(
+                    event, test_generic_library.context_object) for _ in range(2)]
+
+            lambda_clients = [call for call in mock_client.call_args_list
+                              if call[0][0] == "lambda"]
+
+    assert len(lambda_clients) == 1
+    assert lambda_clients[0][1]["config"] is \
+        lambda_wrangler_function.BATCH_LAMBDA_CONFIG
+    for output in outputs:
+        assert not output["success"]
+        assert output["results"] == [
+            {"run_id": "run1", "success": False, "error": "ReadTimeoutError"},
+            {"run_id": "run2", "success": False, "error": "ReadTimeoutError"},
+            {"run_id": "run3", "success": True}]
+        assert output["batchItemFailures"] == [{"itemIdentifier": "message-run1"},
+                                               {"itemIdentifier": "message-run2"}]
+    assert mock_exception.call_count == 4
+    assert mock_exception.call_args[1]["bpm_queue_url"] == \
+        runs[1]["bpm_queue_url"]